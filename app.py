@@ -1,74 +1,343 @@
 import streamlit as st
 import mysql.connector
-import toml
 import pandas as pd
+import functools
 import io
-import datetime
-import secrets
-
-
-def _safe_ident(name):
+import itertools
+import os
+import tempfile
+
+from masking_core import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_ENV_JOB_LIMIT,
+    DEFAULT_FANOUT_THRESHOLD,
+    EXPORT_FORMATS,
+    MAX_LOOKUP_ROWS,
+    MAX_SKIPPED_EXAMPLES,
+    UPLOAD_FORMATS,
+    Job,
+    config_error,
+    detached_upload,
+    estimate_impact,
+    execute_batch,
+    execute_rollback,
+    execute_single,
+    export_details,
+    fan_out_blocker,
+    fan_out_matrix,
+    find_batch,
+    get_connection,
+    get_job_runner,
+    iter_mapping,
+    iter_upload_chunks,
+    load_config,
+    lookup_changes,
+    mapping_check,
+    new_batch_id,
+    normalize_mapping,
+    overwrite_blocker,
+    plan_targets,
+    pool_for,
+    prepare_mapping,
+    prepared_source,
+    query_batches,
+    query_details,
+    read_upload,
+    release_connection,
+    require_log_config,
+    resume_blocker,
+    rollback_blocker,
+    row_states,
+    safe_ident,
+    scan_upload,
+    schema_error,
+    split_db_config,
+    submit_fan_out,
+    table_schema,
+    target_label,
+)
+
+# Uploads above this size default to streaming ingestion
+STREAMING_THRESHOLD_BYTES = 20 * 1024 * 1024
+PREVIEW_PAGE_SIZE = 100
+# History browser: batches per page, detail rows per page
+HISTORY_PAGE_SIZE = 50
+DETAIL_PAGE_SIZE = 200
+EXPORT_MIME_TYPES = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv",
+}
+
+
+def _render_pool_stats(env_db_config):
     """
-    Basic safeguard to avoid backticks in identifiers.
+    Show usage counters of the pools serving the selected environment.
     """
-    if not name:
-        return ""
-    return name.replace("`", "")
-
-
-def _now_str():
-    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    target_db, main_db = split_db_config(env_db_config)
+    rows = []
+    for label, db_cfg in (("目标库", target_db), ("主库", main_db)):
+        if not all(db_cfg.get(k) for k in ("host", "port", "database")):
+            continue
+        stats = pool_for(db_cfg).stats()
+        rows.append(
+            {
+                "连接池": label,
+                "使用中": stats["in_use"],
+                "空闲": stats["idle"],
+                "上限": stats["size"],
+                "新建": stats["created"],
+                "复用": stats["reused"],
+                "丢弃": stats["discarded"],
+                "等待": stats["waits"],
+            }
+        )
+    if rows:
+        with st.sidebar.expander("连接池状态"):
+            st.dataframe(pd.DataFrame(rows), hide_index=True)
+
+
+JOB_KIND_LABELS = {"batch": "批量替换", "rollback": "回退"}
+JOB_STATUS_LABELS = {
+    "queued": "排队中",
+    "running": "运行中",
+    "done": "已完成",
+    "failed": "失败",
+    "cancelled": "已取消",
+}
+# Batch log statuses (masking_replace_log.status)
+BATCH_STATUS_LABELS = {
+    "running": "执行中",
+    "done": "已完成",
+    "failed": "失败",
+    "cancelled": "已取消",
+    "rolling_back": "回退中",
+    "rollback": "已回退",
+}
+# Server health signals of the online mode (see masking_core._Throttle)
+HEALTH_SIGNAL_LABELS = {
+    "threads_running": "运行线程数",
+    "lock_waits": "行锁等待数",
+    "replica_lag": "复制延迟（秒）",
+}
+
+
+def _unavailable_text(names):
+    return (
+        "在线模式：服务器未提供"
+        + "、".join(HEALTH_SIGNAL_LABELS.get(name, name) for name in names)
+        + "，这些限制未生效。"
+    )
 
 
-def _new_batch_id():
-    ts = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-    return f"{ts}-{secrets.token_hex(4)}"
+def _health_text(values):
+    return "，".join(
+        f"{HEALTH_SIGNAL_LABELS.get(name, name)} "
+        f"{'未复制' if value is None else value}"
+        for name, value in values.items()
+    )
 
 
-def _insert_batch_log(cursor, log_table, batch_id, env_name, operator, mode):
-    query = (
-        f"INSERT INTO `{log_table}` "
-        "(batch_id, env_name, operator, mode, created_at, total_rows, status) "
-        "VALUES (%s, %s, %s, %s, %s, %s, %s)"
-    )
-    cursor.execute(
-        query, (batch_id, env_name, operator, mode, _now_str(), 0, "failed")
-    )
+@st.fragment(run_every=2)
+def _render_jobs(job_ids=None):
+    """
+    Live progress of background jobs (all of them when job_ids is None).
+    """
+    runner = get_job_runner()
+    if job_ids is None:
+        jobs = runner.jobs()
+    else:
+        jobs = [job for job in map(runner.get, job_ids) if job]
+    if not jobs:
+        st.info("暂无后台任务。")
+        return
+    for job in jobs:
+        snap = job.snapshot()
+        with st.container(border=True):
+            st.markdown(
+                f"**{JOB_KIND_LABELS.get(job.kind, job.kind)}** `{job.batch_id}` "
+                f"· {job.env_name} · {job.operator} "
+                f"· {JOB_STATUS_LABELS.get(job.status, job.status)}"
+            )
+            if snap["total"]:
+                st.progress(min(snap["processed"] / snap["total"], 1.0))
+            cols = st.columns(4)
+            total = snap["total"] if snap["total"] is not None else "?"
+            cols[0].metric("已处理", f"{snap['processed']}/{total}")
+            cols[1].metric("速度（行/秒）", f"{snap['rate']:.0f}")
+            cols[2].metric(
+                "预计剩余", "-" if snap["eta"] is None else f"{snap['eta']:.0f} 秒"
+            )
+            cols[3].metric("已用时", f"{snap['elapsed']:.0f} 秒")
+            if job.active and job.stats is not None and job.stats.throttle:
+                throttle = job.stats.throttle.summary()
+                if throttle["paused"]:
+                    st.warning(
+                        "在线模式：服务器负载过高，已暂停"
+                        f"（{_health_text(throttle['paused'])}）"
+                    )
+                else:
+                    st.caption(
+                        f"在线模式：实际 {throttle['rows_per_sec']:.0f} 行/秒，"
+                        f"限速等待 {throttle['throttled_seconds']:.0f} 秒，"
+                        f"暂停 {throttle['paused_seconds']:.0f} 秒"
+                    )
+                if throttle["unavailable"]:
+                    st.caption(_unavailable_text(throttle["unavailable"]))
+            if job.message:
+                if job.status == "failed":
+                    st.error(job.message)
+                else:
+                    st.success(job.message)
+            if not job.active and job.stats is not None:
+                with st.expander("执行统计"):
+                    _render_run_stats(job.stats.summary())
+            if job.active:
+                st.button(
+                    "取消任务",
+                    key=f"cancel-{job.job_id}",
+                    on_click=job.cancel,
+                    disabled=job.cancel_requested,
+                )
 
 
-def _update_batch_log(cursor, log_table, batch_id, total_rows, status):
-    query = (
-        f"UPDATE `{log_table}` SET total_rows = %s, status = %s WHERE batch_id = %s"
-    )
-    cursor.execute(query, (total_rows, status, batch_id))
+def _cancel_jobs(jobs):
+    for job in jobs:
+        job.cancel()
 
 
-def _insert_detail_logs(cursor, log_detail_table, batch_id, details):
-    if not details:
+@st.fragment(run_every=2)
+def _render_fan_out(job_ids):
+    """
+    Aggregate progress and result matrix of a batch run in several
+    environments at once (see submit_fan_out).
+    """
+    runner = get_job_runner()
+    jobs = [job for job in map(runner.get, job_ids) if job]
+    if not jobs:
+        st.info("任务记录已清理。")
         return
-    query = (
-        f"INSERT INTO `{log_detail_table}` "
-        "(batch_id, row_id, old_name, new_name, updated_at) "
-        "VALUES (%s, %s, %s, %s, %s)"
+    rows, totals = fan_out_matrix(jobs)
+    if totals["total"]:
+        st.progress(min(totals["processed"] / totals["total"], 1.0))
+    cols = st.columns(4)
+    cols[0].metric("环境", len(rows))
+    cols[1].metric("已处理（合计）", f"{totals['processed']}/{totals['total']}")
+    cols[2].metric("已替换记录（合计）", totals["replaced"])
+    cols[3].metric("已完成", f"{totals['statuses'].get('done', 0)}/{len(rows)}")
+    st.dataframe(
+        pd.DataFrame(
+            [
+                {
+                    "环境": row["env_name"],
+                    "批次号": row["batch_id"],
+                    "状态": JOB_STATUS_LABELS.get(row["status"], row["status"]),
+                    "进度": f"{row['processed']}/{row['total']}",
+                    "替换记录": row["replaced"],
+                    "已用时（秒）": row["elapsed"],
+                    "结果": row["message"],
+                }
+                for row in rows
+            ]
+        ),
+        hide_index=True,
     )
-    cursor.executemany(query, details)
+    if totals["active"]:
+        st.button(
+            "全部取消",
+            key=f"cancel-fan-out-{job_ids[0]}",
+            on_click=_cancel_jobs,
+            args=(jobs,),
+        )
 
 
-def _require_log_config(db_config):
-    return db_config.get("log_table"), db_config.get("log_detail_table")
+def _render_run_stats(summary):
+    """
+    Show a RunStats summary: totals, per-phase counters with their latency
+    histograms, and the slowest statements.
+    """
+    cols = st.columns(4)
+    cols[0].metric("SQL 语句", summary["statements"])
+    cols[1].metric("数据库往返", summary["round_trips"])
+    cols[2].metric("提交次数", summary["commits"])
+    cols[3].metric("数据库耗时", f"{summary['db_seconds']:.2f} 秒")
+    bounds = summary["buckets_ms"]
+    bucket_labels = [f"≤{b}ms" for b in bounds] + [f">{bounds[-1]}ms"]
+    rows = []
+    for phase, c in summary["phases"].items():
+        calls = sum(c["histogram"])
+        rows.append(
+            {
+                "阶段": phase,
+                "语句数": c["statements"],
+                "往返": c["round_trips"],
+                "行数": c["rows"],
+                "耗时（秒）": c["seconds"],
+                "平均（毫秒）": round(c["seconds"] * 1000 / calls, 2) if calls else 0,
+                "最大（毫秒）": c["max_ms"],
+                **dict(zip(bucket_labels, c["histogram"])),
+            }
+        )
+    st.dataframe(pd.DataFrame(rows), hide_index=True)
+    if summary["chunking"]:
+        st.caption("分块大小")
+        st.dataframe(
+            pd.DataFrame(
+                [
+                    {
+                        "分块": name,
+                        "自适应": c["adaptive"],
+                        "初始": c["initial"],
+                        "最终": c["final"],
+                        "最小": c["smallest"],
+                        "最大": c["largest"],
+                        "调整次数": c["changes"],
+                        "锁等待退避": c["lock_backoffs"],
+                        "事务过大拆分": c["size_backoffs"],
+                    }
+                    for name, c in summary["chunking"].items()
+                ]
+            ),
+            hide_index=True,
+        )
+    throttle = summary.get("throttle")
+    if throttle:
+        st.caption("在线模式")
+        cols = st.columns(4)
+        cols[0].metric("实际吞吐（行/秒）", f"{throttle['rows_per_sec']:.0f}")
+        cols[1].metric("限速等待", f"{throttle['throttled_seconds']:.1f} 秒")
+        cols[2].metric("暂停", f"{throttle['pauses']} 次")
+        cols[3].metric("暂停时长", f"{throttle['paused_seconds']:.1f} 秒")
+        budget = []
+        if throttle["max_rows_per_sec"]:
+            budget.append(f"{throttle['max_rows_per_sec']:g} 行/秒")
+        if throttle["max_transactions_per_sec"]:
+            budget.append(f"{throttle['max_transactions_per_sec']:g} 事务/秒")
+        st.caption(
+            f"限速：{'，'.join(budget) or '不限'}；"
+            f"共 {throttle['rows']} 行、{throttle['transactions']} 个事务。"
+        )
+        if throttle["reasons"]:
+            st.caption(
+                "暂停原因："
+                + "，".join(
+                    f"{HEALTH_SIGNAL_LABELS.get(name, name)} {count} 次"
+                    for name, count in throttle["reasons"].items()
+                )
+            )
+        if throttle.get("unavailable"):
+            st.caption(_unavailable_text(throttle["unavailable"]))
+    if summary["slow"]:
+        st.caption(f"慢语句（超过 {summary['slow_ms']:.0f} 毫秒）")
+        st.dataframe(pd.DataFrame(summary["slow"]), hide_index=True)
 
 
-def _split_db_config(env_db_config):
+def jobs_page():
     """
-    Return (target_db, main_db).
-    Supports legacy [database] by using it for both.
+    UI listing the background jobs of every session in this process.
     """
-    target_db = env_db_config.get("target_database")
-    main_db = env_db_config.get("main_database")
-    legacy_db = env_db_config.get("database")
-    if not target_db and not main_db and legacy_db:
-        return legacy_db, legacy_db
-    return target_db or {}, main_db or {}
+    st.header("后台任务")
+    st.caption("任务在服务端后台运行，关闭浏览器不会中断；进度每 2 秒自动刷新。")
+    _render_jobs()
 
 
 def single_replacement(env_db_config, env_name, operator):
@@ -82,422 +351,535 @@ def single_replacement(env_db_config, env_name, operator):
     name_b = st.text_input("替换后的客户名")
 
     if st.button("执行单个替换"):
-        target_db, main_db = _split_db_config(env_db_config)
-        target_host = target_db.get("host")
-        target_port = target_db.get("port")
-        target_user = target_db.get("user")
-        target_password = target_db.get("password")
-        target_name = target_db.get("database")
-        target_table = target_db.get("table")
-        target_column = target_db.get("column")
-        target_id_column = target_db.get("id_column")
-
-        main_host = main_db.get("host")
-        main_port = main_db.get("port")
-        main_user = main_db.get("user")
-        main_password = main_db.get("password")
-        main_name = main_db.get("database")
-        log_table, log_detail_table = _require_log_config(main_db)
-
-        if not all(
-            [
-                target_host,
-                target_port,
-                target_user,
-                target_name,
-                target_table,
-                target_column,
-                name_b,
-            ]
-        ):
-            st.error("请在 `config.toml` 中填写目标库的完整信息，并在UI中填写替换后的客户名。")
-        elif not all([target_id_column]):
-            st.error("请在 `config.toml` 中配置目标库的 `id_column`。")
-        elif not all([main_host, main_port, main_user, main_name]):
-            st.error("请在 `config.toml` 中填写主库的完整信息。")
-        elif not all([log_table, log_detail_table]):
-            st.error("请在 `config.toml` 中配置主库日志表 `log_table` 和 `log_detail_table`。")
+        target_db, main_db = split_db_config(env_db_config)
+        error = config_error(env_db_config)
+
+        if error:
+            st.error(error)
+        elif not name_b:
+            st.error("请在UI中填写替换后的客户名。")
         elif not operator:
             st.error("操作人不能为空，请在侧边栏填写。")
         elif not id_val and not name_a:
             st.error("ID 和原客户名必须至少填写一个。")
+        elif error := schema_error(target_db):
+            st.error(error)
         else:
-            conn_target = None
-            conn_main = None
             try:
-                conn_main = mysql.connector.connect(
-                    host=main_host,
-                    port=int(main_port),
-                    user=main_user,
-                    password=main_password,
-                    database=main_name,
-                )
-                conn_target = mysql.connector.connect(
-                    host=target_host,
-                    port=int(target_port),
-                    user=target_user,
-                    password=target_password,
-                    database=target_name,
-                )
-
-                cursor_main = conn_main.cursor()
-                cursor_target = conn_target.cursor()
-                where_clause = ""
-                params = []
-                safe_table = _safe_ident(target_table)
-                safe_column = _safe_ident(target_column)
-                safe_id_column = _safe_ident(target_id_column)
-                safe_log_table = _safe_ident(log_table)
-                safe_log_detail_table = _safe_ident(log_detail_table)
-
-                if id_val:
-                    where_clause = f"`{safe_id_column}` = %s"
-                    params.append(id_val)
-                else:
-                    where_clause = f"`{safe_column}` = %s"
-                    params.append(name_a)
-
-                batch_id = _new_batch_id()
-                _insert_batch_log(
-                    cursor_main, safe_log_table, batch_id, env_name, operator, "single"
-                )
-                conn_main.commit()
-
-                select_query = (
-                    f"SELECT `{safe_id_column}`, `{safe_column}` "
-                    f"FROM `{safe_table}` WHERE {where_clause}"
-                )
-                cursor_target.execute(select_query, tuple(params))
-                rows = cursor_target.fetchall()
-                details = [
-                    (batch_id, str(row[0]), row[1], name_b, _now_str()) for row in rows
-                ]
-                _insert_detail_logs(
-                    cursor_main, safe_log_detail_table, batch_id, details
-                )
-                conn_main.commit()
-
-                query = (
-                    f"UPDATE `{safe_table}` SET `{safe_column}` = %s WHERE {where_clause}"
-                )
-                params.insert(0, name_b)
-
-                cursor_target.execute(query, tuple(params))
-                conn_target.commit()
-
-                _update_batch_log(
-                    cursor_main, safe_log_table, batch_id, len(rows), "done"
+                matched, updated = execute_single(
+                    target_db, main_db, env_name, operator, id_val, name_a, name_b
                 )
-                conn_main.commit()
-
-                if len(rows) == 0:
+                if matched == 0:
                     st.warning("未匹配到任何记录，已记录本次操作。")
                 else:
-                    st.success(f"成功更新了 {cursor_target.rowcount} 条记录。")
-
+                    st.success(f"成功更新了 {updated} 条记录。")
             except mysql.connector.Error as err:
-                try:
-                    if conn_main and conn_main.is_connected():
-                        cursor_main = conn_main.cursor()
-                        _update_batch_log(
-                            cursor_main, safe_log_table, batch_id, 0, "failed"
-                        )
-                        conn_main.commit()
-                except Exception:
-                    pass
                 handle_db_error(err)
-            finally:
-                if conn_target and conn_target.is_connected():
-                    cursor_target.close()
-                    conn_target.close()
-                if conn_main and conn_main.is_connected():
-                    cursor_main.close()
-                    conn_main.close()
 
 
-def batch_replacement(env_db_config, env_name, operator):
+def batch_replacement(env_db_config, env_name, operator, env_to_db):
     """
-    UI and logic for batch name replacement.
+    UI and logic for batch name replacement, in the selected environment or
+    in several environments of env_to_db at once.
     """
     st.header(f"批量替换 - {env_name}")
     st.write("下载Excel模板，填写后上传以进行批量替换。")
 
-    target_db, main_db = _split_db_config(env_db_config)
+    target_db, main_db = split_db_config(env_db_config)
     id_column_name = target_db.get("id_column", "ID")
-    template_df = pd.DataFrame(
-        {
-            id_column_name: ["示例ID1", "示例ID2"],
-            "原客户名": ["示例客户A", "示例客户B"],
-            "替换后客户名": ["新客户A", "新客户B"],
-        }
-    )
-    excel_buffer = io.BytesIO()
-    with pd.ExcelWriter(excel_buffer, engine="openpyxl") as writer:
-        template_df.to_excel(writer, index=False, sheet_name="客户名替换")
-    excel_buffer.seek(0)
-
     st.download_button(
         label="下载Excel模板",
-        data=excel_buffer,
+        data=_template_xlsx(id_column_name),
         file_name="客户名替换模板.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        mime=EXPORT_MIME_TYPES["xlsx"],
     )
 
-    uploaded_file = st.file_uploader("上传Excel文件", type=["xlsx"])
+    uploaded_file = st.file_uploader(
+        "上传Excel/CSV文件", type=list(UPLOAD_FORMATS.keys())
+    )
 
     if uploaded_file:
         try:
-            df = pd.read_excel(uploaded_file, dtype={id_column_name: str})
-            st.subheader("请确认要替换的客户名列表")
-            st.write("您可以编辑表格中的内容。")
-            edited_df = st.data_editor(df, num_rows="dynamic")
-
-            if st.button("执行批量替换"):
-                target_host = target_db.get("host")
-                target_port = target_db.get("port")
-                target_user = target_db.get("user")
-                target_password = target_db.get("password")
-                target_name = target_db.get("database")
-                target_table = target_db.get("table")
-                target_column = target_db.get("column")
-                target_id_column = target_db.get("id_column")
-
-                main_host = main_db.get("host")
-                main_port = main_db.get("port")
-                main_user = main_db.get("user")
-                main_password = main_db.get("password")
-                main_name = main_db.get("database")
-                log_table, log_detail_table = _require_log_config(main_db)
-
-                if not all(
-                    [
-                        target_host,
-                        target_port,
-                        target_user,
-                        target_name,
-                        target_table,
-                        target_column,
-                        target_id_column,
-                    ]
-                ):
-                    st.error("请在 `config.toml` 中填写目标库的完整信息。")
-                elif not all([main_host, main_port, main_user, main_name]):
-                    st.error("请在 `config.toml` 中填写主库的完整信息。")
-                elif not all([log_table, log_detail_table]):
-                    st.error("请在 `config.toml` 中配置主库日志表 `log_table` 和 `log_detail_table`。")
+            chunk_size = int(target_db.get("chunk_size", DEFAULT_CHUNK_SIZE))
+            streaming = st.toggle(
+                "流式处理（适用于大文件，表格仅预览、不可编辑）",
+                value=uploaded_file.size > STREAMING_THRESHOLD_BYTES,
+            )
+            if streaming:
+                summary_key = ("upload_summary", uploaded_file.file_id, id_column_name)
+                if summary_key not in st.session_state:
+                    with st.spinner("正在校验文件..."):
+                        st.session_state[summary_key] = scan_upload(
+                            uploaded_file, id_column_name, chunk_size
+                        )
+                summary = st.session_state[summary_key]
+                columns = summary["columns"]
+                check = summary["check"]
+                _render_upload_summary(uploaded_file, id_column_name, summary)
+                _render_mapping_check(check, id_column_name)
+            else:
+                df = read_upload(uploaded_file, id_column_name)
+                st.subheader("请确认要替换的客户名列表")
+                st.write("您可以编辑表格中的内容。")
+                edited_df = st.data_editor(df, num_rows="dynamic")
+                columns = list(edited_df.columns)
+                mapping, skipped = normalize_mapping(edited_df, id_column_name)
+                plan = prepare_mapping(mapping)
+                check = mapping_check(plan)
+                _render_mapping_check(check, id_column_name, skipped)
+
+            run_mode = st.radio(
+                "执行方式",
+                ["集合批量（推荐）", "逐行（兼容）"],
+                horizontal=True,
+                help="集合批量：先写入目标库临时表，再按分块执行 JOIN 查询与更新；逐行：每行单独查询、更新并提交。",
+            )
+            env_names = st.multiselect(
+                "执行环境",
+                list(env_to_db),
+                default=[env_name],
+                help="选择多个环境时，同一份映射在这些环境中同时执行，每个环境各自生成批次号，使用各自的连接与配置。",
+            )
+            fan_out = env_names != [env_name]
+
+            if st.button("预估影响（Dry-run）"):
+                error = config_error(env_db_config, ("target", "id_column"))
+                if error:
+                    st.error(error)
+                elif error := schema_error(target_db):
+                    st.error(error)
+                else:
+                    if streaming:
+                        plan = prepare_mapping(
+                            iter_mapping(
+                                iter_upload_chunks(
+                                    uploaded_file, id_column_name, chunk_size
+                                ),
+                                id_column_name,
+                            )
+                        )
+                    conn_target = None
+                    targets = plan_targets(target_db)
+                    try:
+                        conn_target = get_connection(target_db)
+                        for target in targets:
+                            with st.spinner("正在预估..."):
+                                report = estimate_impact(
+                                    conn_target,
+                                    {
+                                        "table": safe_ident(target.get("table")),
+                                        "column": safe_ident(target.get("column")),
+                                        "id_column": safe_ident(
+                                            target.get("id_column")
+                                        ),
+                                    },
+                                    plan,
+                                    chunk_size,
+                                    int(
+                                        target_db.get(
+                                            "fanout_threshold", DEFAULT_FANOUT_THRESHOLD
+                                        )
+                                    ),
+                                    table_schema(target),
+                                )
+                            _render_impact_report(
+                                report,
+                                id_column_name,
+                                target_label(target) if len(targets) > 1 else None,
+                            )
+                    except mysql.connector.Error as err:
+                        handle_db_error(err)
+                    finally:
+                        if conn_target:
+                            release_connection(target_db, conn_target)
+
+            resume_batch_id = st.text_input(
+                "续做中断的批次（可选）",
+                help="填写失败、已取消或执行中断的批次号，并上传该批次原来的映射文件；已完成的部分会被跳过。",
+                disabled=fan_out,
+            ).strip()
+            run_clicked = st.button("执行批量替换")
+            resume_clicked = st.button(
+                "续做批次", disabled=fan_out or not resume_batch_id
+            )
+            if run_clicked or resume_clicked:
+                if fan_out:
+                    error = fan_out_blocker(env_to_db, env_names)
+                else:
+                    error = config_error(env_db_config)
+                if error:
+                    st.error(error)
                 elif not operator:
                     st.error("操作人不能为空，请在侧边栏填写。")
-                elif edited_df.empty:
+                elif (streaming and summary["total"] == 0) or (
+                    not streaming and edited_df.empty
+                ):
                     st.warning("上传的Excel文件为空或编辑后无数据。")
                 elif (
-                    id_column_name not in edited_df.columns
-                    and "原客户名" not in edited_df.columns
-                ) or "替换后客户名" not in edited_df.columns:
+                    id_column_name not in columns and "原客户名" not in columns
+                ) or "替换后客户名" not in columns:
                     st.error(
                         f"Excel文件必须包含 '{id_column_name}' 或 '原客户名' 列，以及 '替换后客户名' 列。"
                     )
+                elif not fan_out and (error := schema_error(target_db)):
+                    st.error(error)
+                elif check["cycles"]:
+                    st.error("映射中存在循环，请先修改后再执行。")
+                elif check["reentered"]:
+                    st.error(
+                        "映射中有原客户名在其他行改成它之后再次出现，请先修改后再执行。"
+                    )
+                elif resume_clicked and (
+                    error := _resume_error(main_db, resume_batch_id, env_name)
+                ):
+                    st.error(error)
                 else:
-                    conn_target = None
-                    conn_main = None
-                    try:
-                        conn_main = mysql.connector.connect(
-                            host=main_host,
-                            port=int(main_port),
-                            user=main_user,
-                            password=main_password,
-                            database=main_name,
+                    if streaming:
+                        upload = detached_upload(uploaded_file)
+                        mapping_source = prepared_source(
+                            lambda: iter_mapping(
+                                iter_upload_chunks(upload, id_column_name, chunk_size),
+                                id_column_name,
+                            )
                         )
-                        conn_target = mysql.connector.connect(
-                            host=target_host,
-                            port=int(target_port),
-                            user=target_user,
-                            password=target_password,
-                            database=target_name,
+                    else:
+                        prepared = plan["mapping"]
+
+                        def mapping_source():
+                            return prepared
+
+                    if fan_out:
+                        jobs = submit_fan_out(
+                            env_to_db,
+                            env_names,
+                            operator,
+                            check["final_rows"],
+                            mapping_source,
+                            run_mode == "逐行（兼容）",
                         )
-                        cursor_main = conn_main.cursor()
-                        cursor_target = conn_target.cursor()
-                        total_replaced_count = 0
-                        st.write("开始批量替换...")
-                        progress_bar = st.progress(0)
-                        safe_table = _safe_ident(target_table)
-                        safe_column = _safe_ident(target_column)
-                        safe_id_column = _safe_ident(target_id_column)
-                        safe_log_table = _safe_ident(log_table)
-                        safe_log_detail_table = _safe_ident(log_detail_table)
-
-                        batch_id = _new_batch_id()
-                        _insert_batch_log(
-                            cursor_main,
-                            safe_log_table,
-                            batch_id,
+                        st.session_state["fan_out_job_ids"] = [
+                            job.job_id for job in jobs
+                        ]
+                        st.session_state.pop("batch_job_id", None)
+                    else:
+                        job = Job(
+                            new_batch_id(),
+                            "batch",
                             env_name,
                             operator,
-                            "batch",
+                            check["final_rows"],
+                            batch_id=resume_batch_id if resume_clicked else None,
                         )
-                        conn_main.commit()
-                        total_logged_rows = 0
-
-                        for i, row in edited_df.iterrows():
-                            new_name = row.get("替换后客户名")
-                            id_val = row.get(id_column_name)
-                            old_name = row.get("原客户名")
-
-                            if pd.isna(new_name) or (
-                                pd.isna(id_val) and pd.isna(old_name)
-                            ):
-                                st.warning(
-                                    f"跳过无效行: ID={id_val}, 原客户名={old_name}, 替换后客户名={new_name}"
+                        get_job_runner().submit(
+                            job,
+                            int(
+                                target_db.get(
+                                    "max_concurrent_jobs", DEFAULT_ENV_JOB_LIMIT
                                 )
-                                continue
-
-                            where_clause = ""
-                            params = []
-
-                            if pd.notna(id_val):
-                                where_clause = f"`{safe_id_column}` = %s"
-                                params.append(str(id_val))
-                            elif pd.notna(old_name):
-                                where_clause = f"`{safe_column}` = %s"
-                                params.append(old_name)
-                            else:
-                                continue
-
-                            select_query = (
-                                f"SELECT `{safe_id_column}`, `{safe_column}` "
-                                f"FROM `{safe_table}` WHERE {where_clause}"
-                            )
-                            cursor_target.execute(select_query, tuple(params))
-                            rows = cursor_target.fetchall()
-                            details = [
-                                (batch_id, str(r[0]), r[1], new_name, _now_str())
-                                for r in rows
-                            ]
-                            _insert_detail_logs(
-                                cursor_main, safe_log_detail_table, batch_id, details
-                            )
-                            conn_main.commit()
-                            total_logged_rows += len(rows)
+                            ),
+                            execute_batch,
+                            target_db,
+                            main_db,
+                            mapping_source,
+                            run_mode == "逐行（兼容）",
+                            chunk_size,
+                            int(target_db.get("parallel_workers", 1)),
+                            resume_clicked,
+                        )
+                        st.session_state["batch_job_id"] = job.job_id
+                        st.session_state.pop("fan_out_job_ids", None)
+        except Exception as e:
+            st.error(f"读取Excel文件失败: {e}")
 
-                            query = (
-                                f"UPDATE `{safe_table}` SET `{safe_column}` = %s "
-                                f"WHERE {where_clause}"
-                            )
-                            params.insert(0, new_name)
+    if st.session_state.get("batch_job_id"):
+        st.subheader("任务进度")
+        _render_jobs([st.session_state["batch_job_id"]])
+    if st.session_state.get("fan_out_job_ids"):
+        st.subheader("多环境执行")
+        _render_fan_out(st.session_state["fan_out_job_ids"])
 
-                            cursor_target.execute(query, tuple(params))
-                            conn_target.commit()
-                            total_replaced_count += cursor_target.rowcount
 
-                            progress_bar.progress((i + 1) / len(edited_df))
+@st.cache_data(show_spinner=False)
+def _template_xlsx(id_column_name):
+    """
+    The mapping template for an id column, as xlsx bytes; built once per id
+    column and shared by every session.
+    """
+    template_df = pd.DataFrame(
+        {
+            id_column_name: ["示例ID1", "示例ID2"],
+            "原客户名": ["示例客户A", "示例客户B"],
+            "替换后客户名": ["新客户A", "新客户B"],
+        }
+    )
+    excel_buffer = io.BytesIO()
+    with pd.ExcelWriter(excel_buffer, engine="openpyxl") as writer:
+        template_df.to_excel(writer, index=False, sheet_name="客户名替换")
+    return excel_buffer.getvalue()
 
-                        _update_batch_log(
-                            cursor_main,
-                            safe_log_table,
-                            batch_id,
-                            total_logged_rows,
-                            "done",
-                        )
-                        conn_main.commit()
 
-                        st.success(
-                            f"批量替换完成！共替换了 {total_replaced_count} 条记录。"
-                        )
-                    except mysql.connector.Error as err:
-                        try:
-                            if conn_main and conn_main.is_connected():
-                                cursor_main = conn_main.cursor()
-                                _update_batch_log(
-                                    cursor_main, safe_log_table, batch_id, 0, "failed"
-                                )
-                                conn_main.commit()
-                        except Exception:
-                            pass
-                        handle_db_error(err)
-                    except Exception as e:
-                        st.error(f"发生未知错误: {e}")
-                    finally:
-                        if conn_target and conn_target.is_connected():
-                            cursor_target.close()
-                            conn_target.close()
-                        if conn_main and conn_main.is_connected():
-                            cursor_main.close()
-                            conn_main.close()
-        except Exception as e:
-            st.error(f"读取Excel文件失败: {e}")
+def _export_file(main_db, batch_id, fmt, with_target):
+    """
+    A batch's detail log exported to a temporary file, rewound for reading;
+    called by the download button only when it is clicked.
+    """
+    out = tempfile.TemporaryFile()
+    export_details(main_db, batch_id, out, fmt, with_target)
+    out.seek(0)
+    return out
 
 
-def rollback_records(env_db_config, env_name):
+def _resume_error(main_db, batch_id, env_name):
+    """
+    Why batch_id cannot be resumed, or None.
+    """
+    batch = find_batch(main_db, batch_id)
+    if batch is None:
+        return f"未找到批次 `{batch_id}`。"
+    return resume_blocker(batch, env_name, main_db)
+
+
+def _render_impact_report(report, id_column_name, label=None):
+    """
+    Show the result of estimate_impact (for the plan target `label`).
+    """
+    st.subheader(f"影响预估（未修改任何数据）{f' - {label}' if label else ''}")
+    cols = st.columns(4)
+    cols[0].metric("有效映射行", report["rows"])
+    cols[1].metric("匹配到记录的键", f"{report['matched_keys']}/{report['distinct_keys']}")
+    cols[2].metric("将更新的记录", report["matched_rows"])
+    cols[3].metric("预计日志明细行", report["estimated_log_rows"])
+    st.caption(f"预估耗时 {report['elapsed']:.2f} 秒。")
+    kind_labels = {"id": id_column_name, "name": "原客户名"}
+    for name in report["unindexed"]:
+        st.warning(f"目标表的 `{name}` 列上没有索引，按该列匹配将扫描全表。")
+
+    for path, kind, plan, full_scan in report["explains"]:
+        label = f"{path}（{kind_labels[kind]}）"
+        if full_scan:
+            st.warning(f"{label}：执行计划显示将对目标表进行全表扫描。")
+        with st.expander(f"执行计划 - {label}"):
+            st.dataframe(pd.DataFrame(plan), hide_index=True)
+
+    if report["unmatched_keys"]:
+        st.info(f"{report['unmatched_keys']} 个键未匹配到任何记录。")
+    if report["fanout"]:
+        st.warning(
+            f"{len(report['fanout'])} 个键匹配超过 {report['fanout_threshold']} 条记录。"
+        )
+        st.dataframe(
+            pd.DataFrame(
+                [(kind_labels[k], key, n) for k, key, n in report["fanout"]],
+                columns=["键类型", "键", "匹配记录数"],
+            ),
+            hide_index=True,
+        )
+
+
+def _render_mapping_check(check, id_column_name, skipped=None):
+    """
+    Show what prepare_mapping found in the sheet before anything runs.
+    """
+    st.subheader("映射预处理")
+    cols = st.columns(4)
+    cols[0].metric("有效映射行", check["rows"])
+    cols[1].metric("实际执行行", check["final_rows"])
+    cols[2].metric("冲突的键", len(check["conflicts"]))
+    cols[3].metric("链式映射", len(check["chains"]))
+    kind_labels = {"id": id_column_name, "name": "原客户名"}
+    if skipped:
+        st.warning(
+            f"{len(skipped)} 行缺少替换后客户名，或 ID 与原客户名均为空，将被跳过。"
+        )
+        with st.expander("无效行"):
+            st.dataframe(
+                pd.DataFrame(
+                    skipped, columns=[id_column_name, "原客户名", "替换后客户名"]
+                ),
+                hide_index=True,
+            )
+    if check["cycles"]:
+        st.error(
+            f"{len(check['cycles'])} 行映射构成循环（如 A→B、B→A）。按顺序执行会把它们"
+            "合并为同一个名称，请修改后再执行。"
+        )
+        st.dataframe(
+            pd.DataFrame(check["cycles"], columns=["原客户名", "替换后客户名"]),
+            hide_index=True,
+        )
+    if check["reentered"]:
+        st.error(
+            f"{len(check['reentered'])} 个原客户名在其他行把记录改成该名称之后再次出现"
+            "（如 A→B、X→A、A→C）。按顺序执行时后一行改的是另一批记录，"
+            "无法合并为一行，请修改后再执行。"
+        )
+        st.dataframe(
+            pd.DataFrame(
+                [
+                    (key, "、".join(map(str, names)))
+                    for key, names in check["reentered"]
+                ],
+                columns=["原客户名", "替换后客户名"],
+            ),
+            hide_index=True,
+        )
+    if check["conflicts"]:
+        st.warning(
+            f"{len(check['conflicts'])} 个键被映射到不同的新客户名（ID 以最后一行为准，原客户名以第一行为准）。"
+        )
+        st.dataframe(
+            pd.DataFrame(
+                [
+                    (kind_labels[k], key, "、".join(map(str, names)))
+                    for k, key, names in check["conflicts"]
+                ],
+                columns=["键类型", "键", "替换后客户名"],
+            ),
+            hide_index=True,
+        )
+    if check["duplicates"]:
+        st.info(f"{len(check['duplicates'])} 组完全重复的映射，只执行一次。")
+        st.dataframe(
+            pd.DataFrame(
+                [
+                    (kind_labels[k], key, name, n)
+                    for k, key, name, n in check["duplicates"]
+                ],
+                columns=["键类型", "键", "替换后客户名", "出现次数"],
+            ),
+            hide_index=True,
+        )
+    if check["chains"]:
+        st.info(
+            f"{len(check['chains'])} 个原客户名的替换后客户名又被后续行替换（链式映射），"
+            "已直接替换为最终名称。"
+        )
+        st.dataframe(
+            pd.DataFrame(
+                check["chains"], columns=["原客户名", "替换后客户名", "最终客户名"]
+            ),
+            hide_index=True,
+        )
+    if check["noops"]:
+        st.caption(f"{check['noops']} 行的替换后客户名与原客户名相同，已忽略。")
+    if check["reordered"]:
+        st.caption("按原客户名替换的行将先于按ID替换的行执行，以减少分块次数。")
+
+
+def _render_upload_summary(uploaded_file, id_column_name, summary):
+    """
+    Validation summary and a paginated, read-only preview of a streamed upload.
+    """
+    st.subheader("文件校验结果")
+    cols = st.columns(4)
+    cols[0].metric("总行数", summary["total"])
+    cols[1].metric("按ID替换", summary["id_keyed"])
+    cols[2].metric("按原客户名替换", summary["name_keyed"])
+    cols[3].metric("无效行", summary["skipped"])
+    if summary["skipped_examples"]:
+        with st.expander(f"无效行示例（最多 {MAX_SKIPPED_EXAMPLES} 条）"):
+            st.dataframe(
+                pd.DataFrame(
+                    summary["skipped_examples"],
+                    columns=[id_column_name, "原客户名", "替换后客户名"],
+                ),
+                hide_index=True,
+            )
+
+    st.subheader("数据预览")
+    page_count = max(1, -(-summary["total"] // PREVIEW_PAGE_SIZE))
+    page = st.number_input("页码", min_value=1, max_value=page_count, value=1)
+    st.caption(f"共 {page_count} 页，每页 {PREVIEW_PAGE_SIZE} 行。")
+    preview = next(
+        itertools.islice(
+            iter_upload_chunks(uploaded_file, id_column_name, PREVIEW_PAGE_SIZE),
+            page - 1,
+            None,
+        ),
+        None,
+    )
+    if preview is not None:
+        st.dataframe(preview, hide_index=True)
+
+
+def _page_cursor(state_key, signature):
+    """
+    Keyset cursor of the current page. session_state[state_key] holds the
+    stack of cursors walked so far; it restarts when signature (the filters
+    the pages belong to) changes. Returns (cursor, page_number).
+    """
+    pages = st.session_state.get(state_key)
+    if not pages or pages["signature"] != signature:
+        pages = {"signature": signature, "cursors": [None]}
+        st.session_state[state_key] = pages
+    return pages["cursors"][-1], len(pages["cursors"])
+
+
+def _render_pager(state_key, next_cursor, has_more):
+    cursors = st.session_state[state_key]["cursors"]
+    cols = st.columns([1, 1, 6])
+    cols[0].button(
+        "上一页",
+        key=f"{state_key}_prev",
+        disabled=len(cursors) == 1,
+        on_click=cursors.pop,
+    )
+    cols[1].button(
+        "下一页",
+        key=f"{state_key}_next",
+        disabled=not has_more,
+        on_click=cursors.append,
+        args=(next_cursor,),
+    )
+    cols[2].caption(f"第 {len(cursors)} 页")
+
+
+def rollback_records(env_db_config, env_name, operator, env_names):
     """
     UI and logic for rollback by batch.
     """
     st.header(f"回退记录 - {env_name}")
-    target_db, main_db = _split_db_config(env_db_config)
-    target_host = target_db.get("host")
-    target_port = target_db.get("port")
-    target_user = target_db.get("user")
-    target_password = target_db.get("password")
-    target_name = target_db.get("database")
-    target_table = target_db.get("table")
-    target_column = target_db.get("column")
-    target_id_column = target_db.get("id_column")
-
-    main_host = main_db.get("host")
-    main_port = main_db.get("port")
-    main_user = main_db.get("user")
-    main_password = main_db.get("password")
-    main_name = main_db.get("database")
-    log_table, log_detail_table = _require_log_config(main_db)
-
-    if not all(
-        [
-            target_host,
-            target_port,
-            target_user,
-            target_name,
-            target_table,
-            target_column,
-            target_id_column,
-        ]
-    ):
-        st.error("请在 `config.toml` 中填写目标库的完整信息。")
-        return
-    if not all([main_host, main_port, main_user, main_name]):
-        st.error("请在 `config.toml` 中填写主库的完整信息。")
-        return
-    if not all([log_table, log_detail_table]):
-        st.error("请在 `config.toml` 中配置主库日志表 `log_table` 和 `log_detail_table`。")
+    target_db, main_db = split_db_config(env_db_config)
+    log_table, log_detail_table = require_log_config(main_db)
+    error = config_error(env_db_config)
+    if error:
+        st.error(error)
         return
 
-    conn_target = None
     conn_main = None
     try:
-        conn_main = mysql.connector.connect(
-            host=main_host,
-            port=int(main_port),
-            user=main_user,
-            password=main_password,
-            database=main_name,
+        conn_main = get_connection(main_db)
+        cursor_main = conn_main.cursor()
+        safe_log_table = safe_ident(log_table)
+        safe_log_detail_table = safe_ident(log_detail_table)
+        checkpoint_table = safe_ident(main_db.get("checkpoint_table"))
+        chunk_size = int(target_db.get("chunk_size", DEFAULT_CHUNK_SIZE))
+        with_target = len(plan_targets(target_db)) > 1
+
+        st.subheader("操作批次")
+        filter_cols = st.columns(4)
+        envs = filter_cols[0].multiselect("环境", env_names, default=[env_name])
+        statuses = filter_cols[1].multiselect(
+            "状态",
+            list(BATCH_STATUS_LABELS),
+            format_func=BATCH_STATUS_LABELS.get,
         )
-        conn_target = mysql.connector.connect(
-            host=target_host,
-            port=int(target_port),
-            user=target_user,
-            password=target_password,
-            database=target_name,
+        operator_filter = filter_cols[2].text_input("操作人筛选").strip()
+        date_range = filter_cols[3].date_input("日期范围", value=())
+        filters = {
+            "envs": envs,
+            "statuses": statuses,
+            "operator": operator_filter,
+            "date_from": date_range[0] if len(date_range) > 0 else None,
+            "date_to": date_range[1] if len(date_range) > 1 else None,
+        }
+
+        before_id, _page = _page_cursor(
+            "history_pages", tuple(map(str, filters.values()))
         )
-        cursor_main = conn_main.cursor()
-        cursor_target = conn_target.cursor()
-        safe_log_table = _safe_ident(log_table)
-        safe_log_detail_table = _safe_ident(log_detail_table)
-        safe_table = _safe_ident(target_table)
-        safe_column = _safe_ident(target_column)
-        safe_id_column = _safe_ident(target_id_column)
-
-        cursor_main.execute(
-            f"SELECT batch_id, operator, mode, created_at, total_rows, status "
-            f"FROM `{safe_log_table}` ORDER BY created_at DESC LIMIT 50"
+        batches, has_more = query_batches(
+            cursor_main, safe_log_table, filters, before_id, HISTORY_PAGE_SIZE
         )
-        batches = cursor_main.fetchall()
         if not batches:
             st.info("暂无日志记录。")
             return
@@ -505,7 +887,9 @@ def rollback_records(env_db_config, env_name):
         batch_df = pd.DataFrame(
             batches,
             columns=[
+                "id",
                 "batch_id",
+                "env_name",
                 "operator",
                 "mode",
                 "created_at",
@@ -513,64 +897,161 @@ def rollback_records(env_db_config, env_name):
                 "status",
             ],
         )
-        st.subheader("最近操作批次")
-        st.dataframe(batch_df, use_container_width=True)
+        st.dataframe(
+            batch_df.drop(columns="id"), use_container_width=True, hide_index=True
+        )
+        _render_pager("history_pages", int(batch_df["id"].iloc[-1]), has_more)
 
         batch_ids = batch_df["batch_id"].tolist()
         selected_batch = st.selectbox("选择要回退的批次", batch_ids, index=0)
+        batch_row = batch_df[batch_df["batch_id"] == selected_batch].iloc[0]
 
-        cursor_main.execute(
-            f"SELECT row_id, old_name, new_name, updated_at "
-            f"FROM `{safe_log_detail_table}` WHERE batch_id = %s",
-            (selected_batch,),
+        st.subheader("批次明细")
+        after_id, page = _page_cursor("detail_pages", selected_batch)
+        details, details_more = query_details(
+            cursor_main,
+            safe_log_detail_table,
+            selected_batch,
+            after_id,
+            DETAIL_PAGE_SIZE,
+            with_target,
+            chunk_table=safe_ident(main_db.get("log_chunk_table")),
         )
-        details = cursor_main.fetchall()
         detail_df = pd.DataFrame(
-            details, columns=["row_id", "old_name", "new_name", "updated_at"]
+            details,
+            columns=["id", "row_id", "old_name", "new_name", "updated_at"]
+            + (["target"] if with_target else []),
         )
-        st.subheader("批次明细")
-        st.dataframe(detail_df, use_container_width=True)
+        st.caption(
+            f"共 {int(batch_row['total_rows'])} 条，每页 {DETAIL_PAGE_SIZE} 条。"
+        )
+        st.dataframe(
+            detail_df.drop(columns="id"), use_container_width=True, hide_index=True
+        )
+        if details:
+            _render_pager("detail_pages", int(detail_df["id"].iloc[-1]), details_more)
+            export_cols = st.columns([1, 3])
+            export_format = export_cols[0].selectbox(
+                "导出格式", EXPORT_FORMATS, label_visibility="collapsed"
+            )
+            export_cols[1].download_button(
+                "导出批次明细",
+                data=functools.partial(
+                    _export_file,
+                    main_db,
+                    selected_batch,
+                    export_format,
+                    with_target,
+                ),
+                file_name=f"{selected_batch}.{export_format}",
+                mime=EXPORT_MIME_TYPES[export_format],
+            )
 
-        batch_row = batch_df[batch_df["batch_id"] == selected_batch].iloc[0]
-        can_rollback = batch_row["status"] == "done" and batch_row["total_rows"] > 0
-        if not can_rollback:
-            st.info("该批次不可回退（可能已回退、失败或无更新）。")
-
-        if st.button("一键回退", disabled=not can_rollback):
-            success_count = 0
-            fail_count = 0
-            for row_id, old_name, _new_name, _updated_at in details:
-                cursor_target.execute(
-                    f"UPDATE `{safe_table}` SET `{safe_column}` = %s "
-                    f"WHERE `{safe_id_column}` = %s",
-                    (old_name, row_id),
-                )
-                conn_target.commit()
-                if cursor_target.rowcount > 0:
-                    success_count += 1
-                else:
-                    fail_count += 1
+        resuming = batch_row["status"] == "rolling_back"
+        blocker = rollback_blocker(batch_row, env_name)
+        can_rollback = blocker is None
+        if blocker:
+            st.info(blocker)
+        elif resuming:
+            st.warning("该批次上次回退未完成，可继续回退。")
+        if not checkpoint_table:
+            st.caption(
+                "未配置 `checkpoint_table`，中断后的回退将从头重新执行（结果相同，但无法跳过已完成部分）。"
+            )
 
-            cursor_main.execute(
-                f"UPDATE `{safe_log_table}` SET status = %s WHERE batch_id = %s",
-                ("rollback", selected_batch),
+        runner = get_job_runner()
+        running_job = next(
+            (
+                job
+                for job in runner.jobs()
+                if job.active and job.batch_id == selected_batch
+            ),
+            None,
+        )
+        if st.button(
+            "继续回退" if resuming else "一键回退",
+            disabled=not can_rollback or running_job is not None,
+        ):
+            error = schema_error(target_db) or overwrite_blocker(
+                main_db, selected_batch, env_name, with_target
+            )
+            if error:
+                st.error(error)
+                return
+            job = Job(
+                new_batch_id(),
+                "rollback",
+                env_name,
+                operator,
+                int(batch_row["total_rows"]),
+                batch_id=selected_batch,
             )
-            conn_main.commit()
-            st.success(
-                f"回退完成：成功 {success_count} 条，失败 {fail_count} 条。"
+            runner.submit(
+                job,
+                int(target_db.get("max_concurrent_jobs", DEFAULT_ENV_JOB_LIMIT)),
+                execute_rollback,
+                target_db,
+                main_db,
+                chunk_size,
             )
+            running_job = job
+        if running_job is not None:
+            _render_jobs([running_job.job_id])
 
     except mysql.connector.Error as err:
         handle_db_error(err)
     except Exception as e:
         st.error(f"发生未知错误: {e}")
     finally:
-        if conn_target and conn_target.is_connected():
-            cursor_target.close()
-            conn_target.close()
-        if conn_main and conn_main.is_connected():
+        if conn_main:
             cursor_main.close()
-            conn_main.close()
+            release_connection(main_db, conn_main)
+
+
+def change_history(env_db_config, env_name):
+    """
+    UI for looking up a record's changes across batches, by ID or name.
+    """
+    st.header(f"修改历史 - {env_name}")
+    target_db, main_db = split_db_config(env_db_config)
+    error = config_error(env_db_config, ("main", "log"))
+    if error:
+        st.error(error)
+        return
+    cols = st.columns(2)
+    row_id = cols[0].text_input("ID(ecif客户号，集团号，商户号等)").strip()
+    name = cols[1].text_input("客户名（原客户名或替换后的客户名）").strip()
+    if not row_id and not name:
+        st.info("输入 ID 或客户名，查询其在各批次中的替换记录。")
+        return
+
+    try:
+        if main_db.get("row_state_table"):
+            st.subheader("当前状态")
+            states = row_states(main_db, row_id, name)
+            if states:
+                st.dataframe(
+                    pd.DataFrame(states), use_container_width=True, hide_index=True
+                )
+            else:
+                st.caption("状态表中没有匹配的记录。")
+
+        st.subheader("替换记录")
+        changes = lookup_changes(
+            main_db, env_name, row_id, name, len(plan_targets(target_db)) > 1
+        )
+        if not changes:
+            st.info("没有找到替换记录。")
+            return
+        st.dataframe(
+            pd.DataFrame(changes).drop(columns="id"),
+            use_container_width=True,
+            hide_index=True,
+        )
+        if len(changes) >= MAX_LOOKUP_ROWS:
+            st.caption(f"仅显示最近的 {MAX_LOOKUP_ROWS} 条。")
+    except mysql.connector.Error as err:
+        handle_db_error(err)
 
 
 def handle_db_error(err):
@@ -586,39 +1067,18 @@ def handle_db_error(err):
         )
 
 
-def local_css(file_name):
-    """
-    Load a local CSS file.
-    """
+@st.cache_resource(show_spinner=False, max_entries=1)
+def _read_css(file_name, mtime):
     with open(file_name) as f:
-        st.markdown(f"<style>{f.read()}</style>", unsafe_allow_html=True)
+        return f.read()
 
 
-def _load_db_config():
+def local_css(file_name):
     """
-    Load database config(s) from config.toml.
-    Supports:
-      - legacy [database]
-      - [environments.<name>.database]
-      - [environments.<name>.target_database] + [environments.<name>.main_database]
-    Returns: (env_names, env_to_db_config)
+    Load a local CSS file; its content is cached until the file changes.
     """
-    config = toml.load("config.toml")
-
-    if "environments" in config:
-        envs = config.get("environments", {})
-        env_to_db = {}
-        for name, env_cfg in envs.items():
-            env_to_db[name] = {
-                "database": env_cfg.get("database", {}),
-                "target_database": env_cfg.get("target_database", {}),
-                "main_database": env_cfg.get("main_database", {}),
-            }
-        env_names = list(env_to_db.keys())
-        return env_names, env_to_db
-
-    # Backward compatible single environment
-    return ["default"], {"default": {"database": config.get("database", {})}}
+    css = _read_css(file_name, os.stat(file_name).st_mtime_ns)
+    st.markdown(f"<style>{css}</style>", unsafe_allow_html=True)
 
 
 def main():
@@ -632,7 +1092,7 @@ def main():
 
     # Load configuration from config.toml
     try:
-        env_names, env_to_db = _load_db_config()
+        env_names, env_to_db = load_config()
     except FileNotFoundError:
         st.error("配置文件 `config.toml` 未找到。请创建它。")
         st.stop()
@@ -650,15 +1110,23 @@ def main():
     db_config = env_to_db.get(selected_env, {})
     operator = st.sidebar.text_input("操作人")
 
-    selection = st.sidebar.radio("选择操作模式", ["单个替换", "批量替换", "回退记录"])
+    selection = st.sidebar.radio(
+        "选择操作模式", ["单个替换", "批量替换", "回退记录", "修改历史", "后台任务"]
+    )
 
     # Display selected page
     if selection == "单个替换":
         single_replacement(db_config, selected_env, operator)
     elif selection == "批量替换":
-        batch_replacement(db_config, selected_env, operator)
+        batch_replacement(db_config, selected_env, operator, env_to_db)
     elif selection == "回退记录":
-        rollback_records(db_config, selected_env)
+        rollback_records(db_config, selected_env, operator, env_names)
+    elif selection == "修改历史":
+        change_history(db_config, selected_env)
+    elif selection == "后台任务":
+        jobs_page()
+
+    _render_pool_stats(db_config)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,168 @@
+"""
+Compare the row-by-row and the set-based batch replacement paths.
+
+Creates a scratch table on the target DB and a scratch detail-log table on
+the main DB of the chosen environment, runs both paths for each row count
+and checks that they produce the same detail rows and rowcounts.
+
+Usage:
+    python benchmarks/bench_batch_replacement.py --env dev --rows 1000,10000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import mysql.connector
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import masking_core as core  # noqa: E402
+
+BENCH_TABLE = "am_bench_target"
+BENCH_DETAIL_TABLE = "am_bench_log_detail"
+
+
+def _connect(db_cfg):
+    return mysql.connector.connect(
+        host=db_cfg.get("host"),
+        port=int(db_cfg.get("port")),
+        user=db_cfg.get("user"),
+        password=db_cfg.get("password"),
+        database=db_cfg.get("database"),
+    )
+
+
+def _reset_tables(conn_target, conn_main, rows):
+    cursor = conn_target.cursor()
+    cursor.execute(f"DROP TABLE IF EXISTS `{BENCH_TABLE}`")
+    cursor.execute(
+        f"CREATE TABLE `{BENCH_TABLE}` ("
+        "id VARCHAR(64) PRIMARY KEY, name VARCHAR(255))"
+    )
+    data = [(f"id{i}", f"name{i}") for i in range(rows)]
+    for start in range(0, rows, 5000):
+        cursor.executemany(
+            f"INSERT INTO `{BENCH_TABLE}` (id, name) VALUES (%s, %s)",
+            data[start : start + 5000],
+        )
+    conn_target.commit()
+    cursor.close()
+
+    cursor = conn_main.cursor()
+    cursor.execute(f"DROP TABLE IF EXISTS `{BENCH_DETAIL_TABLE}`")
+    cursor.execute(
+        f"CREATE TABLE `{BENCH_DETAIL_TABLE}` ("
+        "id BIGINT PRIMARY KEY AUTO_INCREMENT, batch_id VARCHAR(64), "
+        "row_id VARCHAR(128), old_name TEXT, new_name TEXT, updated_at DATETIME, "
+        "INDEX idx_batch_id (batch_id))"
+    )
+    conn_main.commit()
+    cursor.close()
+
+
+def _build_mapping(rows, name_every):
+    """
+    ID-keyed mapping for every row; every `name_every`-th row is keyed by
+    name instead (0 disables name keys).
+    """
+    mapping = []
+    for i in range(rows):
+        if name_every and i % name_every == 0:
+            mapping.append((i, "name", f"name{i}", f"masked{i}"))
+        else:
+            mapping.append((i, "id", f"id{i}", f"masked{i}"))
+    return mapping
+
+
+def _read_details(conn_main):
+    cursor = conn_main.cursor()
+    cursor.execute(
+        f"SELECT row_id, old_name, new_name FROM `{BENCH_DETAIL_TABLE}` "
+        "ORDER BY row_id, id"
+    )
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
+
+def _run(path, conn_target, conn_log, mapping, chunk_size):
+    idents = {
+        "table": BENCH_TABLE,
+        "column": "name",
+        "id_column": "id",
+        "log_detail_table": BENCH_DETAIL_TABLE,
+    }
+    batch_id = core.new_batch_id()
+    writer = core._DetailLogWriter(
+        conn_log,
+        BENCH_DETAIL_TABLE,
+        core.DEFAULT_LOG_FLUSH_ROWS,
+        core.DEFAULT_LOG_FLUSH_INTERVAL,
+    )
+    started = time.perf_counter()
+    try:
+        if path == "rowwise":
+            # Commit per row, like the original loop
+            counts = core._run_batch_rowwise(
+                conn_target, writer, idents, batch_id, mapping, commit_every=1
+            )
+        else:
+            counts = core._run_batch_bulk(
+                conn_target, writer, idents, batch_id, mapping, chunk_size
+            )
+    finally:
+        writer.close()
+    return counts, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--env", default="dev")
+    parser.add_argument("--rows", default="1000,10000")
+    parser.add_argument("--chunk-size", type=int, default=core.DEFAULT_CHUNK_SIZE)
+    parser.add_argument(
+        "--name-every",
+        type=int,
+        default=0,
+        help="key every N-th mapping row by name instead of ID",
+    )
+    args = parser.parse_args()
+
+    _env_names, env_to_db = core.load_config()
+    target_db, main_db = core.split_db_config(env_to_db[args.env])
+    conn_target = _connect(target_db)
+    conn_main = _connect(main_db)
+    conn_log = _connect(main_db)
+
+    print(f"{'rows':>10} {'path':>8} {'seconds':>10} {'rows/s':>10} {'logged':>10}")
+    try:
+        for rows in [int(r) for r in args.rows.split(",")]:
+            mapping = _build_mapping(rows, args.name_every)
+            results = {}
+            for path in ("rowwise", "bulk"):
+                _reset_tables(conn_target, conn_main, rows)
+                counts, seconds = _run(
+                    path, conn_target, conn_log, mapping, args.chunk_size
+                )
+                results[path] = (counts, _read_details(conn_main))
+                print(
+                    f"{rows:>10} {path:>8} {seconds:>10.2f} "
+                    f"{rows / seconds:>10.0f} {counts[0]:>10}"
+                )
+            if results["rowwise"] != results["bulk"]:
+                print(f"MISMATCH at {rows} rows: detail rows or rowcounts differ")
+                sys.exit(1)
+    finally:
+        for conn in (conn_target, conn_main):
+            cursor = conn.cursor()
+            table = BENCH_TABLE if conn is conn_target else BENCH_DETAIL_TABLE
+            cursor.execute(f"DROP TABLE IF EXISTS `{table}`")
+            conn.commit()
+            conn.close()
+        conn_log.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,726 @@
+"""
+Reproducible benchmark suite for the single, batch and rollback flows.
+
+For each table size it creates a synthetic target table and a matching
+mapping file, then runs the flows through masking_core exactly as the UI
+and CLI do, and records throughput, latency percentiles, round trips and
+peak memory. Results are written as JSON; pass an earlier result file as
+--baseline to flag throughput regressions.
+
+Backends:
+  - standin: in-process SQLite stand-in (benchmarks/standin.py), no server
+    needed; measures client-side cost and round trips.
+  - mysql: scratch tables in the databases of a config.toml environment,
+    e.g. a local MySQL/MariaDB container.
+
+Usage:
+    python benchmarks/bench_suite.py --sizes 10000,100000 --output new.json
+    python benchmarks/bench_suite.py --backend mysql --env bench \\
+        --sizes 10000,1000000 --name-ratio 0.2 --fanout 5 --baseline old.json
+"""
+
+import argparse
+import csv
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import mysql.connector
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import masking_core as core  # noqa: E402
+from standin import StandIn  # noqa: E402
+
+BENCH_TABLE = "am_bench_target"
+BENCH_LOG_TABLE = "am_bench_log"
+BENCH_DETAIL_TABLE = "am_bench_log_detail"
+BENCH_CHECKPOINT_TABLE = "am_bench_checkpoint"
+BENCH_CHUNK_TABLE = "am_bench_log_chunk"
+BENCH_CHUNK_KEY_TABLE = "am_bench_log_chunk_key"
+ID_COLUMN = "id"
+NAME_COLUMN = "name"
+# Rows per INSERT when filling the target table
+FILL_BATCH = 5000
+
+_DDL = {
+    "mysql": {
+        "target": [
+            f"CREATE TABLE `{BENCH_TABLE}` (`{ID_COLUMN}` VARCHAR(64) PRIMARY KEY, "
+            f"`{NAME_COLUMN}` VARCHAR(255), INDEX idx_name (`{NAME_COLUMN}`))",
+        ],
+        "main": [
+            f"CREATE TABLE `{BENCH_LOG_TABLE}` (id BIGINT PRIMARY KEY AUTO_INCREMENT, "
+            "batch_id VARCHAR(64) UNIQUE, env_name VARCHAR(64), operator VARCHAR(64), "
+            "mode VARCHAR(16), created_at DATETIME, total_rows INT, "
+            "status VARCHAR(16), stats TEXT)",
+            f"CREATE TABLE `{BENCH_DETAIL_TABLE}` ("
+            "id BIGINT PRIMARY KEY AUTO_INCREMENT, batch_id VARCHAR(64), "
+            "row_id VARCHAR(128), old_name TEXT, new_name TEXT, updated_at DATETIME, "
+            "INDEX idx_batch_id (batch_id, id), INDEX idx_batch_row (batch_id, row_id), "
+            "INDEX idx_row_id (row_id, id), INDEX idx_old_name (old_name(64), id), "
+            "INDEX idx_new_name (new_name(64), id))",
+            f"CREATE TABLE `{BENCH_CHECKPOINT_TABLE}` (batch_id VARCHAR(64) NOT NULL, "
+            "action VARCHAR(32) NOT NULL, last_id BIGINT, processed_rows INT, "
+            "changed_rows INT, updated_at DATETIME, PRIMARY KEY (batch_id, action))",
+            f"CREATE TABLE `{BENCH_CHUNK_TABLE}` ("
+            "id BIGINT PRIMARY KEY AUTO_INCREMENT, batch_id VARCHAR(64) NOT NULL, "
+            "target VARCHAR(128), row_count INT NOT NULL, payload LONGBLOB NOT NULL, "
+            "updated_at DATETIME, INDEX idx_batch_id (batch_id, id))",
+            f"CREATE TABLE `{BENCH_CHUNK_KEY_TABLE}` (key_hash INT NOT NULL, "
+            "chunk_id BIGINT NOT NULL, PRIMARY KEY (key_hash, chunk_id))",
+        ],
+    },
+    "standin": {
+        "target": [
+            f"CREATE TABLE `{BENCH_TABLE}` (`{ID_COLUMN}` VARCHAR(64) PRIMARY KEY, "
+            f"`{NAME_COLUMN}` VARCHAR(255))",
+            f"CREATE INDEX idx_name ON `{BENCH_TABLE}` (`{NAME_COLUMN}`)",
+        ],
+        "main": [
+            f"CREATE TABLE `{BENCH_LOG_TABLE}` (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "batch_id VARCHAR(64) UNIQUE, env_name VARCHAR(64), operator VARCHAR(64), "
+            "mode VARCHAR(16), created_at DATETIME, total_rows INT, "
+            "status VARCHAR(16), stats TEXT)",
+            f"CREATE TABLE `{BENCH_DETAIL_TABLE}` ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, batch_id VARCHAR(64), "
+            "row_id VARCHAR(128), old_name TEXT, new_name TEXT, updated_at DATETIME)",
+            f"CREATE INDEX idx_batch_id ON `{BENCH_DETAIL_TABLE}` (batch_id, id)",
+            f"CREATE INDEX idx_batch_row ON `{BENCH_DETAIL_TABLE}` (batch_id, row_id)",
+            f"CREATE INDEX idx_row_id ON `{BENCH_DETAIL_TABLE}` (row_id, id)",
+            f"CREATE INDEX idx_old_name ON `{BENCH_DETAIL_TABLE}` (old_name, id)",
+            f"CREATE INDEX idx_new_name ON `{BENCH_DETAIL_TABLE}` (new_name, id)",
+            f"CREATE TABLE `{BENCH_CHECKPOINT_TABLE}` (batch_id VARCHAR(64) NOT NULL, "
+            "action VARCHAR(32) NOT NULL, last_id BIGINT, processed_rows INT, "
+            "changed_rows INT, updated_at DATETIME, PRIMARY KEY (batch_id, action))",
+            f"CREATE TABLE `{BENCH_CHUNK_TABLE}` ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, batch_id VARCHAR(64) NOT NULL, "
+            "target VARCHAR(128), row_count INT NOT NULL, payload BLOB NOT NULL, "
+            "updated_at DATETIME)",
+            f"CREATE INDEX idx_chunk_batch_id ON `{BENCH_CHUNK_TABLE}` (batch_id, id)",
+            f"CREATE TABLE `{BENCH_CHUNK_KEY_TABLE}` (key_hash INT NOT NULL, "
+            "chunk_id BIGINT NOT NULL, PRIMARY KEY (key_hash, chunk_id))",
+        ],
+    },
+}
+
+
+class _Recorder:
+    """
+    Round trips and statement latencies of every connection the pools open.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.round_trips = {}
+        self.statements = []
+
+    def count(self, database, trips, seconds=None):
+        self.round_trips[database] = self.round_trips.get(database, 0) + trips
+        if seconds is not None:
+            self.statements.append(seconds)
+
+
+class _CountingCursor:
+    def __init__(self, cursor, database, recorder):
+        self._cursor = cursor
+        self._database = database
+        self._recorder = recorder
+
+    def execute(self, sql, params=()):
+        started = time.perf_counter()
+        try:
+            return self._cursor.execute(sql, params)
+        finally:
+            self._recorder.count(
+                self._database, 1, time.perf_counter() - started
+            )
+
+    def executemany(self, sql, seq_params):
+        seq_params = list(seq_params)
+        started = time.perf_counter()
+        try:
+            return self._cursor.executemany(sql, seq_params)
+        finally:
+            # mysql.connector folds an INSERT ... VALUES executemany into one
+            # multi-row statement; anything else is one statement per row
+            trips = 1 if sql.lstrip().upper().startswith("INSERT") else len(seq_params)
+            self._recorder.count(
+                self._database, trips, time.perf_counter() - started
+            )
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+
+class _CountingConnection:
+    def __init__(self, conn, database, recorder):
+        self._conn = conn
+        self._database = database
+        self._recorder = recorder
+
+    def cursor(self, **kwargs):
+        return _CountingCursor(
+            self._conn.cursor(**kwargs), self._database, self._recorder
+        )
+
+    def commit(self):
+        self._recorder.count(self._database, 1)
+        self._conn.commit()
+
+    def rollback(self):
+        self._recorder.count(self._database, 1)
+        self._conn.rollback()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def _install(connect, recorder):
+    """
+    Route the connection pools of masking_core through `connect`, counting
+    round trips on the way.
+    """
+
+    def counting_connect(**kwargs):
+        return _CountingConnection(
+            connect(**kwargs), kwargs.get("database"), recorder
+        )
+
+    mysql.connector.connect = counting_connect
+
+
+def _execute_script(db_cfg, statements):
+    conn = core.get_connection(db_cfg)
+    cursor = conn.cursor()
+    try:
+        for statement in statements:
+            cursor.execute(statement)
+        conn.commit()
+    finally:
+        cursor.close()
+        core.release_connection(db_cfg, conn)
+
+
+def _reset_tables(backend, target_db, main_db, rows, fanout, name_index=True):
+    """
+    Recreate the scratch tables; the target table gets `rows` rows whose
+    names are shared by groups of `fanout` rows, and an index on the name
+    column unless name_index is false.
+    """
+    drops = {
+        "target": [BENCH_TABLE],
+        "main": [
+            BENCH_LOG_TABLE,
+            BENCH_DETAIL_TABLE,
+            BENCH_CHECKPOINT_TABLE,
+            BENCH_CHUNK_TABLE,
+            BENCH_CHUNK_KEY_TABLE,
+        ],
+    }
+    for side, db_cfg in (("target", target_db), ("main", main_db)):
+        _execute_script(
+            db_cfg,
+            [f"DROP TABLE IF EXISTS `{t}`" for t in drops[side]]
+            + [
+                (
+                    sql
+                    if name_index
+                    else sql.replace(f", INDEX idx_name (`{NAME_COLUMN}`)", "")
+                )
+                for sql in _DDL[backend][side]
+                if name_index or not sql.startswith("CREATE INDEX idx_name ")
+            ],
+        )
+
+    conn = core.get_connection(target_db)
+    cursor = conn.cursor()
+    try:
+        for start in range(0, rows, FILL_BATCH):
+            end = min(rows, start + FILL_BATCH)
+            placeholders = ", ".join(["(%s, %s)"] * (end - start))
+            params = []
+            for i in range(start, end):
+                params.extend((f"id{i}", f"name{i // fanout}"))
+            cursor.execute(
+                f"INSERT INTO `{BENCH_TABLE}` (`{ID_COLUMN}`, `{NAME_COLUMN}`) "
+                f"VALUES {placeholders}",
+                params,
+            )
+        conn.commit()
+    finally:
+        cursor.close()
+        core.release_connection(target_db, conn)
+
+
+def _build_mapping(rows, mapping_rows, name_ratio, fanout, rng):
+    """
+    Mapping rows as (id, old name, new name) sheet rows: round(mapping_rows *
+    name_ratio) distinct name groups keyed by name, the rest keyed by ID and
+    drawn from outside those groups, in shuffled order.
+    """
+    groups = -(-rows // fanout)
+    name_keyed = min(groups, round(mapping_rows * name_ratio))
+    chosen_groups = set(rng.sample(range(groups), name_keyed))
+    id_keyed = min(rows - name_keyed * fanout, mapping_rows - name_keyed)
+    chosen_ids = set()
+    while len(chosen_ids) < id_keyed:
+        i = rng.randrange(rows)
+        if i // fanout not in chosen_groups:
+            chosen_ids.add(i)
+    sheet = [(None, f"name{g}") for g in chosen_groups]
+    sheet += [(f"id{i}", None) for i in chosen_ids]
+    rng.shuffle(sheet)
+    return [(id_val, old, f"masked{n}") for n, (id_val, old) in enumerate(sheet)]
+
+
+def _write_mapping_file(path, sheet):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow([ID_COLUMN, "原客户名", "替换后客户名"])
+        for id_val, old_name, new_name in sheet:
+            writer.writerow([id_val or "", old_name or "", new_name])
+
+
+def _percentiles(samples):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+
+    def at(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+
+    return {"p50": at(0.5), "p95": at(0.95), "p99": at(0.99), "max": at(1.0)}
+
+
+def _measure(recorder, trace_memory, fn):
+    """
+    Run fn(latencies) and collect what the suite reports about it; fn appends
+    one latency per operation (a chunk, or a single replacement).
+    """
+    recorder.reset()
+    latencies = []
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        outcome = fn(latencies)
+    finally:
+        seconds = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        if trace_memory:
+            tracemalloc.stop()
+    return {
+        "outcome": outcome,
+        "seconds": round(seconds, 4),
+        "latency_ms": _percentiles(latencies),
+        "statement_latency_ms": _percentiles(recorder.statements),
+        "statements": len(recorder.statements),
+        "round_trips": dict(recorder.round_trips),
+        "peak_memory_mb": round(peak / 2**20, 2) if peak is not None else None,
+    }
+
+
+def _timed_progress(job, latencies):
+    """
+    Wrap job.report so that every progress callback (one per chunk) records
+    the time since the previous one.
+    """
+    report = job.report
+    last = [time.perf_counter()]
+
+    def timed(processed):
+        now = time.perf_counter()
+        latencies.append(now - last[0])
+        last[0] = now
+        report(processed)
+
+    job.report = timed
+
+
+def _run_batch(target_db, main_db, mapping_path, mapping_rows, args, rowwise):
+    def flow(latencies):
+        job = core.Job(core.new_batch_id(), "batch", "bench", "bench", mapping_rows)
+        _timed_progress(job, latencies)
+        with open(mapping_path, "rb") as upload:
+
+            def read_mapping():
+                return core.iter_mapping(
+                    core.iter_upload_chunks(upload, ID_COLUMN, args.chunk_size),
+                    ID_COLUMN,
+                )
+
+            core.execute_batch(
+                job,
+                target_db,
+                main_db,
+                core.prepared_source(read_mapping),
+                rowwise,
+                args.chunk_size,
+                args.workers,
+            )
+        return job.batch_id
+
+    return flow
+
+
+def _run_rollback(target_db, main_db, batch_id, args):
+    def flow(latencies):
+        batch = core.find_batch(main_db, batch_id)
+        job = core.Job(
+            core.new_batch_id(),
+            "rollback",
+            "bench",
+            "bench",
+            batch["total_rows"],
+            batch_id=batch_id,
+        )
+        _timed_progress(job, latencies)
+        core.execute_rollback(job, target_db, main_db, args.chunk_size)
+        return batch["total_rows"]
+
+    return flow
+
+
+def _run_single(target_db, main_db, rows, args, rng):
+    def flow(latencies):
+        groups = -(-rows // args.fanout)
+        for n in range(args.singles):
+            if rng.random() < args.name_ratio:
+                id_val, old_name = None, f"name{rng.randrange(groups)}"
+            else:
+                id_val, old_name = f"id{rng.randrange(rows)}", None
+            started = time.perf_counter()
+            core.execute_single(
+                target_db, main_db, "bench", "bench", id_val, old_name, f"single{n}"
+            )
+            latencies.append(time.perf_counter() - started)
+        return args.singles
+
+    return flow
+
+
+def _count_masked(target_db):
+    conn = core.get_connection(target_db)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            f"SELECT COUNT(*) FROM `{BENCH_TABLE}` WHERE `{NAME_COLUMN}` LIKE %s",
+            ("masked%",),
+        )
+        return cursor.fetchone()[0]
+    finally:
+        cursor.close()
+        core.release_connection(target_db, conn)
+
+
+def _log_bytes(main_db, batch_id):
+    """
+    Bytes of detail-log data a batch wrote, summed over the stored values
+    (row format) or the packed chunks and their key index rows (compact
+    format), without secondary indexes.
+    """
+    conn = core.get_connection(main_db)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "SELECT COALESCE(SUM(LENGTH(batch_id) + LENGTH(row_id) "
+            "+ COALESCE(LENGTH(old_name), 0) + LENGTH(new_name) + 8), 0) "
+            f"FROM `{BENCH_DETAIL_TABLE}` WHERE batch_id = %s",
+            (batch_id,),
+        )
+        rows = cursor.fetchone()[0]
+        cursor.execute(
+            "SELECT COALESCE(SUM(LENGTH(batch_id) + LENGTH(payload) + 16), 0) "
+            f"FROM `{BENCH_CHUNK_TABLE}` WHERE batch_id = %s",
+            (batch_id,),
+        )
+        chunks = cursor.fetchone()[0]
+        cursor.execute(
+            f"SELECT COUNT(*) * 12 FROM `{BENCH_CHUNK_KEY_TABLE}` AS k "
+            f"JOIN `{BENCH_CHUNK_TABLE}` AS c ON c.id = k.chunk_id "
+            "WHERE c.batch_id = %s",
+            (batch_id,),
+        )
+        return int(rows) + int(chunks) + int(cursor.fetchone()[0])
+    finally:
+        cursor.close()
+        core.release_connection(main_db, conn)
+
+
+def _db_configs(args, workdir):
+    tables = {
+        "table": BENCH_TABLE,
+        "column": NAME_COLUMN,
+        "id_column": ID_COLUMN,
+    }
+    logs = {
+        "log_table": BENCH_LOG_TABLE,
+        "log_detail_table": BENCH_DETAIL_TABLE,
+        "checkpoint_table": BENCH_CHECKPOINT_TABLE,
+    }
+    if args.backend == "standin":
+        base = {"host": "standin", "port": 0, "user": "bench", "password": ""}
+        pool = {"pool_size": max(5, args.workers + 2)}
+        target_db = dict(base, database="target", **tables, **pool)
+        main_db = dict(base, database="main", **logs, **pool)
+        return StandIn(workdir).connect, target_db, main_db
+    _env_names, env_to_db = core.load_config(args.config)
+    target_db, main_db = core.split_db_config(env_to_db[args.env])
+    return (
+        mysql.connector.connect,
+        dict(target_db, **tables),
+        dict(main_db, **logs),
+    )
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _result_key(result):
+    return tuple(
+        result.get(k, False)
+        for k in ("backend", "flow", "mode", "rows", "mapping_rows", "name_ratio",
+                  "fanout", "workers", "chunk_size", "adaptive", "compact_log")
+    )
+
+
+def _compare(results, baseline_path, tolerance, trace_memory):
+    """
+    Print the throughput change against a previous run; returns the number of
+    results slower than the baseline by more than `tolerance`.
+    """
+    with open(baseline_path, encoding="utf-8") as f:
+        previous = json.load(f)
+    if previous["meta"]["memory_traced"] != trace_memory:
+        print("warning: tracemalloc was on in only one of the runs; compare with care")
+    baseline = {_result_key(r): r for r in previous["results"]}
+    regressions = 0
+    for result in results:
+        old = baseline.get(_result_key(result))
+        if not old or not old["throughput"]:
+            continue
+        change = result["throughput"] / old["throughput"] - 1
+        flag = ""
+        if change < -tolerance:
+            regressions += 1
+            flag = "  REGRESSION"
+        print(
+            f"{result['flow']:>8} {result['mode']:>7} {result['rows']:>10} "
+            f"{old['throughput']:>12.0f} -> {result['throughput']:>12.0f} "
+            f"({change:+.1%}){flag}"
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--backend", choices=["standin", "mysql"], default="standin")
+    parser.add_argument("--config", default=core.CONFIG_PATH)
+    parser.add_argument("--env", default="dev", help="mysql backend only")
+    parser.add_argument("--sizes", default="10000,100000", help="target table rows")
+    parser.add_argument(
+        "--mapping-ratio",
+        type=float,
+        default=0.1,
+        help="mapping rows as a fraction of the table size",
+    )
+    parser.add_argument(
+        "--name-ratio", type=float, default=0.1, help="share of name-keyed rows"
+    )
+    parser.add_argument(
+        "--fanout", type=int, default=1, help="target rows sharing each name"
+    )
+    parser.add_argument("--chunk-size", type=int, default=core.DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="adaptive chunk sizing, starting from --chunk-size",
+    )
+    parser.add_argument(
+        "--modes",
+        default="bulk",
+        help="batch modes to run: bulk,bulk-scan,rowwise,rowwise-prepared",
+    )
+    parser.add_argument(
+        "--compact-log",
+        action="store_true",
+        help="write the detail log as compressed chunks (log_chunk_table)",
+    )
+    parser.add_argument(
+        "--unindexed-names",
+        action="store_true",
+        help="leave the target name column without an index",
+    )
+    parser.add_argument(
+        "--singles", type=int, default=100, help="single replacements per size"
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="skip tracemalloc (it slows Python code down noticeably)",
+    )
+    parser.add_argument("--output", default="bench-results.json")
+    parser.add_argument("--baseline", help="earlier result file to compare with")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="throughput drop that counts as a regression",
+    )
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="am-bench-")
+    recorder = _Recorder()
+    connect, target_db, main_db = _db_configs(args, workdir)
+    target_db["adaptive_chunks"] = args.adaptive
+    if args.compact_log:
+        main_db["log_chunk_table"] = BENCH_CHUNK_TABLE
+        main_db["log_chunk_key_table"] = BENCH_CHUNK_KEY_TABLE
+    _install(connect, recorder)
+    trace_memory = not args.no_memory
+
+    modes = args.modes.split(",")
+    results = []
+    try:
+        for rows in [int(r) for r in args.sizes.split(",")]:
+            rng = random.Random(args.seed)
+            mapping_rows = max(1, int(rows * args.mapping_ratio))
+            sheet = _build_mapping(
+                rows, mapping_rows, args.name_ratio, args.fanout, rng
+            )
+            mapping_path = os.path.join(workdir, f"mapping_{rows}.csv")
+            _write_mapping_file(mapping_path, sheet)
+
+            for mode in modes:
+                _reset_tables(
+                    args.backend,
+                    target_db,
+                    main_db,
+                    rows,
+                    args.fanout,
+                    name_index=not args.unindexed_names,
+                )
+                runs = []
+                batch = _measure(
+                    recorder,
+                    trace_memory,
+                    _run_batch(
+                        dict(
+                            target_db,
+                            prepared_statements=mode == "rowwise-prepared",
+                            name_scan=mode == "bulk-scan",
+                        ),
+                        main_db,
+                        mapping_path,
+                        len(sheet),
+                        args,
+                        mode.startswith("rowwise"),
+                    ),
+                )
+                log_bytes = _log_bytes(main_db, batch["outcome"])
+                runs.append(("batch", len(sheet), batch))
+                rollback = _measure(
+                    recorder,
+                    trace_memory,
+                    _run_rollback(target_db, main_db, batch["outcome"], args),
+                )
+                runs.append(("rollback", rollback["outcome"], rollback))
+                left = _count_masked(target_db)
+                if left:
+                    print(f"rollback left {left} masked rows at {rows} rows ({mode})")
+                if mode == modes[0] and args.singles:
+                    single = _measure(
+                        recorder,
+                        trace_memory,
+                        _run_single(target_db, main_db, rows, args, rng),
+                    )
+                    runs.append(("single", args.singles, single))
+
+                for flow, operations, measured in runs:
+                    measured.pop("outcome")
+                    result = {
+                        "backend": args.backend,
+                        "flow": flow,
+                        "mode": mode if flow != "single" else "single",
+                        "rows": rows,
+                        "mapping_rows": len(sheet),
+                        "name_ratio": args.name_ratio,
+                        "fanout": args.fanout,
+                        "workers": args.workers,
+                        "chunk_size": args.chunk_size,
+                        "adaptive": args.adaptive,
+                        "compact_log": args.compact_log,
+                        "operations": operations,
+                        "throughput": round(operations / measured["seconds"], 2),
+                        "verified": flow != "rollback" or left == 0,
+                        **measured,
+                    }
+                    if flow == "batch":
+                        result["log_bytes"] = log_bytes
+                    results.append(result)
+                    latency = result["latency_ms"] or {}
+                    print(
+                        f"{flow:>8} {result['mode']:>7} {rows:>10} "
+                        f"{operations:>9} ops {measured['seconds']:>9.2f}s "
+                        f"{result['throughput']:>11.0f} ops/s "
+                        f"p95 {latency.get('p95', 0):>9.2f}ms "
+                        f"trips {sum(measured['round_trips'].values()):>8} "
+                        f"mem {measured['peak_memory_mb'] or 0:>8.1f}MB"
+                        + (
+                            f" log {result['log_bytes'] / 2**20:>7.2f}MB"
+                            if flow == "batch"
+                            else ""
+                        )
+                    )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            "revision": _git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "memory_traced": trace_memory,
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"results written to {args.output}")
+
+    if args.baseline and _compare(
+        results, args.baseline, args.tolerance, trace_memory
+    ):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""
+In-process stand-in for MySQL, backed by SQLite, for benchmarks.
+
+Implements the part of the mysql.connector connection/cursor API that
+masking_core uses, and rewrites the few MySQL-only statement shapes it
+sends (temporary staging tables, UPDATE ... JOIN, ON DUPLICATE KEY UPDATE,
+information_schema lookups) into SQLite. It measures client-side cost and
+round trips without a server; absolute timings are not MySQL timings.
+
+Each database name maps to one SQLite file under the directory given to
+StandIn, opened in WAL mode so pooled connections and parallel shards can
+share it. SQLite allows one writer per file, so a connection takes the
+file's write lock at its first write and holds it until commit/rollback,
+much like row locks held to the end of a MySQL transaction.
+"""
+
+import os
+import re
+import sqlite3
+import threading
+
+import mysql.connector
+
+_CREATE_STAGE = re.compile(
+    r"CREATE TEMPORARY TABLE (`\w+`) \(seq INT NOT NULL PRIMARY KEY\) "
+    r"SELECT (.*?) FROM \(SELECT 1\) AS d LEFT JOIN .*",
+    re.S,
+)
+_UPDATE_JOIN = re.compile(
+    r"UPDATE (`\w+`) AS t JOIN (`\w+`) AS s ON (.*?) SET t\.(`\w+`) = (.*?) "
+    r"WHERE (.*)",
+    re.S,
+)
+_ON_DUPLICATE = re.compile(r"ON DUPLICATE KEY UPDATE (.*)", re.S)
+_VALUES_REF = re.compile(r"VALUES\((\w+)\)")
+
+
+def _translate(sql):
+    """
+    MySQL statement as sent by masking_core -> equivalent SQLite statement.
+    """
+    match = _CREATE_STAGE.match(sql)
+    if match:
+        columns = re.findall(r"AS (\w+)", match.group(2))
+        return (
+            f"CREATE TEMP TABLE {match.group(1)} "
+            f"(seq INTEGER PRIMARY KEY, {', '.join(columns)})"
+        )
+    match = _UPDATE_JOIN.match(sql)
+    if match:
+        table, stage, on, column, value, where = match.groups()
+        sql = (
+            f"UPDATE {table} AS t SET {column} = {value} "
+            f"FROM {stage} AS s WHERE {on} AND {where}"
+        )
+    sql = sql.replace("DROP TEMPORARY TABLE", "DROP TABLE")
+    if sql.startswith("EXPLAIN "):
+        sql = "EXPLAIN QUERY PLAN " + sql[len("EXPLAIN ") :]
+    sql = _ON_DUPLICATE.sub(
+        lambda m: "ON CONFLICT DO UPDATE SET " + _VALUES_REF.sub(r"excluded.\1", m[1]),
+        sql,
+    )
+    return sql.replace("%s", "?")
+
+
+class _Cursor:
+    def __init__(self, conn):
+        self._conn = conn
+        self._cursor = conn._db.cursor()
+        # Rows of an emulated information_schema query, else None
+        self._rows = None
+        self._description = None
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    @property
+    def description(self):
+        if self._rows is not None:
+            return self._description
+        return self._cursor.description
+
+    def execute(self, sql, params=()):
+        self._rows = None
+        if "information_schema" in sql:
+            self._information_schema(sql, params)
+            return
+        if not sql.lstrip().upper().startswith(("SELECT", "EXPLAIN")):
+            self._conn._begin_write()
+        try:
+            self._cursor.execute(_translate(sql), tuple(params or ()))
+        except sqlite3.OperationalError as e:
+            if "no such column" in str(e):
+                raise mysql.connector.errors.ProgrammingError(
+                    str(e), errno=1054
+                ) from e
+            raise
+
+    def executemany(self, sql, seq_params):
+        self._rows = None
+        self._conn._begin_write()
+        self._cursor.executemany(_translate(sql), [tuple(p) for p in seq_params])
+
+    def _information_schema(self, sql, params):
+        # Only the two lookups of masking_core.table_schema are supported
+        db = self._conn._db
+        table = params[0]
+        info = db.execute(f"PRAGMA table_info(`{table}`)").fetchall()
+        if "information_schema.COLUMNS" in sql:
+            self._description = [
+                ("COLUMN_NAME",),
+                ("COLUMN_TYPE",),
+                ("DATA_TYPE",),
+                ("IS_NULLABLE",),
+                ("COLLATION_NAME",),
+            ]
+            self._rows = [
+                (
+                    name,
+                    col_type.lower(),
+                    col_type.lower().split("(")[0],
+                    "NO" if notnull or pk else "YES",
+                    None,
+                )
+                for _cid, name, col_type, notnull, _default, pk in info
+            ]
+            return
+        self._description = [("INDEX_NAME",), ("NON_UNIQUE",), ("COLUMN_NAME",)]
+        primary = sorted((pk, name) for _cid, name, _t, _n, _d, pk in info if pk)
+        rows = [("PRIMARY", 0, name) for _pk, name in primary]
+        for _seq, index, unique, *_rest in db.execute(
+            f"PRAGMA index_list(`{table}`)"
+        ).fetchall():
+            if index.startswith("sqlite_autoindex"):
+                continue
+            for _seqno, _cid, name in db.execute(
+                f"PRAGMA index_info(`{index}`)"
+            ).fetchall():
+                rows.append((index, 0 if unique else 1, name))
+        self._rows = rows
+
+    def fetchall(self):
+        if self._rows is not None:
+            rows, self._rows = self._rows, []
+            return rows
+        return self._cursor.fetchall()
+
+    def fetchone(self):
+        if self._rows is not None:
+            return self._rows.pop(0) if self._rows else None
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size=1):
+        if self._rows is not None:
+            rows, self._rows = self._rows[:size], self._rows[size:]
+            return rows
+        return self._cursor.fetchmany(size)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        self._cursor.close()
+
+
+class _Connection:
+    def __init__(self, path, write_lock):
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._open = True
+        self._write_lock = write_lock
+        self._writing = False
+
+    def _begin_write(self):
+        if not self._writing:
+            self._write_lock.acquire()
+            self._writing = True
+
+    def _end_write(self):
+        if self._writing:
+            self._writing = False
+            self._write_lock.release()
+
+    def cursor(self, **_kwargs):
+        return _Cursor(self)
+
+    def commit(self):
+        try:
+            self._db.commit()
+        finally:
+            self._end_write()
+
+    def rollback(self):
+        try:
+            self._db.rollback()
+        finally:
+            self._end_write()
+
+    def ping(self, reconnect=False, attempts=1, delay=0):
+        if not self._open:
+            raise mysql.connector.errors.OperationalError("connection closed")
+
+    def is_connected(self):
+        return self._open
+
+    def close(self):
+        self._open = False
+        self._end_write()
+        self._db.close()
+
+
+class StandIn:
+    """
+    Factory with the signature of mysql.connector.connect; one SQLite file
+    per database name under `directory`.
+    """
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._write_locks = {}
+        self._lock = threading.Lock()
+
+    def connect(self, database=None, **_kwargs):
+        path = os.path.join(self._directory, f"{database}.sqlite3")
+        with self._lock:
+            write_lock = self._write_locks.setdefault(path, threading.Lock())
+        return _Connection(path, write_lock)
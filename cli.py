@@ -0,0 +1,515 @@
+"""
+Run Anti Masking jobs from a shell, without the web UI.
+
+Uses the same config.toml, logging and rollback as app.py; progress is
+printed to stdout while the job runs. Ctrl-C cancels the job between
+chunks, and a cancelled batch can be rolled back like any other.
+
+Usage:
+    python cli.py replace mapping.xlsx --env dev --operator alice
+    python cli.py replace mapping.csv --env dev --operator alice --dry-run
+    python cli.py replace mapping.csv --env dev --operator alice \
+        --resume 20240101120000-1a2b3c4d
+    python cli.py replace mapping.csv --env dev --also test --operator alice
+    python cli.py rollback 20240101120000-1a2b3c4d --env dev --operator alice
+    python cli.py export 20240101120000-1a2b3c4d --env dev -o details.xlsx
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from masking_core import (
+    CONFIG_PATH,
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_ENV_JOB_LIMIT,
+    DEFAULT_FANOUT_THRESHOLD,
+    EXPORT_FORMATS,
+    Job,
+    config_error,
+    estimate_impact,
+    execute_batch,
+    execute_rollback,
+    export_details,
+    fan_out_blocker,
+    fan_out_matrix,
+    find_batch,
+    get_connection,
+    get_job_runner,
+    iter_mapping,
+    iter_upload_chunks,
+    load_config,
+    new_batch_id,
+    overwrite_blocker,
+    plan_targets,
+    prepare_mapping,
+    prepared_source,
+    release_connection,
+    resume_blocker,
+    rollback_blocker,
+    safe_ident,
+    scan_upload,
+    schema_error,
+    split_db_config,
+    submit_fan_out,
+    table_schema,
+    target_label,
+)
+
+# Exit codes: job failed or was cancelled / bad arguments or config
+EXIT_JOB_FAILED = 1
+EXIT_USAGE = 2
+# Mapping findings listed individually; the rest are only counted
+MAX_LISTED = 20
+# Server health signals of the online mode (see masking_core._Throttle)
+HEALTH_SIGNAL_LABELS = {
+    "threads_running": "运行线程数",
+    "lock_waits": "行锁等待数",
+    "replica_lag": "复制延迟",
+}
+
+
+def _fail(message, code=EXIT_USAGE):
+    print(message, file=sys.stderr)
+    sys.exit(code)
+
+
+def _format_seconds(seconds):
+    if seconds is None:
+        return "-"
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}:{seconds:02d}"
+
+
+def _print_progress(job):
+    snap = job.snapshot()
+    done = f"{snap['processed']}"
+    if snap["total"]:
+        done += f"/{snap['total']} ({snap['processed'] / snap['total']:.1%})"
+    paused = ""
+    if job.stats is not None and job.stats.throttle:
+        over = job.stats.throttle.summary()["paused"]
+        if over:
+            paused = " 服务器负载过高，已暂停：" + "，".join(
+                f"{HEALTH_SIGNAL_LABELS.get(name, name)} {value}"
+                for name, value in over.items()
+            )
+    print(
+        f"[{job.kind} {job.batch_id}] {job.status} {done} "
+        f"{snap['rate']:.0f} 行/秒 已用 {_format_seconds(snap['elapsed'])} "
+        f"剩余 {_format_seconds(snap['eta'])}{paused}",
+        flush=True,
+    )
+
+
+def _print_stats(summary):
+    print(
+        f"SQL 语句 {summary['statements']}，往返 {summary['round_trips']}，"
+        f"提交 {summary['commits']}，数据库耗时 {summary['db_seconds']:.2f} 秒",
+        flush=True,
+    )
+    for phase, c in summary["phases"].items():
+        print(
+            f"  {phase:<16} 语句 {c['statements']:>8} 行 {c['rows']:>9} "
+            f"{c['seconds']:>9.3f} 秒 最大 {c['max_ms']:>8.1f} 毫秒",
+            flush=True,
+        )
+    for entry in summary["slow"]:
+        print(f"  慢语句 {entry['ms']:.0f} 毫秒 [{entry['phase']}] {entry['sql']}")
+    for name, c in summary["chunking"].items():
+        sizes = (
+            f"{c['initial']} -> {c['final']}（{c['smallest']}~{c['largest']}）"
+            if c["adaptive"]
+            else f"固定 {c['initial']}"
+        )
+        print(
+            f"  分块 {name}: {sizes}，锁等待退避 {c['lock_backoffs']}，"
+            f"事务过大拆分 {c['size_backoffs']}"
+        )
+    throttle = summary.get("throttle")
+    if throttle:
+        reasons = "，".join(
+            f"{HEALTH_SIGNAL_LABELS.get(name, name)} {count} 次"
+            for name, count in throttle["reasons"].items()
+        )
+        print(
+            f"  在线模式: 实际 {throttle['rows_per_sec']:.0f} 行/秒，"
+            f"限速等待 {throttle['throttled_seconds']:.1f} 秒，"
+            f"暂停 {throttle['pauses']} 次共 {throttle['paused_seconds']:.1f} 秒"
+            + (f"（{reasons}）" if reasons else "")
+        )
+        if throttle.get("unavailable"):
+            print(
+                "  服务器未提供"
+                + "、".join(
+                    HEALTH_SIGNAL_LABELS.get(name, name)
+                    for name in throttle["unavailable"]
+                )
+                + "，这些限制未生效"
+            )
+
+
+def _run_job(job, target_db, fn, *args, interval):
+    """
+    Run a job on the job runner and print its progress until it finishes.
+    """
+    get_job_runner().submit(
+        job,
+        int(target_db.get("max_concurrent_jobs", DEFAULT_ENV_JOB_LIMIT)),
+        fn,
+        *args,
+    )
+    last_print = 0.0
+    while job.active:
+        try:
+            time.sleep(0.2)
+        except KeyboardInterrupt:
+            if job.cancel_requested:
+                raise
+            print("正在取消，等待当前分块完成...", flush=True)
+            job.cancel()
+        if job.active and time.monotonic() - last_print >= interval:
+            _print_progress(job)
+            last_print = time.monotonic()
+    _print_progress(job)
+    if job.stats is not None:
+        _print_stats(job.stats.summary())
+    if job.status != "done":
+        _fail(job.message or job.status, EXIT_JOB_FAILED)
+    print(job.message, flush=True)
+
+
+def _run_fan_out(jobs, interval):
+    """
+    Print the combined progress of fan-out jobs until all of them finish,
+    then one line per environment.
+    """
+    last_print = 0.0
+    while any(job.active for job in jobs):
+        try:
+            time.sleep(0.2)
+        except KeyboardInterrupt:
+            if any(job.cancel_requested for job in jobs):
+                raise
+            print("正在取消所有环境的任务，等待当前分块完成...", flush=True)
+            for job in jobs:
+                job.cancel()
+        if time.monotonic() - last_print >= interval:
+            _rows, totals = fan_out_matrix(jobs)
+            done = f"{totals['processed']}/{totals['total']}"
+            statuses = " ".join(f"{s} {n}" for s, n in totals["statuses"].items())
+            print(f"[fan-out] {done} {statuses}", flush=True)
+            last_print = time.monotonic()
+    rows, _totals = fan_out_matrix(jobs)
+    for row in rows:
+        replaced = "-" if row["replaced"] is None else row["replaced"]
+        print(
+            f"  {row['env_name']:<12} {row['batch_id']} {row['status']:<10} "
+            f"{row['processed']}/{row['total']} 替换 {replaced} "
+            f"已用 {_format_seconds(row['elapsed'])} {row['message'] or ''}",
+            flush=True,
+        )
+    failed = [row["env_name"] for row in rows if row["status"] != "done"]
+    if failed:
+        _fail(f"未完成的环境: {', '.join(failed)}", EXIT_JOB_FAILED)
+
+
+def _env_config(args, checks=None):
+    """
+    The environment's config; exits on config errors among `checks` (see
+    config_error), or on any error including the target table's schema.
+    """
+    try:
+        _env_names, env_to_db = load_config(args.config)
+    except FileNotFoundError:
+        _fail(f"配置文件 `{args.config}` 未找到。")
+    if args.env not in env_to_db:
+        _fail(f"未在配置文件中找到环境 `{args.env}`。")
+    env_db_config = env_to_db[args.env]
+    if checks:
+        error = config_error(env_db_config, checks)
+    else:
+        error = config_error(env_db_config) or schema_error(
+            split_db_config(env_db_config)[0]
+        )
+    if error:
+        _fail(error)
+    return env_db_config
+
+
+def _print_impact(report):
+    print(
+        f"有效映射行 {report['rows']}，匹配到记录的键 "
+        f"{report['matched_keys']}/{report['distinct_keys']}，"
+        f"将更新 {report['matched_rows']} 条记录，"
+        f"预计写入 {report['estimated_log_rows']} 条日志明细。"
+    )
+    for path, kind, _plan, full_scan in report["explains"]:
+        if full_scan:
+            print(f"警告：{path}（{kind}）的执行计划将对目标表进行全表扫描。")
+    for name in report["unindexed"]:
+        print(f"警告：目标表的 `{name}` 列上没有索引。")
+    if report["fanout"]:
+        print(
+            f"匹配超过 {report['fanout_threshold']} 条记录的键: {len(report['fanout'])}"
+        )
+    print(f"预估耗时 {report['elapsed']:.2f} 秒。")
+
+
+def _print_check(check):
+    print(
+        f"预处理后实际执行 {check['final_rows']} 行"
+        f"（重复 {len(check['duplicates'])} 组，冲突的键 {len(check['conflicts'])}，"
+        f"链式映射 {len(check['chains'])}，无变化 {check['noops']}）。",
+        flush=True,
+    )
+    for key, new_name, final in check["chains"][:MAX_LISTED]:
+        print(f"  链式: {key} -> {new_name} -> {final}")
+    for kind, key, names in check["conflicts"][:MAX_LISTED]:
+        print(
+            f"  冲突: [{kind}] {key} -> {' / '.join(map(str, names))}"
+            f"（以{'最后' if kind == 'id' else '第一'}一行为准）"
+        )
+    for key, new_name in check["cycles"][:MAX_LISTED]:
+        print(f"  循环: {key} -> {new_name}")
+    for key, names in check["reentered"][:MAX_LISTED]:
+        print(f"  重新出现: {key} -> {' / '.join(map(str, names))}")
+
+
+def _replace(args):
+    if args.also and (args.dry_run or args.resume):
+        _fail("--also 不能与 --dry-run 或 --resume 同时使用。")
+    env_db_config = _env_config(args)
+    if args.also:
+        env_names = list(dict.fromkeys([args.env, *args.also]))
+        env_to_db = load_config(args.config)[1]
+        error = fan_out_blocker(env_to_db, env_names)
+        if error:
+            _fail(error)
+    target_db, main_db = split_db_config(env_db_config)
+    id_column_name = target_db.get("id_column", "ID")
+    chunk_size = args.chunk_size or int(target_db.get("chunk_size", DEFAULT_CHUNK_SIZE))
+
+    with open(args.mapping_file, "rb") as upload:
+        summary = scan_upload(upload, id_column_name, chunk_size)
+        columns = summary["columns"]
+        if (
+            id_column_name not in columns and "原客户名" not in columns
+        ) or "替换后客户名" not in columns:
+            _fail(
+                f"映射文件必须包含 '{id_column_name}' 或 '原客户名' 列，以及 '替换后客户名' 列。"
+            )
+        print(
+            f"共 {summary['total']} 行，有效 {summary['valid']} 行"
+            f"（按ID {summary['id_keyed']}，按原客户名 {summary['name_keyed']}），"
+            f"无效 {summary['skipped']} 行。",
+            flush=True,
+        )
+        if not summary["valid"]:
+            _fail("映射文件中没有有效行。")
+        check = summary["check"]
+        _print_check(check)
+        if check["cycles"]:
+            _fail(f"映射中有 {len(check['cycles'])} 行构成循环，请修改后再执行。")
+        if check["reentered"]:
+            _fail(
+                f"映射中有 {len(check['reentered'])} 个原客户名在其他行改成它之后再次出现，"
+                "请修改后再执行。"
+            )
+
+        def read_mapping():
+            return iter_mapping(
+                iter_upload_chunks(upload, id_column_name, chunk_size), id_column_name
+            )
+
+        if args.dry_run:
+            plan = prepare_mapping(read_mapping())
+            targets = plan_targets(target_db)
+            conn_target = get_connection(target_db)
+            try:
+                for target in targets:
+                    report = estimate_impact(
+                        conn_target,
+                        {
+                            "table": safe_ident(target.get("table")),
+                            "column": safe_ident(target.get("column")),
+                            "id_column": safe_ident(target.get("id_column")),
+                        },
+                        plan,
+                        chunk_size,
+                        int(
+                            target_db.get("fanout_threshold", DEFAULT_FANOUT_THRESHOLD)
+                        ),
+                        table_schema(target),
+                    )
+                    if len(targets) > 1:
+                        print(f"[{target_label(target)}]")
+                    _print_impact(report)
+            finally:
+                release_connection(target_db, conn_target)
+            return
+
+        if args.resume:
+            batch = find_batch(main_db, args.resume)
+            if batch is None:
+                _fail(f"未找到批次 `{args.resume}`。")
+            blocker = resume_blocker(batch, args.env, main_db)
+            if blocker:
+                _fail(blocker)
+
+        if args.also:
+            jobs = submit_fan_out(
+                env_to_db,
+                env_names,
+                args.operator,
+                check["final_rows"],
+                prepared_source(read_mapping),
+                args.rowwise,
+                args.chunk_size,
+                args.workers,
+            )
+            for job in jobs:
+                print(f"[{job.env_name}] 批次号: {job.batch_id}", flush=True)
+            _run_fan_out(jobs, args.interval)
+            return
+
+        workers = args.workers or int(target_db.get("parallel_workers", 1))
+        job = Job(
+            new_batch_id(),
+            "batch",
+            args.env,
+            args.operator,
+            check["final_rows"],
+            batch_id=args.resume,
+        )
+        print(f"批次号: {job.batch_id}", flush=True)
+        _run_job(
+            job,
+            target_db,
+            execute_batch,
+            target_db,
+            main_db,
+            prepared_source(read_mapping),
+            args.rowwise,
+            chunk_size,
+            workers,
+            bool(args.resume),
+            interval=args.interval,
+        )
+
+
+def _rollback(args):
+    env_db_config = _env_config(args)
+    target_db, main_db = split_db_config(env_db_config)
+    chunk_size = args.chunk_size or int(target_db.get("chunk_size", DEFAULT_CHUNK_SIZE))
+
+    batch = find_batch(main_db, args.batch_id)
+    if batch is None:
+        _fail(f"未找到批次 `{args.batch_id}`。")
+    blocker = rollback_blocker(batch, args.env) or overwrite_blocker(
+        main_db, args.batch_id, args.env, len(plan_targets(target_db)) > 1
+    )
+    if blocker:
+        _fail(blocker)
+
+    job = Job(
+        new_batch_id(),
+        "rollback",
+        args.env,
+        args.operator,
+        int(batch["total_rows"]),
+        batch_id=args.batch_id,
+    )
+    _run_job(
+        job,
+        target_db,
+        execute_rollback,
+        target_db,
+        main_db,
+        chunk_size,
+        interval=args.interval,
+    )
+
+
+def _export(args):
+    env_db_config = _env_config(args, ("main", "log"))
+    target_db, main_db = split_db_config(env_db_config)
+    fmt = os.path.splitext(args.output)[1].lstrip(".").lower()
+    if fmt not in EXPORT_FORMATS:
+        _fail(f"导出文件的扩展名须为 {' 或 '.join(EXPORT_FORMATS)}。")
+    if find_batch(main_db, args.batch_id) is None:
+        _fail(f"未找到批次 `{args.batch_id}`。")
+    with open(args.output, "wb") as out:
+        count = export_details(
+            main_db, args.batch_id, out, fmt, len(plan_targets(target_db)) > 1
+        )
+    print(f"已导出 {count} 条明细到 {args.output}。", flush=True)
+
+
+def _parse_args(argv):
+    env_args = argparse.ArgumentParser(add_help=False)
+    env_args.add_argument("--config", default=CONFIG_PATH)
+    env_args.add_argument("--env", required=True, help="environment in config.toml")
+    common = argparse.ArgumentParser(add_help=False, parents=[env_args])
+    common.add_argument("--operator", required=True)
+    common.add_argument(
+        "--chunk-size", type=int, help="default: chunk_size of the environment"
+    )
+    common.add_argument(
+        "--interval", type=float, default=2.0, help="seconds between progress lines"
+    )
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    replace = commands.add_parser(
+        "replace", parents=[common], help="batch replacement from a mapping file"
+    )
+    replace.add_argument("mapping_file", help="xlsx, csv or tsv, same as the UI")
+    replace.add_argument("--rowwise", action="store_true", help="row-by-row mode")
+    replace.add_argument(
+        "--workers", type=int, help="default: parallel_workers of the environment"
+    )
+    replace.add_argument(
+        "--dry-run", action="store_true", help="only estimate the impact"
+    )
+    replace.add_argument(
+        "--resume",
+        metavar="BATCH_ID",
+        help="continue an interrupted batch, given its original mapping file",
+    )
+    replace.add_argument(
+        "--also",
+        action="append",
+        metavar="ENV",
+        help="run the same mapping in this environment too (repeatable)",
+    )
+    replace.set_defaults(func=_replace)
+
+    rollback = commands.add_parser(
+        "rollback", parents=[common], help="roll back a batch"
+    )
+    rollback.add_argument("batch_id")
+    rollback.set_defaults(func=_rollback)
+
+    export = commands.add_parser(
+        "export", parents=[env_args], help="export a batch's detail log"
+    )
+    export.add_argument("batch_id")
+    export.add_argument(
+        "-o", "--output", required=True, help="file to write, .xlsx or .csv"
+    )
+    export.set_defaults(func=_export)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    if "operator" in args and not args.operator.strip():
+        _fail("操作人不能为空。")
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
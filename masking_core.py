@@ -0,0 +1,4723 @@
+"""
+Replacement, rollback and logging logic of Anti Masking, without Streamlit.
+
+app.py builds the web UI on top of this module; cli.py runs the same jobs
+from a shell.
+"""
+
+import mysql.connector
+import numpy as np
+import openpyxl
+import toml
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import tenacity
+import io
+import bisect
+import collections
+import contextlib
+import csv
+import itertools
+import datetime
+import hashlib
+import json
+import logging
+import os
+import queue
+import secrets
+import shutil
+import tempfile
+import threading
+import time
+import unicodedata
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Mapping rows per set-based statement; override with `chunk_size` in config.toml
+DEFAULT_CHUNK_SIZE = 1000
+# Detail-log writer: rows per multi-row INSERT, max seconds rows stay
+# buffered, and pending batches before put() blocks
+DEFAULT_LOG_FLUSH_ROWS = 5000
+DEFAULT_LOG_FLUSH_INTERVAL = 1.0
+DEFAULT_LOG_QUEUE_SIZE = 4
+# Compact detail log (`log_chunk_table`): codec of the packed chunks,
+# chunks read per query when searching the chunks of many batches, and rows
+# per INSERT into its key index (`log_chunk_key_table`)
+CHUNK_COMPRESSION = "zstd"
+CHUNK_SCAN_PAGE = 20
+CHUNK_KEY_INSERT_ROWS = 5000
+# Dry run: report keys matching more target rows than this
+DEFAULT_FANOUT_THRESHOLD = 100
+# Rows per fetchmany() when streaming a result set (snapshots of matched rows)
+STREAM_FETCH_ROWS = 1000
+# Deadlock / lock wait timeout: retry the chunk's write this many times
+LOCK_RETRY_ERRNOS = (1205, 1213)
+LOCK_RETRY_ATTEMPTS = 5
+# Transaction too large for the server: binlog cache full, lock table full,
+# OceanBase timeout / tenant memory exhausted; the chunk is split and redone
+TXN_SIZE_ERRNOS = (1197, 1206, 4012, 4030)
+# Adaptive chunk sizing (`adaptive_chunks`): size bounds and the longest a
+# chunk's transaction should take
+DEFAULT_CHUNK_SIZE_MIN = 100
+DEFAULT_CHUNK_SIZE_MAX = 20000
+DEFAULT_CHUNK_TARGET_MS = 2000
+# Target rows read per keyset page when name keys are matched by scanning the
+# table (`name_scan`); override with `name_scan_rows`
+DEFAULT_NAME_SCAN_ROWS = 10000
+# Online mode: seconds between server health checks, the burst a rate budget
+# allows, and the lowest share of the budget it slows down to after a pause
+DEFAULT_ONLINE_CHECK_INTERVAL = 5
+THROTTLE_BURST_SECONDS = 1.0
+THROTTLE_MIN_FACTOR = 0.125
+# Adaptive chunk sizing compares throughput over windows of this many chunks,
+# and holds for this many windows after stepping back
+SIZER_WINDOW_CHUNKS = 3
+SIZER_SETTLE_WINDOWS = 3
+CONFIG_PATH = "config.toml"
+# Connection pool defaults; override per database section in config.toml
+DEFAULT_POOL_SIZE = 5
+DEFAULT_POOL_IDLE_TIMEOUT = 300
+DEFAULT_POOL_WAIT_TIMEOUT = 30
+# Upload formats: extension -> field separator (None for xlsx)
+UPLOAD_FORMATS = {"xlsx": None, "csv": ",", "tsv": "\t"}
+MAX_SKIPPED_EXAMPLES = 100
+# Mapping rows hashed per digest update when fingerprinting a batch
+FINGERPRINT_ROWS = 10000
+# Background jobs: running jobs per process (override with [jobs] workers in
+# config.toml) and per environment (`max_concurrent_jobs`)
+DEFAULT_JOB_WORKERS = 4
+DEFAULT_ENV_JOB_LIMIT = 1
+# Finished jobs kept in memory for the job page
+MAX_FINISHED_JOBS = 100
+# Instrumentation: statements slower than this (override with
+# `slow_statement_ms` in config.toml) go to the slow-statement log; the
+# slowest MAX_SLOW_STATEMENTS are kept with the run's stats
+DEFAULT_SLOW_STATEMENT_MS = 1000
+MAX_SLOW_STATEMENTS = 20
+# Upper bounds (ms) of the latency histogram buckets; the last one is open
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+# What a replacement target (an entry of `targets`) names
+TARGET_KEYS = ("table", "column", "id_column")
+# MySQL "unknown column": the optional `stats` column of the log table is missing
+ER_BAD_FIELD_ERROR = 1054
+# Change-history lookups: rows returned per search, later batches listed
+MAX_LOOKUP_ROWS = 200
+MAX_LATER_BATCHES = 20
+# Detail-log export: formats, rows read per page, data rows per xlsx sheet
+EXPORT_FORMATS = ("xlsx", "csv")
+EXPORT_PAGE_ROWS = 5000
+XLSX_SHEET_ROWS = 1048575
+
+slow_log = logging.getLogger("anti_masking.slow")
+online_log = logging.getLogger("anti_masking.online")
+
+
+def safe_ident(name):
+    """
+    Basic safeguard to avoid backticks in identifiers.
+    """
+    if not name:
+        return ""
+    return name.replace("`", "")
+
+
+def _now_str():
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def new_batch_id():
+    ts = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+    return f"{ts}-{secrets.token_hex(4)}"
+
+
+def _insert_batch_log(
+    cursor, log_table, batch_id, env_name, operator, mode, status="failed"
+):
+    query = (
+        f"INSERT INTO `{log_table}` "
+        "(batch_id, env_name, operator, mode, created_at, total_rows, status) "
+        "VALUES (%s, %s, %s, %s, %s, %s, %s)"
+    )
+    cursor.execute(
+        query, (batch_id, env_name, operator, mode, _now_str(), 0, status)
+    )
+
+
+def _update_batch_log(cursor, log_table, batch_id, total_rows, status):
+    query = (
+        f"UPDATE `{log_table}` SET total_rows = %s, status = %s WHERE batch_id = %s"
+    )
+    cursor.execute(query, (total_rows, status, batch_id))
+
+
+def _detail_columns(target):
+    """
+    Column list of detail-log INSERTs; rows of a multi-target plan also name
+    their target (see target_label).
+    """
+    columns = "batch_id, row_id, old_name, new_name, updated_at"
+    return f"{columns}, target" if target else columns
+
+
+def _pack_details(details):
+    """
+    Detail rows (batch_id, row_id, old_name, new_name, updated_at) of one
+    batch as a compressed Arrow IPC stream. new_name and updated_at are
+    dictionary-encoded, so a new name or timestamp shared by many rows is
+    stored once per chunk; the batch id is kept on the chunk's row instead.
+    """
+    _batch_ids, row_ids, old_names, new_names, times = zip(*details)
+    table = pa.table(
+        {
+            "row_id": pa.array(row_ids, pa.string()),
+            "old_name": pa.array(old_names, pa.string()),
+            "new_name": pa.array(new_names, pa.string()).dictionary_encode(),
+            "updated_at": pa.array(times, pa.string()).dictionary_encode(),
+        }
+    )
+    sink = pa.BufferOutputStream()
+    options = pa.ipc.IpcWriteOptions(compression=CHUNK_COMPRESSION)
+    with pa.ipc.new_stream(sink, table.schema, options=options) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def _read_chunk(payload):
+    return pa.ipc.open_stream(payload).read_all()
+
+
+def _chunk_tuples(table, columns):
+    """
+    Rows of an unpacked chunk as tuples of `columns`, in log order;
+    updated_at is parsed back to a datetime, as read from a DATETIME column.
+    """
+    values = []
+    for name in columns:
+        column = table.column(name).to_pylist()
+        if name == "updated_at":
+            parsed = {
+                t: datetime.datetime.strptime(t, "%Y-%m-%d %H:%M:%S")
+                for t in set(column)
+            }
+            column = [parsed[t] for t in column]
+        values.append(column)
+    return list(zip(*values))
+
+
+def _chunk_key_hash(kind, value):
+    """
+    Key of the compact log's key index: a 32-bit hash of a record id (kind
+    "r") or of a name (kind "n", old or new). Two keys may share a hash; a
+    lookup then reads a chunk without a match, and filters it out.
+    """
+    digest = hashlib.blake2b(f"{kind}:{value}".encode(), digest_size=4).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def _insert_detail_chunk(cursor, chunk_table, details, target=None, key_table=None):
+    """
+    Write detail rows of one batch as a single row of the compact detail log:
+    the rows packed by _pack_details, with their count and latest timestamp.
+    With key_table set, the chunk's distinct record ids and names are also
+    indexed there as (key_hash, chunk_id) rows (see _chunk_key_hash).
+    """
+    cursor.execute(
+        f"INSERT INTO `{chunk_table}` "
+        "(batch_id, target, row_count, payload, updated_at) "
+        "VALUES (%s, %s, %s, %s, %s)",
+        (details[0][0], target, len(details), _pack_details(details), details[-1][4]),
+    )
+    if not key_table:
+        return
+    chunk_id = cursor.lastrowid
+    keys = set()
+    for _batch_id, row_id, old_name, new_name, _updated_at in details:
+        keys.add(_chunk_key_hash("r", row_id))
+        if old_name is not None:
+            keys.add(_chunk_key_hash("n", old_name))
+        keys.add(_chunk_key_hash("n", new_name))
+    keys = sorted(keys)
+    for start in range(0, len(keys), CHUNK_KEY_INSERT_ROWS):
+        part = keys[start : start + CHUNK_KEY_INSERT_ROWS]
+        cursor.execute(
+            f"INSERT INTO `{key_table}` (key_hash, chunk_id) "
+            f"VALUES {', '.join(['(%s, %s)'] * len(part))}",
+            tuple(v for key in part for v in (key, chunk_id)),
+        )
+
+
+def _insert_detail_logs(
+    cursor,
+    log_detail_table,
+    batch_id,
+    details,
+    target=None,
+    chunk_table=None,
+    chunk_key_table=None,
+):
+    """
+    Insert detail rows (batch_id, row_id, old_name, new_name, updated_at);
+    with chunk_table set they go to the compact detail log instead (indexed
+    in chunk_key_table).
+    """
+    if not details:
+        return
+    if chunk_table:
+        _insert_detail_chunk(cursor, chunk_table, details, target, chunk_key_table)
+        return
+    placeholders = ", ".join(["%s"] * (6 if target else 5))
+    query = (
+        f"INSERT INTO `{log_detail_table}` ({_detail_columns(target)}) "
+        f"VALUES ({placeholders})"
+    )
+    if target:
+        details = [(*detail, target) for detail in details]
+    cursor.executemany(query, details)
+
+
+def _upsert_row_state(cursor, row_state_table, details, target=None):
+    """
+    Record detail rows (batch_id, row_id, old_name, new_name, updated_at) as
+    the latest state of their records in the optional row-state table; later
+    rows of the same record win. `target` as in _insert_detail_logs.
+    """
+    if not row_state_table or not details:
+        return
+    label = target or ""
+    cursor.execute(
+        f"INSERT INTO `{row_state_table}` "
+        "(row_id, target, current_name, batch_id, updated_at) "
+        f"VALUES {', '.join(['(%s, %s, %s, %s, %s)'] * len(details))} "
+        "ON DUPLICATE KEY UPDATE current_name = VALUES(current_name), "
+        "batch_id = VALUES(batch_id), updated_at = VALUES(updated_at)",
+        tuple(
+            v
+            for batch_id, row_id, _old_name, new_name, updated_at in details
+            for v in (row_id, label, new_name, batch_id, updated_at)
+        ),
+    )
+
+
+def _count_detail_logs(cursor, log_detail_table, batch_id, chunk_table=None):
+    cursor.execute(
+        f"SELECT COUNT(*) FROM `{log_detail_table}` WHERE batch_id = %s", (batch_id,)
+    )
+    count = cursor.fetchone()[0]
+    if chunk_table:
+        cursor.execute(
+            f"SELECT COALESCE(SUM(row_count), 0) FROM `{chunk_table}` "
+            "WHERE batch_id = %s",
+            (batch_id,),
+        )
+        count += int(cursor.fetchone()[0])
+    return count
+
+
+def _has_chunks(cursor, chunk_table, batch_id):
+    """
+    Whether batch_id was logged to the compact detail log `chunk_table`.
+    """
+    if not chunk_table:
+        return False
+    cursor.execute(
+        f"SELECT id FROM `{chunk_table}` WHERE batch_id = %s LIMIT 1", (batch_id,)
+    )
+    return bool(cursor.fetchall())
+
+
+def _detail_chunks(
+    cursor, chunk_table, batch_id, columns, from_id=None, descending=False, target=None
+):
+    """
+    A batch's compact detail chunks as (chunk id, target, rows), the rows
+    unpacked to tuples of `columns` in log order: oldest chunk first after
+    chunk id from_id, or newest first below it with descending. `target`
+    keeps the chunks of one target of a multi-target plan. One chunk is read
+    per query, so the cursor's connection is free between chunks.
+    """
+    order, compare = ("DESC", "<") if descending else ("", ">")
+    target_clause = "AND target = %s " if target else ""
+    extra = (target,) if target else ()
+    while True:
+        if from_id is None:
+            cursor.execute(
+                f"SELECT id, target, payload FROM `{chunk_table}` "
+                f"WHERE batch_id = %s {target_clause}ORDER BY id {order} LIMIT 1",
+                (batch_id, *extra),
+            )
+        else:
+            cursor.execute(
+                f"SELECT id, target, payload FROM `{chunk_table}` "
+                f"WHERE batch_id = %s {target_clause}AND id {compare} %s "
+                f"ORDER BY id {order} LIMIT 1",
+                (batch_id, *extra, from_id),
+            )
+        rows = cursor.fetchall()
+        if not rows:
+            return
+        from_id, label, payload = rows[0]
+        yield from_id, label, _chunk_tuples(_read_chunk(payload), columns)
+
+
+def _save_run_stats(cursor, log_table, batch_id, stats):
+    """
+    Store a run's stats summary as JSON in the optional `stats` column of the
+    log table; a log table without that column is left alone.
+    """
+    try:
+        cursor.execute(
+            f"UPDATE `{log_table}` SET stats = %s WHERE batch_id = %s",
+            (json.dumps(stats.summary(), ensure_ascii=False), batch_id),
+        )
+    except mysql.connector.Error as e:
+        if e.errno != ER_BAD_FIELD_ERROR:
+            raise
+
+
+def require_log_config(db_config):
+    return db_config.get("log_table"), db_config.get("log_detail_table")
+
+
+def _validate_env(env_db_config):
+    """
+    Check an environment's settings once, when config.toml is (re)loaded.
+    Returns {check: error message} for the checks that failed.
+    """
+    target_db, main_db = split_db_config(env_db_config)
+    targets = plan_targets(target_db)
+    errors = {}
+    if not all(
+        target_db.get(k) for k in ("host", "port", "user", "database")
+    ) or not all(t.get(k) for t in targets for k in ("table", "column")):
+        errors["target"] = "请在 `config.toml` 中填写目标库的完整信息。"
+    if not all(t.get("id_column") for t in targets):
+        errors["id_column"] = "请在 `config.toml` 中配置目标库的 `id_column`。"
+    elif len({target_label(t) for t in targets}) < len(targets):
+        errors["target"] = "`targets` 中有重复的表和列。"
+    if not all(main_db.get(k) for k in ("host", "port", "user", "database")):
+        errors["main"] = "请在 `config.toml` 中填写主库的完整信息。"
+    if not all(require_log_config(main_db)):
+        errors["log"] = (
+            "请在 `config.toml` 中配置主库日志表 `log_table` 和 `log_detail_table`。"
+        )
+    elif main_db.get("log_chunk_table") and not main_db.get("log_chunk_key_table"):
+        errors["log"] = (
+            "配置 `log_chunk_table` 时还需配置紧凑明细的记录索引表 "
+            "`log_chunk_key_table`。"
+        )
+    return errors
+
+
+def config_error(env_db_config, checks=("target", "id_column", "main", "log")):
+    """
+    First error among the given checks, as computed by _validate_env.
+    """
+    errors = env_db_config.get("errors", {})
+    return next((errors[check] for check in checks if check in errors), None)
+
+
+def split_db_config(env_db_config):
+    """
+    Return (target_db, main_db).
+    Supports legacy [database] by using it for both.
+    """
+    target_db = env_db_config.get("target_database")
+    main_db = env_db_config.get("main_database")
+    legacy_db = env_db_config.get("database")
+    if not target_db and not main_db and legacy_db:
+        return legacy_db, legacy_db
+    return target_db or {}, main_db or {}
+
+
+def plan_targets(target_db):
+    """
+    The targets of an environment's replacement plan: one copy of target_db
+    per entry of its `targets` list, with that entry's table, column and
+    id_column (each defaulting to target_db's own). Without `targets` the plan
+    is target_db's table alone.
+    """
+    shared = {k: v for k, v in target_db.items() if k != "targets"}
+    return [
+        dict(shared, **{k: entry.get(k, shared.get(k)) for k in TARGET_KEYS})
+        for entry in target_db.get("targets") or [{}]
+    ]
+
+
+def target_label(target):
+    """
+    "table.column", naming a plan target in the UI and the detail log.
+    """
+    return f"{target.get('table')}.{target.get('column')}"
+
+
+def _target_idents(target):
+    return {k: safe_ident(target.get(k)) for k in TARGET_KEYS}
+
+
+class _ConnectionPool:
+    """
+    Thread-safe pool of connections to one database.
+    Connections idle longer than idle_timeout are closed on checkout, the
+    others are pinged first; broken connections are replaced transparently.
+    """
+
+    def __init__(self, db_cfg, size, idle_timeout, wait_timeout):
+        self._db_cfg = db_cfg
+        self._size = size
+        self._idle_timeout = idle_timeout
+        self._wait_timeout = wait_timeout
+        self._cond = threading.Condition()
+        self._idle = []  # [(conn, last_used)]
+        self._in_use = 0
+        self._stats = {"created": 0, "reused": 0, "discarded": 0, "waits": 0}
+
+    def _connect(self):
+        return mysql.connector.connect(
+            host=self._db_cfg.get("host"),
+            port=int(self._db_cfg.get("port")),
+            user=self._db_cfg.get("user"),
+            password=self._db_cfg.get("password"),
+            database=self._db_cfg.get("database"),
+        )
+
+    def _discard(self, conn):
+        with self._cond:
+            self._stats["discarded"] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def acquire(self):
+        deadline = time.monotonic() + self._wait_timeout
+        with self._cond:
+            while not self._idle and self._in_use >= self._size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise mysql.connector.errors.PoolError(
+                        f"连接池已满（{self._size}），等待超时。"
+                    )
+                self._stats["waits"] += 1
+                self._cond.wait(remaining)
+            self._in_use += 1
+            candidate = self._idle.pop() if self._idle else None
+
+        # Health check runs outside the lock; the slot is already reserved
+        try:
+            if candidate is not None:
+                conn, last_used = candidate
+                if time.monotonic() - last_used <= self._idle_timeout:
+                    try:
+                        conn.ping(reconnect=False)
+                        with self._cond:
+                            self._stats["reused"] += 1
+                        return conn
+                    except mysql.connector.Error:
+                        pass
+                self._discard(conn)
+            conn = self._connect()
+            with self._cond:
+                self._stats["created"] += 1
+            return conn
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn):
+        # Never hand out a connection with an open transaction or unread result
+        try:
+            conn.rollback()
+            healthy = True
+        except Exception:
+            healthy = False
+        with self._cond:
+            self._in_use -= 1
+            if healthy:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+        if not healthy:
+            self._discard(conn)
+
+    def stats(self):
+        with self._cond:
+            return dict(
+                self._stats,
+                size=self._size,
+                in_use=self._in_use,
+                idle=len(self._idle),
+            )
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(
+    host, port, user, password, database, size, idle_timeout, wait_timeout
+):
+    """
+    One pool per distinct database entry, kept for the life of the process.
+    """
+    key = (host, port, user, password, database, size, idle_timeout, wait_timeout)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            db_cfg = {
+                "host": host,
+                "port": port,
+                "user": user,
+                "password": password,
+                "database": database,
+            }
+            pool = _pools[key] = _ConnectionPool(
+                db_cfg, size, idle_timeout, wait_timeout
+            )
+        return pool
+
+
+def pool_for(db_cfg):
+    return _get_pool(
+        db_cfg.get("host"),
+        str(db_cfg.get("port")),
+        db_cfg.get("user"),
+        db_cfg.get("password"),
+        db_cfg.get("database"),
+        int(db_cfg.get("pool_size", DEFAULT_POOL_SIZE)),
+        float(db_cfg.get("pool_idle_timeout", DEFAULT_POOL_IDLE_TIMEOUT)),
+        float(db_cfg.get("pool_wait_timeout", DEFAULT_POOL_WAIT_TIMEOUT)),
+    )
+
+
+def get_connection(db_cfg):
+    """
+    Check a connection out of the pool for db_cfg.
+    Hand it back with release_connection.
+    """
+    return pool_for(db_cfg).acquire()
+
+
+def release_connection(db_cfg, conn):
+    if isinstance(conn, _InstrumentedConnection):
+        conn = conn.raw
+    pool_for(db_cfg).release(conn)
+
+
+def _phase_of(side, sql):
+    # "target.select", "log.insert", ...; filling, creating and dropping the
+    # staging table is "target.stage"
+    verb = sql.lstrip().split(None, 1)[0].lower()
+    if side == "target" and verb in ("insert", "create", "drop"):
+        if "am_stage_" in sql:
+            return "target.stage"
+    return f"{side}.{verb}"
+
+
+class RunStats:
+    """
+    Per-phase counters of one run, filled in by instrumented connections
+    (see instrument). A phase is "<side>.<statement verb>", e.g.
+    "target.update" or "log.insert"; commits are "<side>.commit".
+    Thread-safe, since shards and the log writer share one RunStats.
+    """
+
+    def __init__(self, slow_ms=DEFAULT_SLOW_STATEMENT_MS):
+        self.slow_ms = slow_ms
+        self.phases = {}
+        self.slow = []
+        # Chunk sizers of the run by name (see _chunk_sizer)
+        self.chunking = {}
+        # _Throttle of an online-mode run (see _online_throttle)
+        self.throttle = None
+        self._lock = threading.Lock()
+
+    def record(self, phase, seconds, statements=1, round_trips=1, rows=0, sql=None):
+        ms = seconds * 1000
+        bucket = next(
+            (i for i, bound in enumerate(LATENCY_BUCKETS_MS) if ms <= bound),
+            len(LATENCY_BUCKETS_MS),
+        )
+        with self._lock:
+            counters = self.phases.setdefault(
+                phase,
+                {
+                    "statements": 0,
+                    "round_trips": 0,
+                    "rows": 0,
+                    "seconds": 0.0,
+                    "max_ms": 0.0,
+                    "histogram": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+                },
+            )
+            counters["statements"] += statements
+            counters["round_trips"] += round_trips
+            counters["rows"] += max(rows, 0)
+            counters["seconds"] += seconds
+            counters["max_ms"] = max(counters["max_ms"], ms)
+            counters["histogram"][bucket] += 1
+            if sql is None or ms < self.slow_ms:
+                return
+            self.slow.append(
+                {
+                    "phase": phase,
+                    "ms": round(ms, 1),
+                    "rows": max(rows, 0),
+                    "sql": sql[:300],
+                }
+            )
+            self.slow.sort(key=lambda entry: -entry["ms"])
+            del self.slow[MAX_SLOW_STATEMENTS:]
+        slow_log.warning("slow statement (%.0f ms, %s): %s", ms, phase, sql[:300])
+
+    def add_chunking(self, name, sizer):
+        with self._lock:
+            self.chunking[name] = sizer
+
+    def add_rows(self, phase, rows):
+        with self._lock:
+            if phase in self.phases:
+                self.phases[phase]["rows"] += rows
+
+    def summary(self):
+        """
+        JSON-serializable copy: phases sorted by time spent, plus totals.
+        """
+        with self._lock:
+            phases = {
+                name: dict(
+                    c,
+                    seconds=round(c["seconds"], 4),
+                    max_ms=round(c["max_ms"], 1),
+                    histogram=list(c["histogram"]),
+                )
+                for name, c in sorted(
+                    self.phases.items(), key=lambda item: -item[1]["seconds"]
+                )
+            }
+            slow = list(self.slow)
+            chunking = dict(self.chunking)
+            throttle = self.throttle
+        return {
+            "phases": phases,
+            "statements": sum(c["statements"] for c in phases.values()),
+            "round_trips": sum(c["round_trips"] for c in phases.values()),
+            "commits": sum(
+                c["statements"] for n, c in phases.items() if n.endswith(".commit")
+            ),
+            "db_seconds": round(sum(c["seconds"] for c in phases.values()), 4),
+            "buckets_ms": list(LATENCY_BUCKETS_MS),
+            "slow_ms": self.slow_ms,
+            "slow": slow,
+            "chunking": {name: sizer.summary() for name, sizer in chunking.items()},
+            "throttle": throttle.summary() if throttle else None,
+        }
+
+
+class _InstrumentedCursor:
+    def __init__(self, cursor, side, stats):
+        self._cursor = cursor
+        self._side = side
+        self._stats = stats
+        self._phase = None
+
+    def execute(self, sql, params=()):
+        self._phase = _phase_of(self._side, sql)
+        started = time.perf_counter()
+        try:
+            return self._cursor.execute(sql, params)
+        finally:
+            self._stats.record(
+                self._phase,
+                time.perf_counter() - started,
+                rows=0 if sql.lstrip()[:6].upper() == "SELECT" else self.rowcount,
+                sql=sql,
+            )
+
+    def executemany(self, sql, seq_params):
+        seq_params = list(seq_params)
+        self._phase = _phase_of(self._side, sql)
+        started = time.perf_counter()
+        try:
+            return self._cursor.executemany(sql, seq_params)
+        finally:
+            # mysql.connector sends an INSERT executemany as one multi-row
+            # statement, anything else as one statement per parameter set
+            is_insert = sql.lstrip()[:6].upper() == "INSERT"
+            self._stats.record(
+                self._phase,
+                time.perf_counter() - started,
+                statements=len(seq_params),
+                round_trips=1 if is_insert else len(seq_params),
+                rows=self.rowcount,
+                sql=sql,
+            )
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._stats.add_rows(self._phase, len(rows))
+        return rows
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._stats.add_rows(self._phase, 1)
+        return row
+
+    def fetchmany(self, size=1):
+        rows = self._cursor.fetchmany(size)
+        self._stats.add_rows(self._phase, len(rows))
+        return rows
+
+    def __iter__(self):
+        for rows in _stream_rows(self):
+            yield from rows
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _InstrumentedConnection:
+    """
+    Connection wrapper that times every statement and commit into a RunStats.
+    release_connection hands the wrapped connection back to its pool.
+    """
+
+    def __init__(self, conn, side, stats):
+        self.raw = conn
+        self._side = side
+        self._stats = stats
+
+    def cursor(self, **kwargs):
+        return _InstrumentedCursor(self.raw.cursor(**kwargs), self._side, self._stats)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            self.raw.commit()
+        finally:
+            self._stats.record(f"{self._side}.commit", time.perf_counter() - started)
+
+    def rollback(self):
+        started = time.perf_counter()
+        try:
+            self.raw.rollback()
+        finally:
+            self._stats.record(f"{self._side}.rollback", time.perf_counter() - started)
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+def instrument(conn, side, stats):
+    """
+    `conn` with its statements counted into `stats` under `side` ("target",
+    "main" or "log"); `conn` itself when stats is None.
+    """
+    if stats is None:
+        return conn
+    return _InstrumentedConnection(conn, side, stats)
+
+
+def run_stats_for(db_cfg):
+    return RunStats(float(db_cfg.get("slow_statement_ms", DEFAULT_SLOW_STATEMENT_MS)))
+
+
+_schemas = {}
+_schemas_lock = threading.Lock()
+
+
+def _load_table_schema(target_db):
+    """
+    Column types, primary key and indexes of a target table, read from
+    information_schema.
+    """
+    table = target_db.get("table")
+    conn = get_connection(target_db)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "SELECT COLUMN_NAME, COLUMN_TYPE, DATA_TYPE, IS_NULLABLE, COLLATION_NAME "
+            "FROM information_schema.COLUMNS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s "
+            "ORDER BY ORDINAL_POSITION",
+            (table,),
+        )
+        columns = {
+            name: {
+                "type": column_type,
+                "data_type": data_type,
+                "nullable": nullable == "YES",
+                "collation": collation,
+            }
+            for name, column_type, data_type, nullable, collation in cursor.fetchall()
+        }
+        cursor.execute(
+            "SELECT INDEX_NAME, NON_UNIQUE, COLUMN_NAME "
+            "FROM information_schema.STATISTICS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s "
+            "ORDER BY INDEX_NAME, SEQ_IN_INDEX",
+            (table,),
+        )
+        indexes = {}
+        for index_name, non_unique, column_name in cursor.fetchall():
+            index = indexes.setdefault(
+                index_name, {"columns": [], "unique": not int(non_unique)}
+            )
+            index["columns"].append(column_name)
+    finally:
+        cursor.close()
+        release_connection(target_db, conn)
+    primary = indexes.get("PRIMARY")
+    return {
+        "columns": columns,
+        "primary_key": primary["columns"] if primary else [],
+        "indexes": indexes,
+    }
+
+
+def table_schema(target_db):
+    """
+    Cached _load_table_schema per (host, port, database, table); the cache is
+    cleared whenever config.toml is reloaded.
+    """
+    key = (
+        target_db.get("host"),
+        str(target_db.get("port")),
+        target_db.get("database"),
+        target_db.get("table"),
+    )
+    with _schemas_lock:
+        schema = _schemas.get(key)
+    if schema is None:
+        schema = _load_table_schema(target_db)
+        with _schemas_lock:
+            _schemas[key] = schema
+    return schema
+
+
+def schema_error(target_db):
+    """
+    Check the table and columns of every plan target against the cached
+    schema.
+    """
+    for target in plan_targets(target_db):
+        try:
+            schema = table_schema(target)
+        except mysql.connector.Error as err:
+            return f"读取目标表结构失败: {err}"
+        if not schema["columns"]:
+            return f"目标表 `{target.get('table')}` 不存在或无访问权限。"
+        missing = [
+            target.get(k)
+            for k in ("column", "id_column")
+            if target.get(k) and target.get(k) not in schema["columns"]
+        ]
+        if missing:
+            return f"目标表 `{target.get('table')}` 中不存在列: {', '.join(missing)}。"
+    return None
+
+
+def _is_indexed(schema, column):
+    """
+    Whether column leads some index, i.e. equality lookups can avoid a scan.
+    """
+    return any(
+        index["columns"][0] == column for index in schema["indexes"].values()
+    )
+
+
+def _is_unique_key(schema, column):
+    """
+    Whether column alone is the primary key or a unique index, so the table
+    can be paged through in its order.
+    """
+    return any(
+        index["unique"] and index["columns"] == [column]
+        for index in schema["indexes"].values()
+    )
+
+
+def _sheet_column(df, name):
+    """
+    One sheet column as strings with surrounding whitespace removed; missing
+    and blank cells become None.
+    """
+    if name not in df.columns:
+        return pd.Series(None, index=df.index, dtype=object)
+    values = df[name]
+    text = values.astype(str).str.strip()
+    return text.where(values.notna() & (text != ""), None).astype(object)
+
+
+def normalize_mapping(df, id_column_name, seq_start=0):
+    """
+    Turn the (edited) sheet into ordered mapping rows, column-wise.
+    Returns (mapping, skipped):
+      - mapping: [(seq, kind, key, new_name)], kind is "id" or "name"
+      - skipped: [(id_val, old_name, new_name)] for invalid sheet rows
+    """
+    id_vals = _sheet_column(df, id_column_name)
+    old_names = _sheet_column(df, "原客户名")
+    new_names = _sheet_column(df, "替换后客户名")
+
+    valid = new_names.notna() & (id_vals.notna() | old_names.notna())
+    skipped = list(zip(id_vals[~valid], old_names[~valid], new_names[~valid]))
+    by_id = id_vals[valid].notna()
+    keys = id_vals[valid].where(by_id, old_names[valid])
+    mapping = list(
+        zip(
+            range(seq_start, seq_start + len(keys)),
+            np.where(by_id, "id", "name").tolist(),
+            keys.tolist(),
+            new_names[valid].tolist(),
+        )
+    )
+    return mapping, skipped
+
+
+def _upload_separator(uploaded_file):
+    ext = os.path.splitext(uploaded_file.name)[1].lstrip(".").lower()
+    if ext not in UPLOAD_FORMATS:
+        raise ValueError(f"不支持的文件类型: {uploaded_file.name}")
+    return UPLOAD_FORMATS[ext]
+
+
+def _sniff_encoding(uploaded_file):
+    """
+    CSV exports from Excel on Chinese Windows are usually GB18030, not UTF-8.
+    """
+    uploaded_file.seek(0)
+    sample = uploaded_file.read(64 * 1024)
+    uploaded_file.seek(0)
+    try:
+        sample.decode("utf-8")
+    except UnicodeDecodeError as e:
+        # A multi-byte character cut off at the end of the sample is fine
+        if e.start < len(sample) - 3:
+            return "gb18030"
+    return "utf-8-sig"
+
+
+def read_upload(uploaded_file, id_column_name):
+    """
+    Read a whole upload into one DataFrame (for the editable table).
+    """
+    sep = _upload_separator(uploaded_file)
+    uploaded_file.seek(0)
+    if sep is None:
+        return pd.read_excel(uploaded_file, dtype={id_column_name: str})
+    return pd.read_csv(
+        uploaded_file,
+        sep=sep,
+        dtype=str,
+        encoding=_sniff_encoding(uploaded_file),
+    )
+
+
+def _cell_to_id(value):
+    # Match pd.read_excel(dtype=str): whole numbers lose the ".0"
+    if value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def iter_upload_chunks(uploaded_file, id_column_name, chunk_size):
+    """
+    Yield the upload as DataFrames of at most chunk_size rows, without ever
+    materialising the whole sheet. xlsx goes through openpyxl's read-only
+    mode, CSV/TSV through pandas' chunked reader.
+    """
+    sep = _upload_separator(uploaded_file)
+    uploaded_file.seek(0)
+    if sep is not None:
+        reader = pd.read_csv(
+            uploaded_file,
+            sep=sep,
+            dtype=str,
+            encoding=_sniff_encoding(uploaded_file),
+            chunksize=chunk_size,
+        )
+        with reader:
+            yield from reader
+        return
+
+    workbook = openpyxl.load_workbook(uploaded_file, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [
+            str(c) if c is not None else f"Unnamed: {i}" for i, c in enumerate(header)
+        ]
+        width = len(columns)
+        id_index = columns.index(id_column_name) if id_column_name in columns else None
+        buffer = []
+        for values in rows:
+            # Read-only mode reports formatted but empty trailing rows
+            if all(v is None for v in values):
+                continue
+            values = list(values[:width]) + [None] * (width - len(values))
+            if id_index is not None:
+                values[id_index] = _cell_to_id(values[id_index])
+            buffer.append(values)
+            if len(buffer) >= chunk_size:
+                yield pd.DataFrame(buffer, columns=columns)
+                buffer = []
+        if buffer:
+            yield pd.DataFrame(buffer, columns=columns)
+    finally:
+        workbook.close()
+
+
+def iter_mapping(chunks, id_column_name):
+    """
+    Stream mapping rows out of DataFrame chunks, numbering them across chunks.
+    Invalid rows are dropped; scan_upload reports them up front.
+    """
+    seq = 0
+    for df in chunks:
+        mapping, _skipped = normalize_mapping(df, id_column_name, seq)
+        seq += len(mapping)
+        yield from mapping
+
+
+def scan_upload(uploaded_file, id_column_name, chunk_size):
+    """
+    One streaming pass over an upload, returning its validation summary and
+    the mapping_check of the whole sheet (summary["check"]).
+    """
+    summary = {
+        "columns": [],
+        "total": 0,
+        "valid": 0,
+        "id_keyed": 0,
+        "name_keyed": 0,
+        "skipped": 0,
+        "skipped_examples": [],
+    }
+
+    def rows():
+        # Chunks go straight into prepare_mapping, which keeps one entry per key
+        for df in iter_upload_chunks(uploaded_file, id_column_name, chunk_size):
+            if not summary["columns"]:
+                summary["columns"] = list(df.columns)
+            mapping, skipped = normalize_mapping(df, id_column_name, summary["valid"])
+            summary["total"] += len(df)
+            summary["valid"] += len(mapping)
+            summary["id_keyed"] += sum(1 for item in mapping if item[1] == "id")
+            summary["name_keyed"] += sum(1 for item in mapping if item[1] == "name")
+            summary["skipped"] += len(skipped)
+            room = MAX_SKIPPED_EXAMPLES - len(summary["skipped_examples"])
+            summary["skipped_examples"].extend(skipped[:room])
+            yield from mapping
+
+    summary["check"] = mapping_check(prepare_mapping(rows()))
+    return summary
+
+
+class _DetailLogWriter:
+    """
+    Buffered writer for detail-log rows, running on its own thread and
+    connection. Rows handed to put() are written as multi-row INSERTs once
+    `flush_rows` rows are buffered or `flush_interval` seconds have passed.
+    put() blocks while `queue_size` batches are pending (backpressure).
+    sync() returns once everything put so far is committed; call it before
+    committing the target rows those log rows describe.
+    checkpoint() records progress in `checkpoint_table` (if set); it is
+    written in the same transaction as the next flush of log rows, and so is
+    the row-state upsert of the flushed rows (if `row_state_table` is set).
+    With `target` set, every row is written with that target label.
+    With `chunk_table` set, each multi-row INSERT is replaced by one row of
+    the compact detail log, indexed in `chunk_key_table` (see
+    _insert_detail_chunk).
+    """
+
+    def __init__(
+        self,
+        conn,
+        log_detail_table,
+        flush_rows,
+        flush_interval,
+        queue_size=4,
+        checkpoint_table=None,
+        target=None,
+        row_state_table=None,
+        chunk_table=None,
+        chunk_key_table=None,
+    ):
+        self._conn = conn
+        self._table = log_detail_table
+        self._chunk_table = chunk_table
+        self._chunk_key_table = chunk_key_table
+        self._target = target
+        self._checkpoint_table = checkpoint_table
+        self._row_state_table = row_state_table
+        # Latest pending checkpoint per (batch_id, action)
+        self._checkpoints = {}
+        self._flush_rows = max(1, flush_rows)
+        self._flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._error = None
+        self.rows_written = 0
+        self.flushes = 0
+        self._thread = threading.Thread(
+            target=self._loop, name="anti-masking-log-writer", daemon=True
+        )
+        self._thread.start()
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise self._error
+
+    def put(self, details):
+        self._raise_if_failed()
+        if details:
+            self._queue.put(details)
+
+    def checkpoint(self, batch_id, action, last_id, processed_rows, changed_rows):
+        """
+        Queue a checkpoint; call it after the target commit it describes.
+        """
+        self._raise_if_failed()
+        if self._checkpoint_table:
+            self._queue.put((batch_id, action, last_id, processed_rows, changed_rows))
+
+    def sync(self):
+        synced = threading.Event()
+        self._queue.put(synced)
+        synced.wait()
+        self._raise_if_failed()
+
+    def close(self):
+        """
+        Flush what is left and stop the thread; raises if any write failed.
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_if_failed()
+
+    def _loop(self):
+        buffer = []
+        deadline = None
+        while True:
+            timeout = None
+            pending = buffer or self._checkpoints
+            if pending:
+                timeout = max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = []
+            if item is None:
+                self._flush(buffer)
+                return
+            if isinstance(item, threading.Event):
+                self._flush(buffer)
+                item.set()
+                continue
+            if item and not pending:
+                deadline = time.monotonic() + self._flush_interval
+            if isinstance(item, tuple):
+                self._checkpoints[item[:2]] = item
+            else:
+                buffer.extend(item)
+            if len(buffer) >= self._flush_rows or (
+                (buffer or self._checkpoints) and time.monotonic() >= deadline
+            ):
+                self._flush(buffer)
+
+    def _flush(self, buffer):
+        # After a failure, rows are dropped; the error surfaces on put/sync
+        if (buffer or self._checkpoints) and self._error is None:
+            cursor = self._conn.cursor()
+            try:
+                row = (
+                    "(%s, %s, %s, %s, %s, %s)"
+                    if self._target
+                    else "(%s, %s, %s, %s, %s)"
+                )
+                extra = (self._target,) if self._target else ()
+                for start in range(0, len(buffer), self._flush_rows):
+                    part = buffer[start : start + self._flush_rows]
+                    if self._chunk_table:
+                        _insert_detail_chunk(
+                            cursor,
+                            self._chunk_table,
+                            part,
+                            self._target,
+                            self._chunk_key_table,
+                        )
+                    else:
+                        cursor.execute(
+                            f"INSERT INTO `{self._table}` "
+                            f"({_detail_columns(self._target)}) "
+                            f"VALUES {', '.join([row] * len(part))}",
+                            tuple(v for detail in part for v in (*detail, *extra)),
+                        )
+                    _upsert_row_state(cursor, self._row_state_table, part, self._target)
+                for checkpoint in self._checkpoints.values():
+                    _save_checkpoint(cursor, self._checkpoint_table, *checkpoint)
+                self._conn.commit()
+                self.rows_written += len(buffer)
+                self.flushes += 1
+            except Exception as e:
+                self._error = e
+                try:
+                    self._conn.rollback()
+                except Exception:
+                    pass
+            finally:
+                cursor.close()
+        buffer.clear()
+        self._checkpoints.clear()
+
+
+@contextlib.contextmanager
+def _detail_log_writer(main_db, log_detail_table, stats=None, target=None):
+    """
+    A _DetailLogWriter on its own pooled main-DB connection, flushed and
+    closed on exit.
+    """
+    conn = instrument(get_connection(main_db), "log", stats)
+    writer = _DetailLogWriter(
+        conn,
+        log_detail_table,
+        int(main_db.get("log_flush_rows", DEFAULT_LOG_FLUSH_ROWS)),
+        float(main_db.get("log_flush_interval", DEFAULT_LOG_FLUSH_INTERVAL)),
+        int(main_db.get("log_queue_size", DEFAULT_LOG_QUEUE_SIZE)),
+        safe_ident(main_db.get("checkpoint_table")),
+        target,
+        safe_ident(main_db.get("row_state_table")),
+        safe_ident(main_db.get("log_chunk_table")),
+        safe_ident(main_db.get("log_chunk_key_table")),
+    )
+    try:
+        yield writer
+    finally:
+        try:
+            writer.close()
+        finally:
+            release_connection(main_db, conn)
+
+
+def _replay_filter(
+    conn,
+    log_detail_table,
+    batch_id,
+    lock,
+    mapping,
+    keys,
+    target=None,
+    chunk_table=None,
+):
+    """
+    Filter for a resumed batch, on the main-DB connection `conn` and shared
+    between shards and targets under `lock`. Checkpoints trail the commits
+    they describe, so the rows a resumed batch runs again may have been
+    applied already; the batch's detail log (for `target`, in a multi-target
+    plan) tells which records they changed.
+
+    replay(rows, since) takes the records [(row_id, name, new_name, seq)]
+    matched by the remaining `mapping` rows ([(seq, kind, key, new_name)],
+    keys compared through `keys`, see _conflict_keys) and returns (rows to
+    change, rows to log). A record whose latest logged change left it with
+    its current name, made by a mapping row at or after the one now matching
+    it (`since`, or the record's seq when None), is left alone: the
+    interrupted run already moved it past this row (A -> B running again
+    after X -> A renamed X to A). A record whose latest logged change is the
+    one about to be made is changed but not logged again (its target commit
+    was lost). Any other record is changed and logged as in a first run.
+
+    A batch in the compact detail log `chunk_table` cannot be probed by
+    row_id: its chunks are read into memory on the first call. Rows the
+    resumed run logs itself are then not seen, which only means a record it
+    changes twice is judged by its change from the interrupted run.
+    """
+    target_clause = "AND target = %s " if target else ""
+    extra = (target,) if target else ()
+    # [row_id -> latest (old_name, new_name) of the batch's chunks], or [None]
+    # for a batch without chunks
+    compact = []
+    # (kind, key(key), new_name) -> last seq of the mapping rows giving it
+    producers = {}
+
+    def latest(row_ids):
+        if not compact:
+            compact.append(_chunk_changes(conn, chunk_table, batch_id, target))
+        if compact[0] is not None:
+            return {r: compact[0][r] for r in row_ids if r in compact[0]}
+        placeholders = ", ".join(["%s"] * len(row_ids))
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                f"SELECT row_id, old_name, new_name FROM `{log_detail_table}` "
+                f"WHERE batch_id = %s {target_clause}"
+                f"AND row_id IN ({placeholders}) ORDER BY id",
+                (batch_id, *extra, *row_ids),
+            )
+            found = {row_id: (old, new) for row_id, old, new in cursor.fetchall()}
+            # Start a fresh read view for the next lookup
+            conn.commit()
+        finally:
+            cursor.close()
+        return found
+
+    def produced_by(row_id, old_name, new_name):
+        # Last mapping row that changes the record from old_name to new_name
+        if not producers:
+            for seq, kind, key, name in mapping:
+                producers[(kind, keys[kind](key), name)] = seq
+            # Built, even for an empty mapping
+            producers[None] = -1
+        return max(
+            producers.get(("id", keys["id"](row_id), new_name), -1),
+            producers.get(("name", keys["name"](old_name), new_name), -1),
+        )
+
+    def replay(rows, since=None):
+        with lock:
+            changes = latest(list(dict.fromkeys(str(r[0]) for r in rows)))
+            change, log = [], []
+            for r in rows:
+                logged = changes.get(str(r[0]))
+                if logged is None:
+                    change.append(r)
+                    log.append(r)
+                elif logged[1] == r[1] and produced_by(str(r[0]), *logged) >= (
+                    r[3] if since is None else since
+                ):
+                    continue
+                else:
+                    change.append(r)
+                    if logged != (r[1], r[2]):
+                        log.append(r)
+        return change, log
+
+    return replay
+
+
+def _chunk_changes(conn, chunk_table, batch_id, target=None):
+    """
+    {row_id: (old_name, new_name)} of the latest change to each record in the
+    compact detail log of batch_id (for `target`), or None if the batch has
+    no chunks there.
+    """
+    if not chunk_table:
+        return None
+    cursor = conn.cursor()
+    try:
+        changes = None
+        for _id, _label, rows in _detail_chunks(
+            cursor,
+            chunk_table,
+            batch_id,
+            ("row_id", "old_name", "new_name"),
+            target=target,
+        ):
+            changes = changes or {}
+            changes.update((row_id, (old, new)) for row_id, old, new in rows)
+        conn.commit()
+    finally:
+        cursor.close()
+    return changes
+
+
+def _follow(next_index):
+    """
+    End of each row's path through next_index (row -> next row, or itself
+    at the end of a path), by pointer doubling: log2(n) vectorized passes.
+    Rows on or leading into a cycle end on some row of that cycle.
+    """
+    end = next_index
+    for _ in range(max(1, len(end)).bit_length()):
+        end = end[end]
+    return end
+
+
+def prepare_mapping(mapping):
+    """
+    Check the whole mapping before anything is written, and reduce it to the
+    rows that need to run, in one pass over `mapping` (any iterable, so an
+    upload can be streamed through) that keeps one entry per key:
+      - duplicates: a key repeated with the same new name runs once
+      - conflicts: a key repeated with different new names; an ID keeps the
+        last new name, a name the first, as running the rows in order would
+        (once renamed, the records no longer carry the key, unless a row in
+        between gives it back: see reentered)
+      - no-ops: name rows whose new name equals their key are dropped
+      - chains: a name row whose new name is the key of a later name row
+        (A -> B, then B -> C) takes the end of the chain (A -> C)
+      - cycles: name rows whose keys form a loop (A -> B, B -> A); applied in
+        order they collapse into one name, so the mapping must not run
+      - reentered: a name key given again after a row in between renamed
+        other records to it (A -> B, X -> A, A -> C); in order the later row
+        renames those other records, which no single row per key can
+        express, so the mapping must not run either
+    Name rows are moved before ID rows, so chunks are not cut at every change
+    of key kind, unless an ID row's new name is also a name key (then the
+    sheet order matters and is kept). Keys are compared exactly: whether
+    "a1" and "A1" name the same record depends on the target column's
+    collation, so both rows are kept and run in sheet order (_plan_chunks
+    puts keys that may collide in separate chunks).
+    Returns a dict with "mapping" ([(seq, kind, key, new_name)], seq
+    renumbered from 0) and the findings above. Memory grows with the number
+    of distinct keys, not of rows: the sheet is never held, but the prepared
+    rows are, for the whole run of a batch.
+    """
+    rows = 0
+    noops = 0
+    # key -> [seq, new name]: the last row of an ID, the first of a name
+    # (names also keep their position, for the chain and cycle checks)
+    ids = {}
+    names = {}
+    # (kind, key) -> {new name: rows}, only for keys given more than once
+    repeated = {}
+    # new name -> seq of the last row giving it, and the name keys given
+    # again after a row in between renamed records to them
+    produced = {}
+    reentered = {}
+    for seq, kind, key, new_name in mapping:
+        rows += 1
+        if kind == "name" and key == new_name:
+            noops += 1
+            continue
+        entries = ids if kind == "id" else names
+        entry = entries.get(key)
+        if entry is None:
+            entries[key] = [seq, new_name, len(entries)]
+        else:
+            counts = repeated.setdefault((kind, key), {entry[1]: 1})
+            counts[new_name] = counts.get(new_name, 0) + 1
+            if kind == "id":
+                entry[0], entry[1] = seq, new_name
+            elif produced.get(key, -1) > entry[0]:
+                reentered.setdefault(key, [entry[1]]).append(new_name)
+        produced[new_name] = seq
+    del produced
+    duplicates = [
+        (kind, key, new_name, count)
+        for (kind, key), counts in repeated.items()
+        for new_name, count in counts.items()
+        if count > 1
+    ]
+    conflicts = [
+        (kind, key, list(counts))
+        for (kind, key), counts in repeated.items()
+        if len(counts) > 1
+    ]
+    del repeated
+
+    keys = list(names)
+    seqs = np.fromiter((entry[0] for entry in names.values()), dtype=np.int64)
+    positions = np.arange(len(keys))
+    target = np.fromiter(
+        (names[entry[1]][2] if entry[1] in names else -1 for entry in names.values()),
+        dtype=np.int64,
+    )
+    linked = (target >= 0) & (target != positions)
+
+    # A loop in the key graph, whatever the row order
+    step = np.where(linked, target, positions)
+    end = _follow(step)
+    cyclic = np.flatnonzero(step[end] != end)
+    cycles = [(keys[i], names[keys[i]][1]) for i in cyclic]
+
+    # Chains only follow rows further down the sheet, as running in order would
+    later = linked & (seqs[np.maximum(target, 0)] > seqs)
+    end = _follow(np.where(later, target, positions))
+    chains = []
+    finals = []
+    for i, key in enumerate(keys):
+        final = names[keys[end[i]]][1]
+        if end[i] != i:
+            chains.append((key, names[key][1], final))
+        finals.append(final)
+
+    reorder = not any(entry[1] in names for entry in ids.values())
+    reordered = reorder and bool(names) and bool(ids)
+    # Built in place (and each dict freed once read), so at most one copy
+    # of the rows is held besides the dicts
+    ordered = [
+        (entry[0], "name", key, final)
+        for (key, entry), final in zip(names.items(), finals)
+    ]
+    del names, finals
+    if reorder:
+        ordered.sort()
+        first_id = len(ordered)
+        ordered.extend((entry[0], "id", key, entry[1]) for key, entry in ids.items())
+        del ids
+        ordered[first_id:] = sorted(ordered[first_id:])
+    else:
+        ordered.extend((entry[0], "id", key, entry[1]) for key, entry in ids.items())
+        del ids
+        ordered.sort()
+    for i, row in enumerate(ordered):
+        ordered[i] = (i, *row[1:])
+    return {
+        "mapping": ordered,
+        "rows": rows,
+        "duplicates": duplicates,
+        "conflicts": conflicts,
+        "noops": noops,
+        "chains": chains,
+        "cycles": cycles,
+        "reentered": [(key, new_names) for key, new_names in reentered.items()],
+        "reordered": reordered,
+    }
+
+
+def mapping_check(plan):
+    """
+    The findings of prepare_mapping without the rows themselves.
+    """
+    check = {k: v for k, v in plan.items() if k != "mapping"}
+    check["final_rows"] = len(plan["mapping"])
+    return check
+
+
+def prepared_source(mapping_source):
+    """
+    mapping_source reduced by prepare_mapping. The work is done on the first
+    call (on the job's thread) and its result reused by later calls.
+    """
+    prepared = []
+    lock = threading.Lock()
+
+    def source():
+        with lock:
+            if not prepared:
+                prepared.append(prepare_mapping(mapping_source())["mapping"])
+        return prepared[0]
+
+    return source
+
+
+def _explain(cursor, statement, params, table):
+    """
+    EXPLAIN a statement; returns its plan rows as dicts plus whether the
+    target table is read with a full scan.
+    """
+    cursor.execute(f"EXPLAIN {statement}", params)
+    names = [d[0].lower() for d in cursor.description]
+    plan = [dict(zip(names, row)) for row in cursor.fetchall()]
+    full_scan = any(
+        str(step.get("table")) in (table, "t")
+        and str(step.get("type")).upper() == "ALL"
+        for step in plan
+    )
+    return plan, full_scan
+
+
+def estimate_impact(conn_target, idents, plan, chunk_size, fanout_threshold, schema):
+    """
+    Dry run of a batch prepared by prepare_mapping: counts the target rows
+    each key matches with grouped JOINs over a temporary key table, and
+    EXPLAINs the statements the set-based and row-by-row paths would send.
+    Nothing is written to the target table; the temporary table and
+    transaction are discarded.
+    schema is the cached table_schema of the target table.
+    """
+    started = time.monotonic()
+    table = idents["table"]
+    column = idents["column"]
+    id_column = idents["id_column"]
+    keys = {"id": [], "name": []}
+    for _seq, kind, key, _new_name in plan["mapping"]:
+        keys[kind].append(key)
+    stage = f"am_stage_{secrets.token_hex(4)}"
+    cursor = conn_target.cursor()
+    matches = {"id": {}, "name": {}}
+    explains = []
+    try:
+        cursor.execute(
+            f"CREATE TEMPORARY TABLE `{stage}` (seq INT NOT NULL PRIMARY KEY) "
+            f"SELECT t.`{id_column}` AS id_key, t.`{column}` AS name_key "
+            f"FROM (SELECT 1) AS d LEFT JOIN `{table}` AS t ON 1 = 0"
+        )
+        seq = 0
+        for kind in ("id", "name"):
+            kind_keys = keys[kind]
+            for start in range(0, len(kind_keys), max(1, chunk_size)):
+                part = kind_keys[start : start + max(1, chunk_size)]
+                cursor.executemany(
+                    f"INSERT INTO `{stage}` (seq, id_key, name_key) "
+                    "VALUES (%s, %s, %s)",
+                    [
+                        (
+                            seq + i,
+                            key if kind == "id" else None,
+                            key if kind == "name" else None,
+                        )
+                        for i, key in enumerate(part)
+                    ],
+                )
+                seq += len(part)
+        # seq ranges: ID keys first, then name keys
+        first_name_seq = len(keys["id"])
+
+        for kind, match_column, key_column in (
+            ("id", id_column, "id_key"),
+            ("name", column, "name_key"),
+        ):
+            if not keys[kind]:
+                continue
+            offset = 0 if kind == "id" else first_name_seq
+            cursor.execute(
+                f"SELECT s.seq, COUNT(*) FROM `{stage}` AS s "
+                f"JOIN `{table}` AS t ON t.`{match_column}` = s.{key_column} "
+                "GROUP BY s.seq"
+            )
+            for seq_value, count in cursor.fetchall():
+                matches[kind][keys[kind][seq_value - offset]] = count
+
+            # Same join as the chunk SELECT/UPDATE of _run_batch_bulk
+            explained, full_scan = _explain(
+                cursor,
+                f"SELECT t.`{id_column}` FROM `{stage}` AS s "
+                f"JOIN `{table}` AS t ON t.`{match_column}` = s.{key_column} "
+                "WHERE s.seq BETWEEN %s AND %s",
+                (offset, offset + max(1, chunk_size) - 1),
+                table,
+            )
+            explains.append(("集合批量", kind, explained, full_scan))
+            explained, full_scan = _explain(
+                cursor,
+                f"SELECT `{id_column}`, `{column}` FROM `{table}` "
+                f"WHERE `{match_column}` = %s",
+                (keys[kind][0],),
+                table,
+            )
+            explains.append(("逐行", kind, explained, full_scan))
+    finally:
+        try:
+            cursor.execute(f"DROP TEMPORARY TABLE IF EXISTS `{stage}`")
+            conn_target.rollback()
+        except mysql.connector.Error:
+            pass
+        cursor.close()
+
+    fanout = sorted(
+        (
+            (kind, key, count)
+            for kind in ("id", "name")
+            for key, count in matches[kind].items()
+            if count > fanout_threshold
+        ),
+        key=lambda item: -item[2],
+    )
+    distinct_keys = len(keys["id"]) + len(keys["name"])
+    matched_keys = len(matches["id"]) + len(matches["name"])
+    matched_rows = sum(sum(m.values()) for m in matches.values())
+    return {
+        "rows": plan["rows"],
+        "distinct_keys": distinct_keys,
+        "matched_keys": matched_keys,
+        "unmatched_keys": distinct_keys - matched_keys,
+        "matched_rows": matched_rows,
+        # Each prepared row logs every record its key matches once
+        "estimated_log_rows": matched_rows,
+        "fanout_threshold": fanout_threshold,
+        "fanout": fanout,
+        "check": mapping_check(plan),
+        "explains": explains,
+        "unindexed": [
+            name
+            for kind, name in (("id", id_column), ("name", column))
+            if keys[kind] and not _is_indexed(schema, name)
+        ],
+        "elapsed": time.monotonic() - started,
+    }
+
+
+def _loose_key(value):
+    """
+    Lookup key with case, accents and trailing spaces folded: two keys that
+    the language-neutral collations would match always share it.
+    """
+    value = "".join(
+        c
+        for c in unicodedata.normalize("NFKD", str(value).rstrip())
+        if not unicodedata.combining(c)
+    )
+    return value.casefold()
+
+
+def _conflict_key(collation):
+    """
+    key(value) used to decide chunk boundaries and parallel shards: keys that
+    may hit the same target rows under `collation` (the key column's
+    COLLATION_NAME) get the same key(). That is the collation's own
+    _scan_match_key where one can be reproduced in memory, so keys the column
+    tells apart are not kept apart for nothing, and _loose_key otherwise
+    (language-specific equalities, such as latin1_swedish_ci's Y = Ü, are not
+    covered by it).
+    """
+    return _scan_match_key(collation) or _loose_key
+
+
+def _conflict_keys(target_db):
+    """
+    The _conflict_key of a plan target's id and name columns, as
+    {"id": key, "name": key}.
+    """
+    columns = table_schema(target_db)["columns"]
+    return {
+        kind: _conflict_key(columns.get(target_db.get(name), {}).get("collation"))
+        for kind, name in (("id", "id_column"), ("name", "column"))
+    }
+
+
+def _plan_chunks(mapping, chunk_size, keys=None):
+    """
+    Split ordered mapping rows into chunks of at most chunk_size rows (an int,
+    or a function giving the size of the next chunk) that can each run as one
+    set-based statement while giving the same result as applying the rows one
+    by one:
+      - a chunk holds a single key kind (id or name)
+      - a key appears at most once per chunk
+      - a name key never equals a new name set earlier in the same chunk
+        (A -> B followed by B -> C must see the first update)
+    Keys are compared through `keys` ({"id": key, "name": key}, see
+    _conflict_keys), or _loose_key when not given.
+    """
+    size_of = chunk_size if callable(chunk_size) else lambda: chunk_size
+    keys = keys or {"id": _loose_key, "name": _loose_key}
+    chunk = []
+    kind = None
+    seen = set()
+    new_names = set()
+    for item in mapping:
+        _seq, item_kind, key, new_name = item
+        ck = keys[item_kind](key)
+        if chunk and (
+            item_kind != kind
+            or len(chunk) >= size_of()
+            or ck in seen
+            or (item_kind == "name" and ck in new_names)
+        ):
+            yield kind, chunk
+            chunk = []
+            seen = set()
+            new_names = set()
+        kind = item_kind
+        chunk.append(item)
+        seen.add(ck)
+        new_names.add(keys["name"](new_name))
+    if chunk:
+        yield kind, chunk
+
+
+# Language-neutral case-insensitive collations (after the character set
+# name); language-specific ones such as latin1_swedish_ci reorder letters
+_SCAN_CI_COLLATIONS = {
+    "general_ci",
+    "general_nopad_ci",
+    "unicode_ci",
+    "unicode_nopad_ci",
+    "unicode_520_ci",
+    "unicode_520_nopad_ci",
+    "0900_ai_ci",
+    "0900_as_ci",
+}
+
+
+def _scan_match_key(collation):
+    """
+    key(value) such that two names are equal under `collation` (the name
+    column's COLLATION_NAME) exactly when their keys are, or None when the
+    collation cannot be reproduced in memory and names must be matched by
+    the database. Binary strings and _bin collations compare exactly; the
+    language-neutral _ci collations ignore case (casefold) and, unless
+    _as_ci, accents (Unicode decomposition). All but the NO PAD ones (MySQL
+    8's _0900_ and the _nopad_ collations) ignore trailing spaces.
+    """
+    if collation is None or collation == "binary":
+        return str
+    name = collation.lower()
+    rule = name.split("_", 1)[-1]
+    if name.endswith("_bin"):
+        fold_case = fold_accents = False
+    elif rule in _SCAN_CI_COLLATIONS:
+        fold_case = True
+        fold_accents = rule != "0900_as_ci"
+    else:
+        return None
+    pad_space = "_0900_" not in name and "_nopad_" not in name
+
+    def key(value):
+        value = str(value)
+        if pad_space:
+            value = value.rstrip(" ")
+        if fold_accents:
+            value = "".join(
+                c
+                for c in unicodedata.normalize("NFKD", value)
+                if not unicodedata.combining(c)
+            )
+        return value.casefold() if fold_case else value
+
+    return key
+
+
+def _name_resolver(mapping, key=str):
+    """
+    resolve(name): the name a record called `name` ends up with once the name
+    rows of `mapping` ([(seq, "name", key, new_name)] in seq order) are applied
+    one by one, or None when none of them matches it. A row applies to the
+    name left by the rows before it, so A -> B followed by B -> C gives C and
+    the reverse order gives B. Names match when their key() values are equal
+    (see _scan_match_key).
+    """
+    index = {}  # key(name) -> ([seq], [new_name]) in seq order
+    for seq, _kind, name, new_name in mapping:
+        seqs, names = index.setdefault(key(name), ([], []))
+        seqs.append(seq)
+        names.append(new_name)
+
+    def resolve(name):
+        if name is None:
+            return None
+        seq = None
+        while True:
+            entry = index.get(key(name))
+            if entry is None:
+                break
+            seqs, names = entry
+            i = 0 if seq is None else bisect.bisect_right(seqs, seq)
+            if i == len(seqs):
+                break
+            seq, name = seqs[i], names[i]
+        return None if seq is None else name
+
+    return resolve
+
+
+def _scan_name_matches(cursor, idents, mapping, page_rows, size, after=None, key=str):
+    """
+    Match the name rows of `mapping` against the target table in one pass
+    instead of one lookup per name: read (id, name) pairs in keyset pages of
+    page_rows rows ordered by id_column, resolve each name in memory (see
+    _name_resolver) and yield the records whose name changes, in lists of at
+    most size() records [(row_id, name, new_name)], each with the fraction of
+    the table scanned so far (None unless id_column holds integers).
+    Each page is read in full before its records are yielded, so the cursor is
+    free in between; no more than a page and a list are held at once.
+
+    A resumed scan with integer ids starts after the id `after`; without
+    integer ids it starts over (the caller's _replay_filter then leaves alone
+    the records the interrupted scan renamed).
+    Names are compared through `key`, the name column's _scan_match_key.
+    """
+    table = idents["table"]
+    column = idents["column"]
+    id_column = idents["id_column"]
+    resolve = _name_resolver(mapping, key)
+    cursor.execute(f"SELECT MIN(`{id_column}`), MAX(`{id_column}`) FROM `{table}`")
+    low, high = cursor.fetchone()
+    numeric = isinstance(low, int) and isinstance(high, int)
+    if not numeric:
+        after = None
+
+    matches = []
+    last_id = after
+    while True:
+        if last_id is None:
+            cursor.execute(
+                f"SELECT `{id_column}`, `{column}` FROM `{table}` "
+                f"ORDER BY `{id_column}` LIMIT %s",
+                (page_rows,),
+            )
+        else:
+            cursor.execute(
+                f"SELECT `{id_column}`, `{column}` FROM `{table}` "
+                f"WHERE `{id_column}` > %s ORDER BY `{id_column}` LIMIT %s",
+                (last_id, page_rows),
+            )
+        page = cursor.fetchall()
+        if not page:
+            break
+        last_id = page[-1][0]
+        hits = []
+        for row_id, name in page:
+            new_name = resolve(name)
+            if new_name is not None and new_name != name:
+                hits.append((row_id, name, new_name))
+        matches.extend(hits)
+        scanned = (last_id - low) / (high - low) if numeric and high > low else None
+        while len(matches) >= size():
+            part, matches = matches[: size()], matches[size() :]
+            yield part, scanned
+    if matches:
+        yield matches, 1.0 if numeric else None
+
+
+def _is_lock_error(exc):
+    return (
+        isinstance(exc, mysql.connector.Error) and exc.errno in LOCK_RETRY_ERRNOS
+    )
+
+
+def _lock_retrying(sizer=None):
+    """
+    Retry loop for a target-DB write that may hit a deadlock or lock-wait
+    timeout; the write must roll back and redo its own transaction. Each
+    retry also backs off `sizer` (see _ChunkSizer.lock_error).
+    """
+    return tenacity.Retrying(
+        retry=tenacity.retry_if_exception(_is_lock_error),
+        stop=tenacity.stop_after_attempt(LOCK_RETRY_ATTEMPTS),
+        wait=tenacity.wait_random_exponential(multiplier=0.2, max=5),
+        before_sleep=(lambda _state: sizer.lock_error()) if sizer else None,
+        reraise=True,
+    )
+
+
+class _ChunkSizer:
+    """
+    Rows per chunk (and so per transaction) of one run, read through size()
+    before every chunk. Fixed at `size` unless `adaptive`, in which case it
+    is tuned from what each committed chunk cost (observe). Throughput
+    (rows/s) is measured over windows of SIZER_WINDOW_CHUNKS chunks: the size
+    grows by half while it rises by more than 5% per window, and steps back a
+    third when it falls by more than 5% (then holds for SIZER_SETTLE_WINDOWS
+    windows). The size halves at once when a chunk takes longer than
+    `target_seconds` or a write hits a lock-wait timeout or deadlock. A
+    transaction the server rejects as too large (too_large) also lowers the
+    ceiling for the rest of the run.
+    """
+
+    def __init__(
+        self,
+        size,
+        adaptive=False,
+        min_size=DEFAULT_CHUNK_SIZE_MIN,
+        max_size=DEFAULT_CHUNK_SIZE_MAX,
+        target_seconds=DEFAULT_CHUNK_TARGET_MS / 1000,
+    ):
+        self.adaptive = adaptive
+        self.min_size = max(1, min(min_size, size)) if adaptive else max(1, size)
+        self.max_size = max(max_size, size) if adaptive else max(1, size)
+        self.target_seconds = target_seconds
+        self.initial = max(1, size)
+        self._size = self.initial
+        self._last_rate = None
+        self._settle = 0
+        self._window = [0, 0.0, 0]  # rows, seconds, chunks
+        self.smallest = self.largest = self._size
+        self.changes = 0
+        self.lock_backoffs = 0
+        self.size_backoffs = 0
+
+    def size(self):
+        return self._size
+
+    def _resize(self, size):
+        size = max(self.min_size, min(self.max_size, int(size)))
+        self._window = [0, 0.0, 0]
+        if self.adaptive and size != self._size:
+            self._size = size
+            self.changes += 1
+            self.smallest = min(self.smallest, size)
+            self.largest = max(self.largest, size)
+
+    def _back_off(self, size):
+        self._resize(size)
+        self._last_rate = None
+
+    def observe(self, rows, seconds):
+        """
+        A chunk of `rows` rows committed after `seconds`.
+        """
+        if seconds > self.target_seconds:
+            self._back_off(self._size // 2)
+            return
+        # Chunks cut short (key conflicts, end of the mapping) say little
+        if rows < self._size // 2 or seconds <= 0:
+            return
+        window = self._window
+        window[0] += rows
+        window[1] += seconds
+        window[2] += 1
+        if window[2] < SIZER_WINDOW_CHUNKS:
+            return
+        rate = window[0] / window[1]
+        last, self._last_rate = self._last_rate, rate
+        if self._settle:
+            self._settle -= 1
+            self._window = [0, 0.0, 0]
+        elif last is None or rate > last * 1.05:
+            self._resize(self._size * 3 // 2)
+        elif rate < last * 0.95:
+            self._resize(self._size * 2 // 3)
+            self._settle = SIZER_SETTLE_WINDOWS
+        else:
+            self._window = [0, 0.0, 0]
+
+    def lock_error(self):
+        self.lock_backoffs += 1
+        self._back_off(self._size // 2)
+
+    def too_large(self, rows):
+        """
+        The server rejected a transaction of `rows` rows as too large.
+        """
+        self.size_backoffs += 1
+        if self.adaptive:
+            self.max_size = max(self.min_size, rows // 2)
+        self._back_off(rows // 2)
+
+    def summary(self):
+        return {
+            "adaptive": self.adaptive,
+            "initial": self.initial,
+            "final": self._size,
+            "smallest": self.smallest,
+            "largest": self.largest,
+            "changes": self.changes,
+            "lock_backoffs": self.lock_backoffs,
+            "size_backoffs": self.size_backoffs,
+        }
+
+
+def _chunk_sizer(db_cfg, chunk_size, stats=None, name=None):
+    """
+    The _ChunkSizer of a run against db_cfg (adaptive with `adaptive_chunks`
+    set, bounded by chunk_size_min / chunk_size_max / chunk_target_ms),
+    reported in stats under `name`.
+    """
+    sizer = _ChunkSizer(
+        max(1, chunk_size),
+        bool(db_cfg.get("adaptive_chunks")),
+        int(db_cfg.get("chunk_size_min", DEFAULT_CHUNK_SIZE_MIN)),
+        int(db_cfg.get("chunk_size_max", DEFAULT_CHUNK_SIZE_MAX)),
+        float(db_cfg.get("chunk_target_ms", DEFAULT_CHUNK_TARGET_MS)) / 1000,
+    )
+    if stats is not None and name:
+        stats.add_chunking(name, sizer)
+    return sizer
+
+
+def _server_health(cursor):
+    """
+    Load signals of the server behind cursor: threads running and row lock
+    waits in progress.
+    """
+    cursor.execute(
+        "SHOW GLOBAL STATUS WHERE Variable_name IN "
+        "('Threads_running', 'Innodb_row_lock_current_waits')"
+    )
+    status = {name.lower(): int(value) for name, value in cursor.fetchall()}
+    return {
+        "threads_running": status.get("threads_running"),
+        "lock_waits": status.get("innodb_row_lock_current_waits"),
+    }
+
+
+def _replica_lag(cursor):
+    """
+    Seconds the replica behind cursor lags its source; None when it is not
+    replicating (no replica status, or the SQL/IO thread stopped).
+    """
+    try:
+        cursor.execute("SHOW REPLICA STATUS")
+    except mysql.connector.Error as e:
+        # Before MySQL 8.0.22
+        if e.errno != 1064:
+            raise
+        cursor.execute("SHOW SLAVE STATUS")
+    names = [d[0] for d in cursor.description or ()]
+    rows = cursor.fetchall()
+    if not rows:
+        return None
+    status = dict(zip(names, rows[0]))
+    lag = status.get("Seconds_Behind_Source", status.get("Seconds_Behind_Master"))
+    return None if lag is None else int(lag)
+
+
+class _Throttle:
+    """
+    Pacing of an online-mode job, shared by all its connections: budgets of
+    rows/s and transactions/s (0 for none), and server health checks every
+    `check_interval` seconds on connections of their own. While a signal is
+    over its limit (`limits`: signal -> limit, see _server_health; a
+    "replica_lag" limit applies to each of `replicas`, and a replica that is
+    not replicating counts as over it) the job pauses and checks again every
+    interval; it then resumes at half the budget, which doubles back after
+    each healthy check. A server signal the server does not report (None)
+    is skipped, not taken as over its limit; it is listed in `unavailable`
+    and logged once.
+    pace() is called after each commit, so no locks are held while it sleeps.
+    `stopped()` is polled while sleeping; once true, JobCancelled is raised.
+    """
+
+    def __init__(
+        self,
+        target_db,
+        max_rows=0,
+        max_transactions=0,
+        check_interval=DEFAULT_ONLINE_CHECK_INTERVAL,
+        limits=None,
+        replicas=(),
+        stopped=None,
+    ):
+        self._target_db = target_db
+        self.max_rows = max_rows
+        self.max_transactions = max_transactions
+        self.check_interval = check_interval
+        self.limits = {name: limit for name, limit in (limits or {}).items() if limit}
+        self._replicas = list(replicas)
+        self._stopped = stopped
+        self._factor = 1.0
+        self._ready = 0.0
+        self._next_check = 0.0
+        self._started = time.monotonic()
+        self.rows = 0
+        self.transactions = 0
+        self.throttled_seconds = 0.0
+        self.paused_seconds = 0.0
+        self.pauses = 0
+        # Signal -> pauses it caused
+        self.reasons = {}
+        # Latest signal values, and those over their limit during a pause
+        self.health = {}
+        self.paused = None
+        # Limited signals the server did not report
+        self.unavailable = set()
+        self._lock = threading.Lock()
+        self._check_lock = threading.Lock()
+
+    def _sleep(self, seconds):
+        deadline = time.monotonic() + seconds
+        while True:
+            if self._stopped and self._stopped():
+                raise JobCancelled()
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return
+            time.sleep(min(left, 0.5))
+
+    def pace(self, rows=0, transactions=1):
+        """
+        Account for a committed transaction of `rows` rows; sleeps as long as
+        the budgets require, and through a pause the health checks call for.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.rows += rows
+            self.transactions += transactions
+            cost = max(
+                rows / self.max_rows if self.max_rows else 0.0,
+                transactions / self.max_transactions if self.max_transactions else 0.0,
+            )
+            self._ready = (
+                max(self._ready, now - THROTTLE_BURST_SECONDS) + cost / self._factor
+            )
+            delay = self._ready - now
+        if delay > 0:
+            self._sleep(delay)
+            with self._lock:
+                self.throttled_seconds += delay
+        if time.monotonic() >= self._next_check:
+            self.check()
+
+    def _read_health(self):
+        health = {}
+        conn = get_connection(self._target_db)
+        cursor = conn.cursor()
+        try:
+            health.update(_server_health(cursor))
+        finally:
+            cursor.close()
+            release_connection(self._target_db, conn)
+        if "replica_lag" in self.limits:
+            lags = []
+            for replica in self._replicas:
+                conn = get_connection(replica)
+                cursor = conn.cursor()
+                try:
+                    lags.append(_replica_lag(cursor))
+                finally:
+                    cursor.close()
+                    release_connection(replica, conn)
+            if lags:
+                # A replica that is not replicating counts as too far behind
+                health["replica_lag"] = None if None in lags else max(lags)
+        return health
+
+    def _over(self, health):
+        over = {}
+        for name, limit in self.limits.items():
+            if name not in health:
+                continue
+            value = health[name]
+            if value is None and name != "replica_lag":
+                if name not in self.unavailable:
+                    with self._lock:
+                        self.unavailable.add(name)
+                    online_log.warning(
+                        "server did not report %s; its limit is not applied", name
+                    )
+                continue
+            if value is None or value > limit:
+                over[name] = value
+        return over
+
+    def check(self):
+        """
+        Read the health signals; pause while any is over its limit.
+        """
+        with self._check_lock:
+            if time.monotonic() < self._next_check:
+                return
+            paused = False
+            while True:
+                health = self._read_health()
+                over = self._over(health)
+                with self._lock:
+                    self.health = health
+                    self.paused = over or None
+                    if not over:
+                        if not paused:
+                            self._factor = min(1.0, self._factor * 2)
+                        break
+                    if not paused:
+                        self.pauses += 1
+                        for name in over:
+                            self.reasons[name] = self.reasons.get(name, 0) + 1
+                    self._factor = max(THROTTLE_MIN_FACTOR, self._factor / 2)
+                paused = True
+                started = time.monotonic()
+                try:
+                    self._sleep(self.check_interval)
+                finally:
+                    with self._lock:
+                        self.paused_seconds += time.monotonic() - started
+            self._next_check = time.monotonic() + self.check_interval
+
+    def summary(self):
+        with self._lock:
+            seconds = time.monotonic() - self._started
+            return {
+                "max_rows_per_sec": self.max_rows,
+                "max_transactions_per_sec": self.max_transactions,
+                "limits": dict(self.limits),
+                "rows": self.rows,
+                "transactions": self.transactions,
+                "seconds": round(seconds, 2),
+                "rows_per_sec": round(self.rows / seconds, 1) if seconds > 0 else 0.0,
+                "throttled_seconds": round(self.throttled_seconds, 2),
+                "paused_seconds": round(self.paused_seconds, 2),
+                "pauses": self.pauses,
+                "reasons": dict(self.reasons),
+                "rate_factor": self._factor,
+                "health": dict(self.health),
+                "paused": dict(self.paused) if self.paused else None,
+                "unavailable": sorted(self.unavailable),
+            }
+
+
+def _online_throttle(target_db, stats=None, stopped=None):
+    """
+    The _Throttle of a job against target_db when its `online` mode is on
+    (budgets online_max_rows_per_sec / online_max_txn_per_sec, limits
+    online_max_threads_running / online_max_lock_waits /
+    online_max_replica_lag, replicas from online_replicas), else None.
+    Replica entries default to target_db's connection settings.
+    """
+    if not target_db.get("online"):
+        return None
+    connection = {
+        k: target_db.get(k) for k in ("host", "port", "user", "password", "database")
+    }
+    throttle = _Throttle(
+        target_db,
+        float(target_db.get("online_max_rows_per_sec", 0)),
+        float(target_db.get("online_max_txn_per_sec", 0)),
+        float(target_db.get("online_check_interval", DEFAULT_ONLINE_CHECK_INTERVAL)),
+        {
+            "threads_running": target_db.get("online_max_threads_running"),
+            "lock_waits": target_db.get("online_max_lock_waits"),
+            "replica_lag": target_db.get("online_max_replica_lag"),
+        },
+        [dict(connection, **r) for r in target_db.get("online_replicas") or []],
+        stopped,
+    )
+    if stats is not None:
+        stats.throttle = throttle
+    return throttle
+
+
+def _is_size_error(exc):
+    return isinstance(exc, mysql.connector.Error) and exc.errno in TXN_SIZE_ERRNOS
+
+
+def _apply_in_parts(rows, apply, rollback, sizer):
+    """
+    apply(rows) as one transaction (apply commits it). Should the server
+    reject it as too large, roll back, tell `sizer` and apply each half in
+    turn instead, down to single rows. Returns the sum of apply's results.
+    """
+    try:
+        return apply(rows)
+    except mysql.connector.Error as e:
+        if not _is_size_error(e) or len(rows) < 2:
+            raise
+    rollback()
+    sizer.too_large(len(rows))
+    half = len(rows) // 2
+    first = _apply_in_parts(rows[:half], apply, rollback, sizer)
+    return first + _apply_in_parts(rows[half:], apply, rollback, sizer)
+
+
+def _stream_rows(cursor, size=STREAM_FETCH_ROWS):
+    """
+    The rows of the cursor's current result set in lists of at most `size`.
+    Pooled connections use unbuffered cursors, so rows are read from the
+    server as they are consumed and a match of any size never sits in memory
+    at once. Consume all of it before the next statement on the connection.
+    """
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield rows
+
+
+def _replayed(rows, replay, since=None):
+    """
+    The matched records [(row_id, name, new_name, ...)] split into (rows to
+    change, rows to log) by `replay` (see _replay_filter); all of them both
+    ways outside a resumed batch.
+    """
+    if replay is None or not rows:
+        return rows, rows
+    return replay(rows, since)
+
+
+class _PreparedStatements:
+    """
+    Server-side prepared statements on one connection, executed with the
+    binary protocol: one prepared cursor per statement, so each statement is
+    parsed by the server once per connection rather than once per call.
+    A prepared cursor re-prepares whenever it is handed a different string
+    object, so statements are passed back exactly as first given.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._cursors = {}  # sql -> (cursor, the sql object it was prepared with)
+
+    def execute(self, sql, params):
+        """
+        Run `sql` on its prepared cursor; returns the cursor for its results.
+        """
+        entry = self._cursors.get(sql)
+        if entry is None:
+            entry = self._cursors[sql] = (self._conn.cursor(prepared=True), sql)
+        cursor, prepared_sql = entry
+        cursor.execute(prepared_sql, params)
+        return cursor
+
+    def close(self):
+        for cursor, _sql in self._cursors.values():
+            cursor.close()
+        self._cursors.clear()
+
+
+def _run_batch_rowwise(
+    conn_target,
+    log_writer,
+    idents,
+    batch_id,
+    mapping,
+    commit_every=1,
+    on_progress=None,
+    checkpoint=None,
+    replay=None,
+    prepared=False,
+    sizer=None,
+    throttle=None,
+):
+    """
+    Apply the mapping one row at a time: SELECT, log and UPDATE per row, with a
+    target commit every `commit_every` rows (after the log writer has synced),
+    or as many as `sizer` (a _ChunkSizer timing each commit group) says.
+    Each commit is paced by `throttle` (a _Throttle, in online mode).
+    After each commit the last seq done is checkpointed under the action
+    `checkpoint` (if given). A resumed batch passes `replay` (see
+    _replay_filter); when it holds back some of a row's records, the others
+    are updated one by one by ID.
+    With prepared=True the statements run as server-side prepared statements
+    (see _PreparedStatements) instead of being sent as text for every row.
+    Returns (logged_rows, replaced_rows).
+    """
+    cursor_target = conn_target.cursor()
+    statements = _PreparedStatements(conn_target) if prepared else None
+    table = idents["table"]
+    column = idents["column"]
+    id_column = idents["id_column"]
+    # Built once per match column, so a prepared statement is reused as is
+    select_by = {
+        match: f"SELECT `{id_column}`, `{column}` FROM `{table}` WHERE `{match}` = %s"
+        for match in (id_column, column)
+    }
+    update_by = {
+        match: f"UPDATE `{table}` SET `{column}` = %s WHERE `{match}` = %s"
+        for match in (id_column, column)
+    }
+
+    def run(sql, params):
+        if statements is not None:
+            return statements.execute(sql, params)
+        cursor_target.execute(sql, params)
+        return cursor_target
+
+    sizer = sizer or _ChunkSizer(commit_every)
+    total_logged_rows = 0
+    total_replaced_count = 0
+    done = 0
+    pending = 0
+    replaced_before = 0
+    seq = None
+    started = time.perf_counter()
+    try:
+        for seq, kind, key, new_name in mapping:
+            match_column = id_column if kind == "id" else column
+
+            cursor = run(select_by[match_column], (key,))
+            changed = []
+            held = False
+            for rows in _stream_rows(cursor):
+                rows = [(r[0], r[1], new_name, seq) for r in rows]
+                change, log = _replayed(rows, replay)
+                if replay:
+                    changed.extend(change)
+                    held = held or len(change) < len(rows)
+                log_writer.put(
+                    [(batch_id, str(r[0]), r[1], new_name, _now_str()) for r in log]
+                )
+                total_logged_rows += len(log)
+
+            if held:
+                for r in changed:
+                    cursor = run(update_by[id_column], (new_name, r[0]))
+                    total_replaced_count += cursor.rowcount
+            else:
+                cursor = run(update_by[match_column], (new_name, key))
+                total_replaced_count += cursor.rowcount
+
+            done += 1
+            pending += 1
+            if pending >= sizer.size():
+                log_writer.sync()
+                conn_target.commit()
+                sizer.observe(pending, time.perf_counter() - started)
+                if throttle:
+                    throttle.pace(total_replaced_count - replaced_before)
+                    replaced_before = total_replaced_count
+                pending = 0
+                started = time.perf_counter()
+                if checkpoint:
+                    log_writer.checkpoint(
+                        batch_id, checkpoint, seq, done, total_replaced_count
+                    )
+                if on_progress:
+                    on_progress(done)
+        log_writer.sync()
+        conn_target.commit()
+        if checkpoint and seq is not None:
+            log_writer.checkpoint(batch_id, checkpoint, seq, done, total_replaced_count)
+        if on_progress:
+            on_progress(done)
+    finally:
+        if statements is not None:
+            statements.close()
+        cursor_target.close()
+    return total_logged_rows, total_replaced_count
+
+
+def _run_batch_bulk(
+    conn_target,
+    log_writer,
+    idents,
+    batch_id,
+    mapping,
+    chunk_size,
+    on_progress=None,
+    checkpoint=None,
+    replay=None,
+    sizer=None,
+    name_scan=0,
+    scan_from=None,
+    throttle=None,
+    scan_key=str,
+    conflict_keys=None,
+):
+    """
+    Apply the mapping set-based: load each chunk into a temporary staging table
+    on the target DB, snapshot the matched rows with one SELECT ... JOIN, hand
+    them to the log writer, then update them with one UPDATE ... JOIN while the
+    log is being written. The chunk commits once its log rows are durable.
+    Chunks hold up to chunk_size rows, or as many as `sizer` (a _ChunkSizer)
+    says; a chunk the server rejects as too large is updated in parts.
+    `checkpoint`, `replay` and `throttle` work as in _run_batch_rowwise; a
+    chunk whose records replay holds back in part stages the others by ID.
+
+    With name_scan (rows per page; needs a unique id_column), each run of
+    consecutive name rows is matched by one scan of the target table (see
+    _scan_name_matches) rather than by joining on the name column, and the
+    records found are staged by ID, along with the name they were read with so
+    a record renamed in the meantime is left alone. Its rows are checkpointed
+    as done once the scan ends. With integer ids, the last id committed is
+    also checkpointed as "scan/<checkpoint>" (last_id = that id,
+    processed_rows = first seq of the rows scanned for), and a resumed batch
+    passes it back as scan_from so the scan picks up there. scan_key compares
+    names the way the name column's collation does (see _scan_match_key), and
+    conflict_keys keeps colliding keys in separate chunks (see _plan_chunks).
+    Returns (logged_rows, replaced_rows), same as _run_batch_rowwise.
+    """
+    cursor_target = conn_target.cursor()
+    table = idents["table"]
+    column = idents["column"]
+    id_column = idents["id_column"]
+    stage = f"am_stage_{secrets.token_hex(4)}"
+    stage_insert = (
+        f"INSERT INTO `{stage}` (seq, id_key, name_key, new_name) "
+        "VALUES (%s, %s, %s, %s)"
+    )
+    joins = {
+        "id": f"t.`{id_column}` = s.id_key",
+        "name": f"t.`{column}` = s.name_key",
+        "scan": f"t.`{id_column}` = s.id_key AND t.`{column}` = s.name_key",
+    }
+    sizer = sizer or _ChunkSizer(chunk_size)
+    total_logged_rows = 0
+    total_replaced_count = 0
+    done = 0
+    # Whether the chunk's staged rows are in the open transaction or committed
+    staged = committed = False
+    # Staging seqs of scanned records, counting down from -1 so they never
+    # meet mapping seqs
+    scan_seq = 0
+
+    def rollback():
+        nonlocal staged
+        conn_target.rollback()
+        # Rolling back takes the staged rows along, unless a part committed them
+        staged = committed
+
+    def apply(part):
+        nonlocal staged, committed
+        for attempt in _lock_retrying(sizer):
+            with attempt:
+                if attempt.retry_state.attempt_number > 1:
+                    rollback()
+                if not staged:
+                    cursor_target.executemany(stage_insert, stage_rows)
+                    staged = True
+                cursor_target.execute(
+                    f"UPDATE `{table}` AS t JOIN `{stage}` AS s ON {join} "
+                    f"SET t.`{column}` = s.new_name "
+                    "WHERE s.seq BETWEEN %s AND %s",
+                    (part[0][0], part[-1][0]),
+                )
+                replaced = cursor_target.rowcount
+                log_writer.sync()
+                conn_target.commit()
+                committed = True
+        return replaced
+
+    def run_chunk(kind, chunk, rows, since=None):
+        # Stage the chunk's rows, log the records they match and update them
+        nonlocal stage_rows, join, staged, committed, total_logged_rows, scan_seq
+        started = time.perf_counter()
+        stage_rows = rows
+        join = joins[kind]
+        cursor_target.executemany(stage_insert, stage_rows)
+        staged, committed = True, False
+        cursor_target.execute(
+            f"SELECT t.`{id_column}`, t.`{column}`, s.new_name, s.seq "
+            f"FROM `{stage}` AS s JOIN `{table}` AS t ON {join} "
+            "WHERE s.seq BETWEEN %s AND %s ORDER BY s.seq",
+            (chunk[0][0], chunk[-1][0]),
+        )
+        now = _now_str()
+        changed = []
+        held = False
+        for found in _stream_rows(cursor_target):
+            change, log = _replayed(found, replay, since)
+            if replay:
+                changed.extend(change)
+                held = held or len(change) < len(found)
+            log_writer.put([(batch_id, str(r[0]), r[1], r[2], now) for r in log])
+            total_logged_rows += len(log)
+        if held:
+            if not changed:
+                rollback()
+                return 0
+            # Stage the records left to change by ID and name instead
+            scan_seq -= len(changed)
+            chunk = [(scan_seq + i, "scan", r[0], r[2]) for i, r in enumerate(changed)]
+            stage_rows = [
+                (scan_seq + i, r[0], r[1], r[2]) for i, r in enumerate(changed)
+            ]
+            join = joins["scan"]
+            cursor_target.executemany(stage_insert, stage_rows)
+        replaced = _apply_in_parts(chunk, apply, rollback, sizer)
+        sizer.observe(len(chunk), time.perf_counter() - started)
+        if throttle:
+            throttle.pace(replaced)
+        return replaced
+
+    def report(last_seq, progress):
+        if checkpoint:
+            log_writer.checkpoint(
+                batch_id, checkpoint, last_seq, done, total_replaced_count
+            )
+        if on_progress:
+            on_progress(progress)
+
+    stage_rows = join = None
+    try:
+        # Copy the key/name column types (and collations) from the target
+        # table, so the JOINs compare like with like and can use its indexes.
+        # The LEFT JOIN makes the copied columns nullable.
+        cursor_target.execute(
+            f"CREATE TEMPORARY TABLE `{stage}` (seq INT NOT NULL PRIMARY KEY) "
+            f"SELECT t.`{id_column}` AS id_key, t.`{column}` AS name_key, "
+            f"t.`{column}` AS new_name "
+            f"FROM (SELECT 1) AS d LEFT JOIN `{table}` AS t ON 1 = 0"
+        )
+        for kind, segment in itertools.groupby(mapping, key=lambda item: item[1]):
+            if kind == "name" and name_scan:
+                segment = list(segment)
+                # Every row before the segment is done
+                before = segment[0][0] - 1
+                after = None
+                if scan_from and scan_from[1] == segment[0][0]:
+                    after = scan_from[0]
+                for matches, scanned in _scan_name_matches(
+                    cursor_target,
+                    idents,
+                    segment,
+                    name_scan,
+                    sizer.size,
+                    after,
+                    scan_key,
+                ):
+                    scan_seq -= len(matches)
+                    chunk = [
+                        (scan_seq + i, "scan", row_id, new_name)
+                        for i, (row_id, _name, new_name) in enumerate(matches)
+                    ]
+                    total_replaced_count += run_chunk(
+                        "scan",
+                        chunk,
+                        [
+                            (scan_seq + i, row_id, name, new_name)
+                            for i, (row_id, name, new_name) in enumerate(matches)
+                        ],
+                        since=segment[0][0],
+                    )
+                    if checkpoint and scanned is not None:
+                        log_writer.checkpoint(
+                            batch_id,
+                            f"scan/{checkpoint}",
+                            matches[-1][0],
+                            segment[0][0],
+                            0,
+                        )
+                    part = int(len(segment) * scanned) if scanned is not None else 0
+                    report(before, done + min(part, len(segment) - 1))
+                done += len(segment)
+                report(segment[-1][0], done)
+                continue
+            for kind, chunk in _plan_chunks(segment, sizer.size, conflict_keys):
+                total_replaced_count += run_chunk(
+                    kind,
+                    chunk,
+                    [
+                        (
+                            seq,
+                            key if item_kind == "id" else None,
+                            key if item_kind == "name" else None,
+                            new_name,
+                        )
+                        for seq, item_kind, key, new_name in chunk
+                    ],
+                )
+                done += len(chunk)
+                report(chunk[-1][0], done)
+    finally:
+        try:
+            cursor_target.execute(f"DROP TEMPORARY TABLE IF EXISTS `{stage}`")
+        except mysql.connector.Error:
+            pass
+        cursor_target.close()
+    return total_logged_rows, total_replaced_count
+
+
+def _plan_shards(mapping, workers, keys=None):
+    """
+    Decide how to spread mapping rows over `workers` shards so that shards
+    never touch the same target rows and can run concurrently.
+    Returns shard_of(item) -> int, or None when the mapping mixes ID and name
+    keys (an ID row and a name row may hit the same record), in which case
+    it must run serially.
+
+    ID rows shard by key. Name rows are grouped with every row their key or
+    new name collides with (A -> B, B -> C ...), so ordered chains stay in
+    one shard. Keys collide when `keys` ({"id": key, "name": key}, see
+    _conflict_keys) gives them the same value; _loose_key when not given.
+    """
+    keys = keys or {"id": _loose_key, "name": _loose_key}
+    name_key = keys["name"]
+    kinds = set()
+    parent = {}
+
+    def find(x):
+        root = parent.setdefault(x, x)
+        while root != parent[root]:
+            root = parent[root]
+        while x != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    for _seq, kind, key, new_name in mapping:
+        kinds.add(kind)
+        if kind == "name":
+            a, b = find(name_key(key)), find(name_key(new_name))
+            if a != b:
+                parent[a] = b
+    if len(kinds) > 1:
+        return None
+
+    def shard_of(item):
+        _seq, kind, key, _new_name = item
+        root = find(name_key(key)) if kind == "name" else keys["id"](key)
+        return zlib.crc32(root.encode("utf-8")) % workers
+
+    return shard_of
+
+
+class _ShardStopped(Exception):
+    """
+    Raised inside a shard worker once another shard failed or was cancelled.
+    """
+
+
+def _run_batch_parallel(
+    target_db,
+    main_db,
+    idents,
+    batch_id,
+    mapping_source,
+    shard_of,
+    chunk_size,
+    workers,
+    on_progress=None,
+    stats=None,
+    replay=None,
+    end_seq=None,
+    checkpoints=None,
+    target=None,
+    throttle=None,
+    conflict_keys=None,
+):
+    """
+    Run _run_batch_bulk on `workers` shards at once, each on its own pair of
+    pooled connections. Rows are routed by shard_of (see _plan_shards) to
+    per-shard bounded queues as the mapping streams in. Shard i checkpoints
+    under the action checkpoints[i]; a shard that runs out of rows
+    checkpoints `end_seq`, so it does not hold back where a resumed batch
+    starts. `target` labels the detail rows of a multi-target plan. All shards
+    share `throttle`; conflict_keys is passed on to _run_batch_bulk.
+    Returns the summed (logged_rows, replaced_rows).
+    """
+    queues = [queue.Queue(maxsize=max(1, chunk_size) * 2) for _ in range(workers)]
+    stop = threading.Event()
+    # Set once every row was routed to its shard
+    fed = threading.Event()
+    lock = threading.Lock()
+    shard_done = [0] * workers
+
+    def shard_rows(shard):
+        while True:
+            item = queues[shard].get()
+            if item is None:
+                return
+            if stop.is_set():
+                raise _ShardStopped()
+            yield item
+
+    def shard_progress(shard, done):
+        with lock:
+            shard_done[shard] = done
+            total = sum(shard_done)
+        if stop.is_set():
+            raise _ShardStopped()
+        if on_progress:
+            on_progress(total)
+
+    def run_shard(shard):
+        conn_target = instrument(get_connection(target_db), "target", stats)
+        action = checkpoints[shard] if checkpoints else None
+        sizer = _chunk_sizer(target_db, chunk_size, stats, action)
+        try:
+            with _detail_log_writer(
+                main_db, idents["log_detail_table"], stats, target
+            ) as writer:
+                counts = _run_batch_bulk(
+                    conn_target,
+                    writer,
+                    idents,
+                    batch_id,
+                    shard_rows(shard),
+                    chunk_size,
+                    on_progress=lambda done: shard_progress(shard, done),
+                    checkpoint=action,
+                    replay=replay,
+                    sizer=sizer,
+                    throttle=throttle,
+                    conflict_keys=conflict_keys,
+                )
+                if action and end_seq is not None and fed.is_set():
+                    writer.checkpoint(
+                        batch_id, action, end_seq, shard_done[shard], counts[1]
+                    )
+                return counts
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            release_connection(target_db, conn_target)
+
+    def put(shard, item):
+        # Give up once the shard's worker has stopped consuming
+        while not futures[shard].done():
+            try:
+                queues[shard].put(item, timeout=0.2)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    with ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="anti-masking-shard"
+    ) as executor:
+        futures = [executor.submit(run_shard, shard) for shard in range(workers)]
+        try:
+            for item in mapping_source():
+                if stop.is_set():
+                    break
+                put(shard_of(item), item)
+            else:
+                fed.set()
+        finally:
+            for shard in range(workers):
+                put(shard, None)
+
+    errors = [f.exception() for f in futures if f.exception() is not None]
+    if errors:
+        # Report the root cause rather than the shards it stopped
+        real = [e for e in errors if not isinstance(e, _ShardStopped)]
+        raise (real or errors)[0]
+    results = [f.result() for f in futures]
+    return sum(r[0] for r in results), sum(r[1] for r in results)
+
+
+def _load_checkpoint(cursor, checkpoint_table, batch_id, action):
+    """
+    Return (last_id, processed_rows, changed_rows) or None.
+    """
+    if not checkpoint_table:
+        return None
+    cursor.execute(
+        f"SELECT last_id, processed_rows, changed_rows FROM `{checkpoint_table}` "
+        "WHERE batch_id = %s AND action = %s",
+        (batch_id, action),
+    )
+    return cursor.fetchone()
+
+
+def _save_checkpoint(
+    cursor, checkpoint_table, batch_id, action, last_id, processed_rows, changed_rows
+):
+    if not checkpoint_table:
+        return
+    cursor.execute(
+        f"INSERT INTO `{checkpoint_table}` "
+        "(batch_id, action, last_id, processed_rows, changed_rows, updated_at) "
+        "VALUES (%s, %s, %s, %s, %s, %s) "
+        "ON DUPLICATE KEY UPDATE last_id = VALUES(last_id), "
+        "processed_rows = VALUES(processed_rows), "
+        "changed_rows = VALUES(changed_rows), updated_at = VALUES(updated_at)",
+        (batch_id, action, last_id, processed_rows, changed_rows, _now_str()),
+    )
+
+
+def _detail_pages(cursor, select, log_detail_table, batch_id, before_id, size):
+    """
+    A batch's detail rows (`select` columns, id first), newest first, in pages
+    of `size` (an int, or a function giving the size of the next page) read
+    one keyset-paginated query at a time as they are consumed,
+    starting below detail id before_id (None for the newest). Each page is
+    read in full, so the cursor's connection is free between pages.
+    """
+    size_of = size if callable(size) else lambda: size
+    while True:
+        if before_id is None:
+            cursor.execute(
+                f"{select} FROM `{log_detail_table}` "
+                "WHERE batch_id = %s ORDER BY id DESC LIMIT %s",
+                (batch_id, size_of()),
+            )
+        else:
+            cursor.execute(
+                f"{select} FROM `{log_detail_table}` "
+                "WHERE batch_id = %s AND id < %s ORDER BY id DESC LIMIT %s",
+                (batch_id, before_id, size_of()),
+            )
+        rows = cursor.fetchall()
+        if not rows:
+            return
+        yield rows
+        before_id = rows[-1][0]
+
+
+def _chunk_pages(cursor, chunk_table, batch_id, before_id, size, with_target):
+    """
+    _detail_pages for a batch in the compact detail log: rows (id, row_id,
+    old_name[, target]) newest first, one chunk read at a time and cut into
+    pages of `size` (an int or a function). A row's id is its chunk's id on
+    the chunk's last page and one more before that, so paging resumed below
+    the last id seen redoes an unfinished chunk from its newest row.
+    """
+    size_of = size if callable(size) else lambda: size
+    for chunk_id, label, rows in _detail_chunks(
+        cursor,
+        chunk_table,
+        batch_id,
+        ("row_id", "old_name"),
+        before_id,
+        descending=True,
+    ):
+        rows.reverse()
+        extra = (label,) if with_target else ()
+        start = 0
+        while start < len(rows):
+            end = start + size_of()
+            page_id = chunk_id if end >= len(rows) else chunk_id + 1
+            yield [(page_id, *row, *extra) for row in rows[start:end]]
+            start = end
+
+
+def _restore_row_state(cursor, row_state_table, batch_id, label, names):
+    """
+    Set the current names ({row_id: name}) of the row-state records that
+    batch_id changed last; records changed since by a later batch keep theirs.
+    """
+    cases = " ".join(["WHEN %s THEN %s"] * len(names))
+    placeholders = ", ".join(["%s"] * len(names))
+    cursor.execute(
+        f"UPDATE `{row_state_table}` SET current_name = "
+        f"CASE row_id {cases} ELSE current_name END, updated_at = %s "
+        f"WHERE target = %s AND batch_id = %s AND row_id IN ({placeholders})",
+        (
+            *(v for pair in names.items() for v in pair),
+            _now_str(),
+            label or "",
+            batch_id,
+            *names.keys(),
+        ),
+    )
+
+
+def _run_rollback_bulk(
+    conn_target,
+    conn_main,
+    idents,
+    batch_id,
+    chunk_size,
+    on_progress=None,
+    sizer=None,
+    throttle=None,
+):
+    """
+    Restore the old names of a batch, one chunk of detail rows per transaction.
+
+    Detail rows are read by keyset pagination on `id`, newest first, so when a
+    row was changed several times within the batch the oldest name is written
+    last. Each chunk becomes a single UPDATE ... SET col = CASE ... END. After
+    every committed chunk a checkpoint (when `checkpoint_table` is configured)
+    records the lowest detail id done, so an interrupted rollback resumes there.
+    Re-running a chunk is harmless: it writes the same values again.
+    Chunks hold chunk_size rows, or as many as `sizer` (a _ChunkSizer) says;
+    a chunk the server rejects as too large is restored in parts. Each chunk
+    is paced by `throttle` (a _Throttle, in online mode).
+    With a multi-target plan (idents["targets"]: label -> idents), detail rows
+    are restored into the target they name; rows without one belong to the
+    first target.
+    With a row-state table (idents["row_state_table"]), the restored names
+    become the current names of the records still last changed by the batch,
+    in the transaction of the chunk's checkpoint.
+    A batch logged to the compact detail log (idents["log_chunk_table"]) is
+    read from its chunks instead (see _chunk_pages), checkpointed by chunk id.
+    Returns (processed_rows, changed_rows, merged_rows): merged_rows counts
+    detail rows folded into a newer-read row of the same record within a
+    chunk (checkpointed as "rollback/merged"), so processed_rows minus the
+    other two is the detail rows whose record was not changed (deleted, or
+    already holding the old name).
+    """
+    cursor_target = conn_target.cursor()
+    cursor_main = conn_main.cursor()
+    targets = idents.get("targets")
+    detail_table = idents["log_detail_table"]
+    chunk_table = idents.get("log_chunk_table")
+    checkpoint_table = idents.get("checkpoint_table")
+    row_state_table = idents.get("row_state_table")
+    sizer = sizer or _ChunkSizer(chunk_size)
+    select = (
+        "SELECT id, row_id, old_name, target"
+        if targets
+        else ("SELECT id, row_id, old_name")
+    )
+
+    def restore_of(rows):
+        # Newest first, so the oldest old_name of a repeated row_id wins
+        restore = {}
+        for _id, row_id, old_name, *label in rows:
+            restore.setdefault(label[0] if label else None, {})[row_id] = old_name
+        return restore
+
+    def apply(rows):
+        updates = []
+        restore = restore_of(rows)
+        for label, names in restore.items():
+            target = targets.get(label or next(iter(targets))) if targets else idents
+            if target is None:
+                raise ValueError(
+                    f"日志明细中的目标 `{label}` 不在当前环境的替换计划中。"
+                )
+            column, id_column = target["column"], target["id_column"]
+            cases = " ".join(["WHEN %s THEN %s"] * len(names))
+            placeholders = ", ".join(["%s"] * len(names))
+            params = [v for pair in names.items() for v in pair]
+            params.extend(names.keys())
+            updates.append(
+                (
+                    f"UPDATE `{target['table']}` SET `{column}` = "
+                    f"CASE `{id_column}` {cases} ELSE `{column}` END "
+                    f"WHERE `{id_column}` IN ({placeholders})",
+                    tuple(params),
+                )
+            )
+        for attempt in _lock_retrying(sizer):
+            with attempt:
+                if attempt.retry_state.attempt_number > 1:
+                    conn_target.rollback()
+                changed = 0
+                for query, params in updates:
+                    cursor_target.execute(query, params)
+                    changed += cursor_target.rowcount
+                conn_target.commit()
+        merged[0] += len(rows) - sum(len(names) for names in restore.values())
+        return changed
+
+    try:
+        checkpoint = _load_checkpoint(
+            cursor_main, checkpoint_table, batch_id, "rollback"
+        )
+        last_id, processed_rows, changed_rows = checkpoint or (None, 0, 0)
+        # Counted once a part of a chunk commits (a part may be retried)
+        merged = [0]
+        if checkpoint:
+            merged_checkpoint = _load_checkpoint(
+                cursor_main, checkpoint_table, batch_id, "rollback/merged"
+            )
+            merged[0] = merged_checkpoint[1] if merged_checkpoint else 0
+        if _has_chunks(cursor_main, chunk_table, batch_id):
+            pages = _chunk_pages(
+                cursor_main, chunk_table, batch_id, last_id, sizer.size, bool(targets)
+            )
+        else:
+            pages = _detail_pages(
+                cursor_main, select, detail_table, batch_id, last_id, sizer.size
+            )
+        for rows in pages:
+            started = time.perf_counter()
+            # Older rows of a split chunk are restored last, as in one piece
+            changed = _apply_in_parts(rows, apply, conn_target.rollback, sizer)
+            sizer.observe(len(rows), time.perf_counter() - started)
+            if throttle:
+                throttle.pace(changed)
+
+            last_id = rows[-1][0]
+            processed_rows += len(rows)
+            changed_rows += changed
+            if row_state_table:
+                for label, names in restore_of(rows).items():
+                    _restore_row_state(
+                        cursor_main, row_state_table, batch_id, label, names
+                    )
+            _save_checkpoint(
+                cursor_main,
+                checkpoint_table,
+                batch_id,
+                "rollback",
+                last_id,
+                processed_rows,
+                changed_rows,
+            )
+            _save_checkpoint(
+                cursor_main,
+                checkpoint_table,
+                batch_id,
+                "rollback/merged",
+                last_id,
+                merged[0],
+                0,
+            )
+            conn_main.commit()
+            if on_progress:
+                on_progress(processed_rows)
+    finally:
+        cursor_target.close()
+        cursor_main.close()
+    return processed_rows, changed_rows, merged[0]
+
+
+class JobCancelled(Exception):
+    """
+    Raised from a job's progress callback to stop it between chunks.
+    """
+
+
+class Job:
+    """
+    A replacement or rollback running on the job runner.
+    Progress lives here so any session can poll it; the outcome is also
+    written to the batch's row in the main DB log table.
+    """
+
+    def __init__(self, job_id, kind, env_name, operator, total, batch_id=None):
+        self.job_id = job_id
+        self.kind = kind
+        self.env_name = env_name
+        self.operator = operator
+        self.batch_id = batch_id or job_id
+        self.total = total
+        self.processed = 0
+        self.status = "queued"
+        self.message = ""
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        # RunStats of the run, set by the job body once it starts
+        self.stats = None
+        # Counts of a finished batch ({"replaced", "logged"}), see execute_batch
+        self.result = None
+        self._cancel = threading.Event()
+        # Set by the job runner while the job waits in its queue
+        self._on_cancel = None
+
+    def cancel(self):
+        self._cancel.set()
+        on_cancel = self._on_cancel
+        if on_cancel is not None:
+            on_cancel(self)
+
+    @property
+    def cancel_requested(self):
+        return self._cancel.is_set()
+
+    @property
+    def active(self):
+        return self.status in ("queued", "running")
+
+    def report(self, processed):
+        """
+        Progress callback for the engines; raises once cancel was requested.
+        """
+        self.processed = processed
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def snapshot(self):
+        now = self.finished_at or time.time()
+        elapsed = now - self.started_at if self.started_at else 0.0
+        rate = self.processed / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if self.status == "running" and rate > 0 and self.total:
+            eta = max(self.total - self.processed, 0) / rate
+        return {
+            "processed": self.processed,
+            "total": self.total,
+            "elapsed": elapsed,
+            "rate": rate,
+            "eta": eta,
+        }
+
+
+class _JobRunner:
+    """
+    Runs jobs on threads of their own, off the Streamlit script thread, so
+    they survive the browser session that started them. Each environment has
+    a queue: a job starts once fewer than `env_limit` jobs of its environment
+    and fewer than `max_workers` jobs overall are running, oldest first;
+    until then it waits in "queued" without holding a thread. A `reserved`
+    job brings its own slot and only waits for its environment.
+    """
+
+    def __init__(self, max_workers):
+        self._max_workers = max(1, max_workers)
+        self._lock = threading.Lock()
+        self._jobs = {}
+        # env -> deque of (job, fn, args, reserved) waiting, and running
+        # jobs / limit
+        self._queues = {}
+        self._env_running = {}
+        self._env_limits = {}
+        # Running jobs that took one of the max_workers slots
+        self._running = 0
+
+    @property
+    def max_workers(self):
+        return self._max_workers
+
+    def set_max_workers(self, max_workers):
+        """
+        Change the number of jobs run at once; queued jobs start if it grew.
+        Running jobs are never stopped when it shrinks.
+        """
+        with self._lock:
+            self._max_workers = max(1, max_workers)
+            self._dispatch()
+
+    def submit(self, job, env_limit, fn, *args, reserved=False):
+        """
+        Schedule fn(job, *args); its return value becomes job.message.
+        With `reserved`, the job does not count against max_workers (see
+        submit_fan_out).
+        """
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._env_limits[job.env_name] = max(1, env_limit)
+            self._queues.setdefault(job.env_name, collections.deque()).append(
+                (job, fn, args, reserved)
+            )
+            job._on_cancel = self._withdraw
+            self._prune()
+            self._dispatch()
+        return job
+
+    def _dispatch(self):
+        # Start queued jobs while there is room; called with the lock held
+        while True:
+            ready = [
+                waiting[0]
+                for env, waiting in self._queues.items()
+                if waiting
+                and self._env_running.get(env, 0) < self._env_limits[env]
+                and (waiting[0][3] or self._running < self._max_workers)
+            ]
+            if not ready:
+                return
+            job, fn, args, reserved = min(ready, key=lambda item: item[0].created_at)
+            self._queues[job.env_name].popleft()
+            job._on_cancel = None
+            job.started_at = time.time()
+            job.status = "running"
+            if not reserved:
+                self._running += 1
+            self._env_running[job.env_name] = self._env_running.get(job.env_name, 0) + 1
+            threading.Thread(
+                target=self._run,
+                args=(job, fn, args, reserved),
+                name="anti-masking-job",
+                daemon=True,
+            ).start()
+
+    def _withdraw(self, job):
+        # A queued job was cancelled: drop it without starting it
+        with self._lock:
+            waiting = self._queues.get(job.env_name, ())
+            for item in waiting:
+                if item[0] is job:
+                    waiting.remove(item)
+                    job._on_cancel = None
+                    job.status = "cancelled"
+                    job.finished_at = time.time()
+                    break
+
+    def _run(self, job, fn, args, reserved):
+        try:
+            job.message = fn(job, *args) or ""
+            job.status = "done"
+        except JobCancelled:
+            job.status = "cancelled"
+        except Exception as e:
+            job.status = "failed"
+            job.message = str(e)
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                if not reserved:
+                    self._running -= 1
+                self._env_running[job.env_name] -= 1
+                self._dispatch()
+
+    def _prune(self):
+        finished = [j for j in self._jobs.values() if not j.active]
+        for job in finished[: max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job.job_id]
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self):
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda j: -j.created_at)
+
+
+_job_runner = None
+_job_runner_lock = threading.Lock()
+
+
+def get_job_runner():
+    """
+    The process-wide job runner, shared by every session and the CLI. It runs
+    DEFAULT_JOB_WORKERS jobs at once unless config.toml sets [jobs] workers.
+    """
+    global _job_runner
+    with _job_runner_lock:
+        if _job_runner is None:
+            _job_runner = _JobRunner(DEFAULT_JOB_WORKERS)
+        return _job_runner
+
+
+def detached_upload(uploaded_file):
+    """
+    Private copy of an upload for a job, so the page can keep reading
+    (and seeking) the original while the job streams the copy. The copy is
+    spooled to a temporary file with the upload's extension, removed once
+    the job lets go of it, rather than held in memory a second time.
+    """
+    upload = tempfile.NamedTemporaryFile(suffix=os.path.splitext(uploaded_file.name)[1])
+    position = uploaded_file.tell()
+    uploaded_file.seek(0)
+    shutil.copyfileobj(uploaded_file, upload)
+    uploaded_file.seek(position)
+    upload.seek(0)
+    return upload
+
+
+def execute_single(target_db, main_db, env_name, operator, id_val, name_a, name_b):
+    """
+    Replace the records matching one ID (or, without an ID, one name) in
+    every plan target and log them as a batch of mode "single".
+    Returns (matched rows, updated rows), summed over the targets.
+    """
+    log_table, log_detail_table = require_log_config(main_db)
+    targets = plan_targets(target_db)
+    safe_log_table = safe_ident(log_table)
+    safe_log_detail_table = safe_ident(log_detail_table)
+    safe_row_state_table = safe_ident(main_db.get("row_state_table"))
+    chunk_table = safe_ident(main_db.get("log_chunk_table"))
+    key = id_val or name_a
+
+    conn_target = None
+    conn_main = None
+    batch_id = None
+    try:
+        conn_main = get_connection(main_db)
+        conn_target = get_connection(target_db)
+        cursor_main = conn_main.cursor()
+        cursor_target = conn_target.cursor()
+
+        batch_id = new_batch_id()
+        _insert_batch_log(
+            cursor_main, safe_log_table, batch_id, env_name, operator, "single"
+        )
+        conn_main.commit()
+
+        matched = updated = 0
+        for target in targets:
+            idents = _target_idents(target)
+            safe_table = idents["table"]
+            safe_column = idents["column"]
+            safe_id_column = idents["id_column"]
+            where_clause = f"`{safe_id_column if id_val else safe_column}` = %s"
+            select_query = (
+                f"SELECT `{safe_id_column}`, `{safe_column}` "
+                f"FROM `{safe_table}` WHERE {where_clause}"
+            )
+            cursor_target.execute(select_query, (key,))
+            label = target_label(target) if len(targets) > 1 else None
+            for rows in _stream_rows(cursor_target):
+                details = [
+                    (batch_id, str(row[0]), row[1], name_b, _now_str()) for row in rows
+                ]
+                _insert_detail_logs(
+                    cursor_main,
+                    safe_log_detail_table,
+                    batch_id,
+                    details,
+                    label,
+                    chunk_table,
+                    safe_ident(main_db.get("log_chunk_key_table")),
+                )
+                _upsert_row_state(cursor_main, safe_row_state_table, details, label)
+                matched += len(rows)
+            conn_main.commit()
+
+            query = (
+                f"UPDATE `{safe_table}` SET `{safe_column}` = %s WHERE {where_clause}"
+            )
+            cursor_target.execute(query, (name_b, key))
+            conn_target.commit()
+            updated += cursor_target.rowcount
+
+        _update_batch_log(cursor_main, safe_log_table, batch_id, matched, "done")
+        conn_main.commit()
+        return matched, updated
+    except mysql.connector.Error:
+        try:
+            if batch_id and conn_main and conn_main.is_connected():
+                cursor_main = conn_main.cursor()
+                _update_batch_log(cursor_main, safe_log_table, batch_id, 0, "failed")
+                conn_main.commit()
+        except Exception:
+            pass
+        raise
+    finally:
+        if conn_target:
+            cursor_target.close()
+            release_connection(target_db, conn_target)
+        if conn_main:
+            cursor_main.close()
+            release_connection(main_db, conn_main)
+
+
+def _mapping_summary(mapping, labels):
+    """
+    (rows, last seq, fingerprint) of a prepared mapping, in one streaming
+    pass. The fingerprint is a 64-bit digest of the rows and of the plan
+    targets they run against (their labels), as a non-negative signed
+    BIGINT, so a resumed batch can tell it was given the same mapping and
+    plan as its first run. Rows are hashed FINGERPRINT_ROWS at a time.
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    rows = 0
+    last_seq = None
+    buffer = []
+    for seq, kind, key, new_name in mapping:
+        rows += 1
+        last_seq = seq
+        buffer.append(f"{seq}\x1f{kind}\x1f{key}\x1f{new_name}\x1e")
+        if len(buffer) >= FINGERPRINT_ROWS:
+            digest.update("".join(buffer).encode("utf-8"))
+            buffer.clear()
+    digest.update("".join(buffer).encode("utf-8"))
+    if len(labels) > 1:
+        digest.update("\n".join(labels).encode("utf-8"))
+    return rows, last_seq, int.from_bytes(digest.digest(), "big") >> 1
+
+
+def _checkpoint_actions(target_index, shards):
+    """
+    Checkpoint actions of one plan target's shards: "batch/<shard>", or
+    "batch/<target>.<shard>" for the second and later targets.
+    """
+    prefix = "batch/" if target_index == 0 else f"batch/{target_index}."
+    return [f"{prefix}{shard}" for shard in range(shards)]
+
+
+def _resume_point(cursor, checkpoint_table, batch_id, fingerprint, rows):
+    """
+    Where an interrupted batch picks up: (seq, replaced_rows). Every mapping
+    row with seq <= the returned seq is done; replaced_rows is what the
+    earlier runs replaced. Raises ValueError when the batch cannot resume
+    with this mapping.
+
+    The batch's checkpoint rows are "batch" (last_id = mapping fingerprint,
+    processed_rows = mapping rows, changed_rows = replaced before the current
+    run) and one per shard and target of the current run (last seq done, see
+    _checkpoint_actions). Shards advance independently, so the batch is done
+    up to the lowest one.
+    """
+    cursor.execute(
+        "SELECT action, last_id, processed_rows, changed_rows "
+        f"FROM `{checkpoint_table}` WHERE batch_id = %s "
+        "AND (action = %s OR action LIKE %s)",
+        (batch_id, "batch", "batch/%"),
+    )
+    found = {action: values for action, *values in cursor.fetchall()}
+    base = found.pop("batch", None)
+    if base is None:
+        raise ValueError("该批次没有断点记录，无法续做。")
+    if base[0] != fingerprint or base[1] != rows:
+        raise ValueError("映射文件或替换计划与该批次首次执行时不一致，无法续做。")
+    seq = min((last_id for last_id, _p, _c in found.values()), default=-1)
+    return seq, base[2] + sum(changed for _l, _p, changed in found.values())
+
+
+def _start_checkpoints(
+    cursor, checkpoint_table, batch_id, fingerprint, rows, replaced, actions, seq
+):
+    """
+    Reset a batch's checkpoint rows (see _resume_point) for a run whose shards
+    checkpoint under `actions`, starting after `seq`.
+    """
+    cursor.execute(
+        f"DELETE FROM `{checkpoint_table}` WHERE batch_id = %s AND action LIKE %s",
+        (batch_id, "batch/%"),
+    )
+    _save_checkpoint(
+        cursor, checkpoint_table, batch_id, "batch", fingerprint, rows, replaced
+    )
+    for action in actions:
+        _save_checkpoint(cursor, checkpoint_table, batch_id, action, seq, 0, 0)
+
+
+def execute_batch(
+    job,
+    target_db,
+    main_db,
+    mapping_source,
+    rowwise,
+    chunk_size,
+    workers=1,
+    resume=False,
+):
+    """
+    Job body of a batch replacement; job.batch_id is the new batch's id, or
+    the id of the batch to resume.
+
+    The mapping is applied to every plan target (see plan_targets)
+    concurrently, each on its own connections and with its own row counts,
+    under the one batch id. Detail rows of a multi-target plan record their
+    target, so rollback knows where to restore them.
+
+    The mapping is never copied: every pass over it (its fingerprint, shard
+    planning, each target's run) streams a fresh mapping_source(), so the
+    source must give the same rows on every call, from several threads at
+    once for a multi-target plan. A prepared_source does, and holds the
+    prepared rows (one per distinct key) once for all passes.
+
+    With `checkpoint_table` configured, progress is checkpointed after every
+    committed chunk. resume=True continues the interrupted batch job.batch_id
+    (see resume_blocker) from its checkpoint: mapping_source must give the
+    same mapping and rows already done are skipped. Checkpoints trail their
+    commits, so the rows after the checkpoint may have run already: the
+    batch's detail log tells which records they changed, and those are not
+    changed or logged again (see _replay_filter).
+
+    With `online` set, every target and shard shares one _Throttle (see
+    _online_throttle), which paces commits and pauses on server load.
+
+    With `name_scan` set, the set-based path matches name rows by scanning
+    each target table once (see _run_batch_bulk), which needs id_column to be
+    its primary key or a unique index, and runs serially. A target whose name
+    column's collation cannot be compared in memory (see _scan_match_key)
+    matches them with the JOIN instead.
+    """
+    log_table, log_detail_table = require_log_config(main_db)
+    safe_log_table = safe_ident(log_table)
+    safe_log_detail_table = safe_ident(log_detail_table)
+    chunk_table = safe_ident(main_db.get("log_chunk_table"))
+    checkpoint_table = safe_ident(main_db.get("checkpoint_table"))
+    targets = plan_targets(target_db)
+    labels = [target_label(t) for t in targets]
+    multi = len(targets) > 1
+    if resume and not checkpoint_table:
+        raise ValueError("未配置 checkpoint_table，无法续做批次。")
+    name_scan = 0
+    # Per target: how the scan compares names, or None to use the JOIN
+    scan_keys = [None] * len(targets)
+    scan_note = ""
+    if not rowwise and target_db.get("name_scan"):
+        for index, target in enumerate(targets):
+            schema = table_schema(target)
+            column = schema["columns"].get(target.get("column"), {})
+            scan_keys[index] = _scan_match_key(column.get("collation"))
+            if scan_keys[index] is None:
+                scan_note += (
+                    f"（{target_label(target)} 的排序规则 {column.get('collation')} "
+                    "无法在内存中比较，按原客户名替换的行改用 JOIN 匹配）"
+                )
+            elif not _is_unique_key(schema, target.get("id_column")):
+                raise ValueError(
+                    f"目标表 `{target.get('table')}` 的 `{target.get('id_column')}` "
+                    "列不是主键或唯一索引，无法按原客户名扫描匹配（name_scan）。"
+                )
+        if any(scan_keys):
+            name_scan = int(target_db.get("name_scan_rows", DEFAULT_NAME_SCAN_ROWS))
+    stats = job.stats = run_stats_for(target_db)
+    conn_main = None
+    try:
+        conn_main = instrument(get_connection(main_db), "main", stats)
+        cursor_main = conn_main.cursor()
+        mapping_rows, end_seq, fingerprint = _mapping_summary(mapping_source(), labels)
+        seq, replaced_before = -1, 0
+        if resume:
+            seq, replaced_before = _resume_point(
+                cursor_main, checkpoint_table, job.batch_id, fingerprint, mapping_rows
+            )
+            cursor_main.execute(
+                f"UPDATE `{safe_log_table}` SET status = %s WHERE batch_id = %s",
+                ("running", job.batch_id),
+            )
+        else:
+            _insert_batch_log(
+                cursor_main,
+                safe_log_table,
+                job.batch_id,
+                job.env_name,
+                job.operator,
+                "batch",
+                status="running",
+            )
+
+        def remaining():
+            # The rows left to run, streamed from mapping_source on every pass
+            return (item for item in mapping_source() if item[0] > seq)
+
+        skipped = 0
+        if seq >= 0:
+            skipped = sum(1 for item in mapping_source() if item[0] <= seq)
+
+        note = scan_note
+        # Per target: which keys may hit the same rows under its collations,
+        # and how its rows are spread over shards (None: serially)
+        conflict_keys = [_conflict_keys(t) for t in targets]
+        shard_of = [None] * len(targets)
+        if not rowwise and workers > 1:
+            if name_scan and any(item[1] == "name" for item in remaining()):
+                note += "（按原客户名扫描匹配时只能串行执行）"
+            else:
+                shard_of = [
+                    _plan_shards(remaining(), workers, keys) for keys in conflict_keys
+                ]
+                if shard_of[0] is None:
+                    note += "（映射同时包含按ID与按原客户名替换的行，已改为串行执行）"
+        actions = [
+            _checkpoint_actions(index, workers if shard_of[index] else 1)
+            for index in range(len(targets))
+        ]
+        if checkpoint_table:
+            _start_checkpoints(
+                cursor_main,
+                checkpoint_table,
+                job.batch_id,
+                fingerprint,
+                mapping_rows,
+                replaced_before,
+                [action for target_actions in actions for action in target_actions],
+                seq,
+            )
+        # Where the interrupted run's table scans got to (see _run_batch_bulk)
+        scan_from = [None] * len(targets)
+        if resume and name_scan:
+            scan_from = [
+                _load_checkpoint(
+                    cursor_main, checkpoint_table, job.batch_id, f"scan/{action[0]}"
+                )
+                for action in actions
+            ]
+        conn_main.commit()
+
+        throttle = _online_throttle(target_db, stats, lambda: job.cancel_requested)
+        if throttle:
+            # Wait for a healthy server before the first write
+            throttle.check()
+
+        # Progress is the number of mapping rows done in every target
+        progress_lock = threading.Lock()
+        target_done = [0] * len(targets)
+        stop = threading.Event()
+        logged_lock = threading.Lock()
+
+        def report(index, done):
+            with progress_lock:
+                target_done[index] = done
+                least = min(target_done)
+            if stop.is_set():
+                raise _ShardStopped()
+            job.report(skipped + least)
+
+        def run_target(index):
+            target = targets[index]
+            idents = dict(
+                _target_idents(target), log_detail_table=safe_log_detail_table
+            )
+            label = labels[index] if multi else None
+            replay = None
+            if resume:
+                replay = _replay_filter(
+                    conn_main,
+                    safe_log_detail_table,
+                    job.batch_id,
+                    logged_lock,
+                    remaining(),
+                    conflict_keys[index],
+                    label,
+                    chunk_table,
+                )
+            try:
+                if shard_of[index]:
+                    return _run_batch_parallel(
+                        target,
+                        main_db,
+                        idents,
+                        job.batch_id,
+                        remaining,
+                        shard_of[index],
+                        chunk_size,
+                        workers,
+                        on_progress=lambda done: report(index, done),
+                        stats=stats,
+                        replay=replay,
+                        end_seq=end_seq,
+                        checkpoints=actions[index],
+                        target=label,
+                        throttle=throttle,
+                        conflict_keys=conflict_keys[index],
+                    )
+                conn_target = instrument(get_connection(target), "target", stats)
+                sizer = _chunk_sizer(target, chunk_size, stats, actions[index][0])
+                try:
+                    with _detail_log_writer(
+                        main_db, safe_log_detail_table, stats, label
+                    ) as writer:
+                        if rowwise:
+                            return _run_batch_rowwise(
+                                conn_target,
+                                writer,
+                                idents,
+                                job.batch_id,
+                                remaining(),
+                                commit_every=chunk_size,
+                                on_progress=lambda done: report(index, done),
+                                checkpoint=actions[index][0],
+                                replay=replay,
+                                prepared=bool(target.get("prepared_statements")),
+                                sizer=sizer,
+                                throttle=throttle,
+                            )
+                        return _run_batch_bulk(
+                            conn_target,
+                            writer,
+                            idents,
+                            job.batch_id,
+                            remaining(),
+                            chunk_size,
+                            on_progress=lambda done: report(index, done),
+                            checkpoint=actions[index][0],
+                            replay=replay,
+                            sizer=sizer,
+                            name_scan=name_scan if scan_keys[index] else 0,
+                            scan_from=scan_from[index],
+                            throttle=throttle,
+                            scan_key=scan_keys[index],
+                            conflict_keys=conflict_keys[index],
+                        )
+                finally:
+                    release_connection(target, conn_target)
+            except BaseException:
+                stop.set()
+                raise
+
+        job.report(skipped)
+        if multi:
+            with ThreadPoolExecutor(
+                max_workers=len(targets), thread_name_prefix="anti-masking-target"
+            ) as executor:
+                futures = [executor.submit(run_target, i) for i in range(len(targets))]
+            errors = [f.exception() for f in futures if f.exception() is not None]
+            if errors:
+                # Report the root cause rather than the targets it stopped
+                real = [e for e in errors if not isinstance(e, _ShardStopped)]
+                raise (real or errors)[0]
+            results = [f.result() for f in futures]
+        else:
+            results = [run_target(0)]
+        total_logged_rows = sum(r[0] for r in results)
+        total_replaced_count = sum(r[1] for r in results)
+        if multi:
+            per_target = "，".join(
+                f"{label} {replaced}" for label, (_l, replaced) in zip(labels, results)
+            )
+            note = f"（{per_target}）{note}"
+        if resume:
+            total_logged_rows = _count_detail_logs(
+                cursor_main, safe_log_detail_table, job.batch_id, chunk_table
+            )
+            note = (
+                f"（续做：跳过已完成的 {skipped} 行映射，"
+                f"本次替换 {total_replaced_count} 条）{note}"
+            )
+            total_replaced_count += replaced_before
+        _update_batch_log(
+            cursor_main, safe_log_table, job.batch_id, total_logged_rows, "done"
+        )
+        _save_run_stats(cursor_main, safe_log_table, job.batch_id, stats)
+        conn_main.commit()
+        job.result = {"replaced": total_replaced_count, "logged": total_logged_rows}
+        return f"批量替换完成！共替换了 {total_replaced_count} 条记录。{note}"
+    except Exception as exc:
+        # Keep what was logged so far, so the partial batch can be rolled back
+        # or resumed
+        status = "cancelled" if isinstance(exc, JobCancelled) else "failed"
+        try:
+            if conn_main:
+                cursor_main = conn_main.cursor()
+                logged = _count_detail_logs(
+                    cursor_main, safe_log_detail_table, job.batch_id, chunk_table
+                )
+                _update_batch_log(
+                    cursor_main, safe_log_table, job.batch_id, logged, status
+                )
+                _save_run_stats(cursor_main, safe_log_table, job.batch_id, stats)
+                conn_main.commit()
+        except Exception:
+            pass
+        raise
+    finally:
+        if conn_main:
+            cursor_main.close()
+            release_connection(main_db, conn_main)
+
+
+def fan_out_blocker(env_to_db, env_names):
+    """
+    Why a fan-out over env_names cannot start (the first environment whose
+    config or target schema is not usable), or None.
+    """
+    if not env_names:
+        return "请至少选择一个环境。"
+    for env_name in env_names:
+        env_db_config = env_to_db.get(env_name)
+        if env_db_config is None:
+            return f"未在配置文件中找到环境 `{env_name}`。"
+        error = config_error(env_db_config) or schema_error(
+            split_db_config(env_db_config)[0]
+        )
+        if error:
+            return f"环境 `{env_name}`：{error}"
+    return None
+
+
+def submit_fan_out(
+    env_to_db,
+    env_names,
+    operator,
+    total,
+    mapping_source,
+    rowwise,
+    chunk_size=None,
+    workers=None,
+):
+    """
+    Start the same batch replacement in every environment of env_names at
+    once: one job and batch id per environment, each on that environment's
+    own connection pools, with its own chunk_size, parallel_workers and
+    max_concurrent_jobs (chunk_size / workers, when given, apply to all).
+    The jobs share mapping_source, so pass a prepared_source: the mapping is
+    then read and prepared once. Each job brings its own runner slot, so all
+    of them start at once however many environments there are, unless an
+    environment is already running max_concurrent_jobs jobs.
+    Returns the jobs, in env_names order.
+    """
+    runner = get_job_runner()
+    jobs = []
+    for env_name in env_names:
+        target_db, main_db = split_db_config(env_to_db[env_name])
+        job = Job(new_batch_id(), "batch", env_name, operator, total)
+        runner.submit(
+            job,
+            int(target_db.get("max_concurrent_jobs", DEFAULT_ENV_JOB_LIMIT)),
+            execute_batch,
+            target_db,
+            main_db,
+            mapping_source,
+            rowwise,
+            chunk_size or int(target_db.get("chunk_size", DEFAULT_CHUNK_SIZE)),
+            workers or int(target_db.get("parallel_workers", 1)),
+            reserved=True,
+        )
+        jobs.append(job)
+    return jobs
+
+
+def fan_out_matrix(jobs):
+    """
+    Result matrix of a fan-out: one row per job (environment, batch id,
+    status, progress, replaced records, elapsed seconds, message), and the
+    totals over all of them (progress summed, jobs counted per status).
+    """
+    rows = []
+    for job in jobs:
+        snap = job.snapshot()
+        rows.append(
+            {
+                "env_name": job.env_name,
+                "batch_id": job.batch_id,
+                "status": job.status,
+                "processed": snap["processed"],
+                "total": snap["total"],
+                "replaced": job.result["replaced"] if job.result else None,
+                "elapsed": round(snap["elapsed"], 1),
+                "message": job.message,
+            }
+        )
+    statuses = {}
+    for row in rows:
+        statuses[row["status"]] = statuses.get(row["status"], 0) + 1
+    return rows, {
+        "processed": sum(row["processed"] for row in rows),
+        "total": sum(row["total"] or 0 for row in rows),
+        "replaced": sum(row["replaced"] or 0 for row in rows),
+        "statuses": statuses,
+        "active": any(job.active for job in jobs),
+    }
+
+
+def execute_rollback(job, target_db, main_db, chunk_size):
+    """
+    Job body of a rollback. A cancelled or failed rollback leaves the batch in
+    "rolling_back", from where it can be resumed.
+    """
+    log_table, log_detail_table = require_log_config(main_db)
+    safe_log_table = safe_ident(log_table)
+    targets = plan_targets(target_db)
+    idents = dict(
+        _target_idents(targets[0]),
+        log_detail_table=safe_ident(log_detail_table),
+        log_chunk_table=safe_ident(main_db.get("log_chunk_table")),
+        checkpoint_table=safe_ident(main_db.get("checkpoint_table")),
+        row_state_table=safe_ident(main_db.get("row_state_table")),
+    )
+    if len(targets) > 1:
+        idents["targets"] = {target_label(t): _target_idents(t) for t in targets}
+    stats = job.stats = run_stats_for(target_db)
+    conn_target = None
+    conn_main = None
+    try:
+        conn_main = instrument(get_connection(main_db), "main", stats)
+        cursor_main = conn_main.cursor()
+        cursor_main.execute(
+            f"UPDATE `{safe_log_table}` SET status = %s WHERE batch_id = %s",
+            ("rolling_back", job.batch_id),
+        )
+        conn_main.commit()
+        throttle = _online_throttle(target_db, stats, lambda: job.cancel_requested)
+        if throttle:
+            # Wait for a healthy server before the first write
+            throttle.check()
+        conn_target = instrument(get_connection(target_db), "target", stats)
+        processed_rows, success_count, merged_count = _run_rollback_bulk(
+            conn_target,
+            conn_main,
+            idents,
+            job.batch_id,
+            chunk_size,
+            on_progress=job.report,
+            sizer=_chunk_sizer(target_db, chunk_size, stats, "rollback"),
+            throttle=throttle,
+        )
+        cursor_main.execute(
+            f"UPDATE `{safe_log_table}` SET status = %s WHERE batch_id = %s",
+            ("rollback", job.batch_id),
+        )
+        conn_main.commit()
+        fail_count = max(0, processed_rows - success_count - merged_count)
+        note = ""
+        if merged_count:
+            note = f"（同一记录在批次中多次修改，合并明细 {merged_count} 条）"
+        return f"回退完成：成功 {success_count} 条，失败 {fail_count} 条。{note}"
+    finally:
+        if conn_target:
+            release_connection(target_db, conn_target)
+        if conn_main:
+            cursor_main.close()
+            release_connection(main_db, conn_main)
+
+
+def query_batches(cursor, log_table, filters, before_id, limit):
+    """
+    One page of batch log rows, newest first. Keyset pagination on the log
+    id: before_id is the last id of the previous page (None for the first).
+    Returns (rows, has_more).
+    """
+    where = []
+    params = []
+    for column, values in (
+        ("env_name", filters["envs"]),
+        ("status", filters["statuses"]),
+    ):
+        if values:
+            where.append(f"{column} IN ({', '.join(['%s'] * len(values))})")
+            params.extend(values)
+    if filters["operator"]:
+        where.append("operator = %s")
+        params.append(filters["operator"])
+    if filters["date_from"]:
+        where.append("created_at >= %s")
+        params.append(filters["date_from"].strftime("%Y-%m-%d 00:00:00"))
+    if filters["date_to"]:
+        where.append("created_at < %s")
+        next_day = filters["date_to"] + datetime.timedelta(days=1)
+        params.append(next_day.strftime("%Y-%m-%d 00:00:00"))
+    if before_id is not None:
+        where.append("id < %s")
+        params.append(before_id)
+    where_clause = f"WHERE {' AND '.join(where)} " if where else ""
+    cursor.execute(
+        "SELECT id, batch_id, env_name, operator, mode, created_at, total_rows, "
+        f"status FROM `{log_table}` {where_clause}ORDER BY id DESC LIMIT %s",
+        (*params, limit + 1),
+    )
+    rows = cursor.fetchall()
+    return rows[:limit], len(rows) > limit
+
+
+def query_details(
+    cursor,
+    log_detail_table,
+    batch_id,
+    after_id,
+    limit,
+    with_target=False,
+    chunk_table=None,
+):
+    """
+    One page of a batch's detail rows in log order, keyset-paginated on the
+    detail id so deep pages cost the same as the first. with_target adds the
+    `target` column of multi-target plans.
+    A batch in the compact detail log `chunk_table` is paged by row number
+    instead (see _query_chunk_details), which then stands in for the id.
+    Returns (rows, has_more).
+    """
+    if _has_chunks(cursor, chunk_table, batch_id):
+        return _query_chunk_details(
+            cursor, chunk_table, batch_id, after_id or 0, limit, with_target
+        )
+    target = ", target" if with_target else ""
+    cursor.execute(
+        f"SELECT id, row_id, old_name, new_name, updated_at{target} "
+        f"FROM `{log_detail_table}` WHERE batch_id = %s AND id > %s "
+        "ORDER BY id LIMIT %s",
+        (batch_id, after_id or 0, limit + 1),
+    )
+    rows = cursor.fetchall()
+    return rows[:limit], len(rows) > limit
+
+
+def _query_chunk_details(cursor, chunk_table, batch_id, after_row, limit, with_target):
+    """
+    query_details for a batch in the compact detail log: the rows numbered
+    after_row + 1 onwards, each numbered from 1 in log order in place of the
+    id. Only the chunks holding the page are read and unpacked.
+    """
+    cursor.execute(
+        f"SELECT id, row_count FROM `{chunk_table}` WHERE batch_id = %s ORDER BY id",
+        (batch_id,),
+    )
+    chunks = cursor.fetchall()
+    rows = []
+    first = 0
+    for chunk_id, count in chunks:
+        if len(rows) >= limit:
+            break
+        if first + count > after_row:
+            cursor.execute(
+                f"SELECT target, payload FROM `{chunk_table}` WHERE id = %s",
+                (chunk_id,),
+            )
+            label, payload = cursor.fetchall()[0]
+            extra = (label,) if with_target else ()
+            columns = ("row_id", "old_name", "new_name", "updated_at")
+            for number, row in enumerate(
+                _chunk_tuples(_read_chunk(payload), columns), first + 1
+            ):
+                if number > after_row and len(rows) < limit:
+                    rows.append((number, *row, *extra))
+        first += count
+    total = sum(count for _id, count in chunks)
+    return rows, after_row + len(rows) < total
+
+
+def _export_rows(main_db, batch_id, with_target):
+    """
+    A batch's detail rows in log order (without the id), read by
+    query_details one page at a time on a pooled main-DB connection, or one
+    chunk at a time for a batch in the compact detail log.
+    """
+    _log_table, log_detail_table = require_log_config(main_db)
+    chunk_table = safe_ident(main_db.get("log_chunk_table"))
+    conn = get_connection(main_db)
+    cursor = conn.cursor()
+    try:
+        if _has_chunks(cursor, chunk_table, batch_id):
+            columns = ("row_id", "old_name", "new_name", "updated_at")
+            for _id, label, rows in _detail_chunks(
+                cursor, chunk_table, batch_id, columns
+            ):
+                extra = (label,) if with_target else ()
+                for row in rows:
+                    yield (*row, *extra)
+            return
+        after_id, has_more = None, True
+        while has_more:
+            rows, has_more = query_details(
+                cursor,
+                safe_ident(log_detail_table),
+                batch_id,
+                after_id,
+                EXPORT_PAGE_ROWS,
+                with_target,
+            )
+            for row in rows:
+                yield row[1:]
+            if rows:
+                after_id = rows[-1][0]
+    finally:
+        cursor.close()
+        release_connection(main_db, conn)
+
+
+def export_details(main_db, batch_id, out, fmt, with_target=False):
+    """
+    Write a batch's detail log to the binary file `out` as "csv" (UTF-8 with
+    BOM, for Excel) or "xlsx", holding one page of rows at a time: xlsx goes
+    through openpyxl's write-only mode, which streams rows to a temporary
+    file, and continues on a new sheet after XLSX_SHEET_ROWS rows.
+    Returns the number of rows written.
+    """
+    header = ["row_id", "old_name", "new_name", "updated_at"]
+    if with_target:
+        header.append("target")
+    rows = _export_rows(main_db, batch_id, with_target)
+    count = 0
+    if fmt == "csv":
+        text = io.TextIOWrapper(out, encoding="utf-8-sig", newline="")
+        writer = csv.writer(text)
+        writer.writerow(header)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+        text.flush()
+        text.detach()
+        return count
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = None
+    for row in rows:
+        if count % XLSX_SHEET_ROWS == 0:
+            sheet = workbook.create_sheet(
+                f"批次明细{count // XLSX_SHEET_ROWS + 1}" if count else "批次明细"
+            )
+            sheet.append(header)
+        sheet.append(row)
+        count += 1
+    if sheet is None:
+        workbook.create_sheet("批次明细").append(header)
+    workbook.save(out)
+    return count
+
+
+def find_batch(main_db, batch_id):
+    """
+    The log row of one batch as a dict, or None if there is no such batch.
+    """
+    log_table, _log_detail_table = require_log_config(main_db)
+    conn = get_connection(main_db)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "SELECT batch_id, env_name, operator, mode, created_at, total_rows, "
+            f"status FROM `{safe_ident(log_table)}` WHERE batch_id = %s",
+            (batch_id,),
+        )
+        row = cursor.fetchone()
+    finally:
+        cursor.close()
+        release_connection(main_db, conn)
+    if row is None:
+        return None
+    return dict(
+        zip(
+            (
+                "batch_id",
+                "env_name",
+                "operator",
+                "mode",
+                "created_at",
+                "total_rows",
+                "status",
+            ),
+            row,
+        )
+    )
+
+
+def _env_clause(column):
+    # Batches logged without an environment belong to every environment
+    return f"({column} = %s OR {column} IS NULL OR {column} = '')"
+
+
+def lookup_changes(
+    main_db, env_name, row_id=None, name=None, with_target=False, limit=None
+):
+    """
+    Detail rows of env_name's batches that changed record row_id, or renamed a
+    record from or to `name`, newest first, as dicts with the batch's
+    operator, mode and status added. Each condition is one probe of an index
+    of the detail table (idx_row_id, idx_old_name, idx_new_name in README).
+    with_target adds the `target` column of multi-target plans.
+    Batches in the compact detail log are searched through its key index by
+    _lookup_chunk_changes, and both kinds of rows merged newest first by
+    their timestamp.
+    """
+    log_table, log_detail_table = require_log_config(main_db)
+    chunk_table = safe_ident(main_db.get("log_chunk_table"))
+    limit = limit or MAX_LOOKUP_ROWS
+    conditions = []
+    if row_id:
+        conditions.append(("d.row_id = %s", row_id))
+    if name:
+        conditions.extend([("d.old_name = %s", name), ("d.new_name = %s", name)])
+    if not conditions:
+        return []
+    columns = ["id", "batch_id", "row_id", "old_name", "new_name", "updated_at"]
+    if with_target:
+        columns.append("target")
+    select = (
+        f"SELECT {', '.join(f'd.{c}' for c in columns)}, "
+        "l.operator, l.mode, l.status "
+        f"FROM `{safe_ident(log_detail_table)}` AS d "
+        f"JOIN `{safe_ident(log_table)}` AS l ON l.batch_id = d.batch_id "
+        f"WHERE {{}} AND {_env_clause('l.env_name')} ORDER BY d.id DESC LIMIT %s"
+    )
+    parts = [
+        f"SELECT * FROM ({select.format(condition)}) AS p{i}"
+        for i, (condition, _value) in enumerate(conditions)
+    ]
+    params = [v for _condition, value in conditions for v in (value, env_name, limit)]
+    conn = get_connection(main_db)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            f"SELECT * FROM ({' UNION '.join(parts)}) AS u "
+            "ORDER BY id DESC LIMIT %s",
+            (*params, limit),
+        )
+        rows = cursor.fetchall()
+        if chunk_table:
+            rows += _lookup_chunk_changes(
+                cursor,
+                chunk_table,
+                safe_ident(main_db.get("log_chunk_key_table")),
+                safe_ident(log_table),
+                env_name,
+                row_id,
+                name,
+                with_target,
+                limit,
+            )
+            rows = sorted(rows, key=lambda row: str(row[5]), reverse=True)[:limit]
+    finally:
+        cursor.close()
+        release_connection(main_db, conn)
+    columns.extend(["operator", "mode", "status"])
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def _lookup_chunk_changes(
+    cursor,
+    chunk_table,
+    key_table,
+    log_table,
+    env_name,
+    row_id,
+    name,
+    with_target,
+    limit,
+):
+    """
+    lookup_changes over the compact detail log, as rows of the same columns
+    (the chunk id in place of the detail id). The key index `key_table`
+    names the chunks holding row_id or name (see _chunk_key_hash); only
+    those of env_name are read, newest first, CHUNK_SCAN_PAGE per query, and
+    filtered once unpacked until `limit` rows are found.
+    """
+    columns = ("row_id", "old_name", "new_name", "updated_at")
+    hashes = []
+    if row_id:
+        hashes.append(_chunk_key_hash("r", row_id))
+    if name:
+        hashes.append(_chunk_key_hash("n", name))
+    found = []
+    before_id = None
+    while len(found) < limit:
+        keyset = "AND c.id < %s " if before_id is not None else ""
+        cursor.execute(
+            "SELECT c.id, c.batch_id, c.target, c.payload, "
+            "l.operator, l.mode, l.status "
+            f"FROM `{chunk_table}` AS c "
+            f"JOIN `{log_table}` AS l ON l.batch_id = c.batch_id "
+            f"WHERE c.id IN (SELECT k.chunk_id FROM `{key_table}` AS k "
+            f"WHERE k.key_hash IN ({', '.join(['%s'] * len(hashes))})) "
+            f"AND {_env_clause('l.env_name')} {keyset}"
+            "ORDER BY c.id DESC LIMIT %s",
+            (
+                *hashes,
+                env_name,
+                *([] if before_id is None else [before_id]),
+                CHUNK_SCAN_PAGE,
+            ),
+        )
+        chunks = cursor.fetchall()
+        if not chunks:
+            break
+        for chunk_id, batch_id, label, payload, operator, mode, status in chunks:
+            table = _read_chunk(payload)
+            masks = []
+            if row_id:
+                masks.append(pc.equal(table.column("row_id"), row_id))
+            if name:
+                masks.append(pc.equal(table.column("old_name"), name))
+                masks.append(pc.equal(table.column("new_name"), name))
+            mask = masks[0]
+            for other in masks[1:]:
+                mask = pc.or_kleene(mask, other)
+            extra = (label,) if with_target else ()
+            for row in reversed(_chunk_tuples(table.filter(mask), columns)):
+                found.append((chunk_id, batch_id, *row, *extra, operator, mode, status))
+        before_id = chunks[-1][0]
+    return found[:limit]
+
+
+def row_states(main_db, row_id=None, name=None, limit=None):
+    """
+    Current state of records in the optional row-state table: the one with
+    row_id (one row per target) or those currently named `name`, as dicts
+    with the status of the batch that changed them last. Empty without a
+    row-state table.
+    """
+    row_state_table = safe_ident(main_db.get("row_state_table"))
+    log_table, _log_detail_table = require_log_config(main_db)
+    if not row_state_table or not (row_id or name):
+        return []
+    if row_id:
+        condition, value = "s.row_id = %s", row_id
+    else:
+        condition, value = "s.current_name = %s", name
+    columns = ["row_id", "target", "current_name", "batch_id", "updated_at"]
+    conn = get_connection(main_db)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            f"SELECT {', '.join(f's.{c}' for c in columns)}, l.status "
+            f"FROM `{row_state_table}` AS s "
+            f"LEFT JOIN `{safe_ident(log_table)}` AS l ON l.batch_id = s.batch_id "
+            f"WHERE {condition} ORDER BY s.updated_at DESC LIMIT %s",
+            (value, limit or MAX_LOOKUP_ROWS),
+        )
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+        release_connection(main_db, conn)
+    columns.append("status")
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def later_overwrites(main_db, batch_id, env_name, with_target=False):
+    """
+    Batches of env_name that changed some of batch_id's records after it and
+    are not rolled back, as [(batch_id, records)] in the order they ran (at
+    most MAX_LATER_BATCHES). Rolling batch_id back would overwrite their
+    names with its old ones. Probes idx_row_id once per detail row of the
+    batch; with_target only counts the same target of a multi-target plan.
+    With a compact detail log configured, see _later_chunk_overwrites.
+    """
+    log_table, log_detail_table = require_log_config(main_db)
+    detail_table = safe_ident(log_detail_table)
+    chunk_table = safe_ident(main_db.get("log_chunk_table"))
+    same_target = (
+        "AND COALESCE(later.target, '') = COALESCE(d.target, '') "
+        if with_target
+        else ""
+    )
+    conn = get_connection(main_db)
+    cursor = conn.cursor()
+    try:
+        if _has_chunks(cursor, chunk_table, batch_id):
+            later = []
+        else:
+            cursor.execute(
+                "SELECT later.batch_id, COUNT(DISTINCT later.row_id) "
+                f"FROM `{detail_table}` AS d JOIN `{detail_table}` AS later "
+                f"ON later.row_id = d.row_id AND later.id > d.id {same_target}"
+                f"JOIN `{safe_ident(log_table)}` AS l "
+                "ON l.batch_id = later.batch_id "
+                "WHERE d.batch_id = %s AND later.batch_id <> %s "
+                f"AND l.status <> 'rollback' AND {_env_clause('l.env_name')} "
+                "GROUP BY later.batch_id ORDER BY MIN(later.id) LIMIT %s",
+                (batch_id, batch_id, env_name, MAX_LATER_BATCHES),
+            )
+            later = [(row[0], row[1]) for row in cursor.fetchall()]
+        if chunk_table:
+            later = _later_chunk_overwrites(
+                cursor,
+                safe_ident(log_table),
+                detail_table,
+                chunk_table,
+                batch_id,
+                env_name,
+                with_target,
+                later,
+            )
+        return later
+    finally:
+        cursor.close()
+        release_connection(main_db, conn)
+
+
+def _later_chunk_overwrites(
+    cursor, log_table, detail_table, chunk_table, batch_id, env_name, with_target, later
+):
+    """
+    later_overwrites where either batch may be in the compact detail log
+    `chunk_table`, which cannot be joined by record: batch_id's records are
+    read into a set and compared with the rows of later batches, here those
+    whose log row is newer. `later` (from the detail-table join) is merged
+    in, and the result ordered by when the batches started.
+    """
+    cursor.execute(f"SELECT id FROM `{log_table}` WHERE batch_id = %s", (batch_id,))
+    found = cursor.fetchall()
+    if not found:
+        return later
+
+    def key(row_id, label=None):
+        return (label or "", row_id) if with_target else row_id
+
+    # Detail-table rows carry a target only in multi-target plans
+    target = ", d.target" if with_target else ""
+
+    records = set()
+    for _id, label, rows in _detail_chunks(cursor, chunk_table, batch_id, ("row_id",)):
+        records.update(key(row[0], label) for row in rows)
+    compact = bool(records)
+    if not compact:
+        cursor.execute(
+            f"SELECT d.row_id{target} FROM `{detail_table}` AS d "
+            "WHERE d.batch_id = %s",
+            (batch_id,),
+        )
+        records.update(key(*row) for row in cursor.fetchall())
+    newer = (
+        f"JOIN `{log_table}` AS l ON l.batch_id = d.batch_id "
+        "WHERE l.id > %s AND d.batch_id <> %s "
+        f"AND l.status <> 'rollback' AND {_env_clause('l.env_name')} "
+    )
+    changed = {}
+    if compact:
+        # Detail-table rows of later batches, probing idx_row_id per record
+        row_ids = list(dict.fromkeys(r[1] if with_target else r for r in records))
+        for start in range(0, len(row_ids), STREAM_FETCH_ROWS):
+            part = row_ids[start : start + STREAM_FETCH_ROWS]
+            cursor.execute(
+                f"SELECT d.batch_id, d.row_id{target} FROM `{detail_table}` AS d "
+                f"{newer}AND d.row_id IN ({', '.join(['%s'] * len(part))})",
+                (found[0][0], batch_id, env_name, *part),
+            )
+            for later_batch, *record in cursor.fetchall():
+                if key(*record) in records:
+                    changed.setdefault(later_batch, set()).add(record[0])
+    before_id = None
+    while True:
+        keyset = "AND d.id > %s " if before_id is not None else ""
+        cursor.execute(
+            f"SELECT d.id, d.batch_id, d.target, d.payload FROM `{chunk_table}` AS d "
+            f"{newer}{keyset}ORDER BY d.id LIMIT %s",
+            (
+                found[0][0],
+                batch_id,
+                env_name,
+                *([] if before_id is None else [before_id]),
+                CHUNK_SCAN_PAGE,
+            ),
+        )
+        chunks = cursor.fetchall()
+        if not chunks:
+            break
+        for _id, later_batch, label, payload in chunks:
+            for (row_id,) in _chunk_tuples(_read_chunk(payload), ("row_id",)):
+                if key(row_id, label) in records:
+                    changed.setdefault(later_batch, set()).add(row_id)
+        before_id = chunks[-1][0]
+    counts = dict(later)
+    for later_batch, row_ids in changed.items():
+        counts[later_batch] = counts.get(later_batch, 0) + len(row_ids)
+    if not counts:
+        return []
+    cursor.execute(
+        f"SELECT batch_id FROM `{log_table}` "
+        f"WHERE batch_id IN ({', '.join(['%s'] * len(counts))}) ORDER BY id",
+        tuple(counts),
+    )
+    ordered = [row[0] for row in cursor.fetchall()]
+    return [(b, counts[b]) for b in ordered][:MAX_LATER_BATCHES]
+
+
+def overwrite_blocker(main_db, batch_id, env_name, with_target=False):
+    """
+    Why rolling batch_id back would undo later batches' changes (see
+    later_overwrites), or None if no later batch touched its records.
+    """
+    later = later_overwrites(main_db, batch_id, env_name, with_target)
+    if not later:
+        return None
+    listed = "、".join(f"`{b}`（{n} 条）" for b, n in later)
+    return (
+        f"该批次的部分记录已被之后的批次修改：{listed}。"
+        "请先回退这些批次，再回退本批次。"
+    )
+
+
+def rollback_blocker(batch, env_name):
+    """
+    Why a batch (log row from find_batch or query_batches) cannot be rolled
+    back from env_name's target table, or None if it can.
+    """
+    # A batch only touched the target table of its own environment
+    if batch["env_name"] not in (None, "", env_name):
+        return f"该批次属于环境 `{batch['env_name']}`，请切换到该环境后回退。"
+    # A failed or cancelled batch keeps the detail rows of what it committed
+    if (
+        batch["status"] not in ("done", "cancelled", "failed", "rolling_back")
+        or not batch["total_rows"]
+    ):
+        return "该批次不可回退（可能已回退、仍在执行或无更新）。"
+    return None
+
+
+def resume_blocker(batch, env_name, main_db):
+    """
+    Why a batch (log row from find_batch) cannot be resumed with
+    execute_batch(resume=True) in env_name, or None if it can.
+    """
+    if not main_db.get("checkpoint_table"):
+        return "未配置 checkpoint_table，无法续做批次。"
+    if batch["env_name"] not in (None, "", env_name):
+        return f"该批次属于环境 `{batch['env_name']}`，请切换到该环境后续做。"
+    if batch["mode"] != "batch":
+        return "只有批量替换的批次可以续做。"
+    # "running" without a live job here: the process running it was stopped
+    running_here = any(
+        job.batch_id == batch["batch_id"] and job.active
+        for job in get_job_runner().jobs()
+    )
+    if batch["status"] not in ("failed", "cancelled", "running") or running_here:
+        return "该批次不可续做（可能已完成、已回退或仍在执行）。"
+    return _log_format_blocker(batch, main_db)
+
+
+def _log_format_blocker(batch, main_db):
+    """
+    Why a batch cannot be resumed into the detail log format main_db now
+    has, or None. Readers take a batch's detail rows from one store (the
+    compact log if it holds any, see _has_chunks), so a resumed run must log
+    to the store its first run used: with `log_chunk_table` toggled in
+    between, the batch would be split over both.
+    """
+    _log_table, log_detail_table = require_log_config(main_db)
+    chunk_table = safe_ident(main_db.get("log_chunk_table"))
+    conn = get_connection(main_db)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            f"SELECT id FROM `{safe_ident(log_detail_table)}` "
+            "WHERE batch_id = %s LIMIT 1",
+            (batch["batch_id"],),
+        )
+        in_rows = bool(cursor.fetchall())
+        conn.commit()
+    finally:
+        cursor.close()
+        release_connection(main_db, conn)
+    if chunk_table and in_rows:
+        return (
+            "该批次的明细记录在逐行明细表中，当前配置了 log_chunk_table，"
+            "无法续做；请去掉该配置后续做。"
+        )
+    if not chunk_table and not in_rows and batch["total_rows"]:
+        return (
+            "该批次的明细记录在紧凑明细表中，当前未配置 log_chunk_table，"
+            "无法续做；请恢复该配置后续做。"
+        )
+    return None
+
+
+_configs = {}
+_configs_lock = threading.Lock()
+
+
+def _parse_db_config(path):
+    """
+    Parse config.toml and validate each environment.
+    Returns (env_names, env_to_db_config, job_workers), job_workers being the
+    optional [jobs] workers setting (see get_job_runner).
+    """
+    config = toml.load(path)
+
+    if "environments" in config:
+        envs = config.get("environments", {})
+        env_to_db = {}
+        for name, env_cfg in envs.items():
+            env_to_db[name] = {
+                "database": env_cfg.get("database", {}),
+                "target_database": env_cfg.get("target_database", {}),
+                "main_database": env_cfg.get("main_database", {}),
+            }
+    else:
+        # Backward compatible single environment
+        env_to_db = {"default": {"database": config.get("database", {})}}
+
+    for env_db_config in env_to_db.values():
+        env_db_config["errors"] = _validate_env(env_db_config)
+    job_workers = config.get("jobs", {}).get("workers")
+    return list(env_to_db.keys()), env_to_db, job_workers
+
+
+def load_config(path=CONFIG_PATH):
+    """
+    Load database config(s) from config.toml.
+    Supports:
+      - legacy [database]
+      - [environments.<name>.database]
+      - [environments.<name>.target_database] + [environments.<name>.main_database]
+    Returns: (env_names, env_to_db_config)
+    The parsed result is reused until the file's modification time changes,
+    so repeated calls only stat the file. A reload also drops the cached
+    table schemas and applies [jobs] workers to the job runner.
+    """
+    mtime = os.stat(path).st_mtime_ns
+    with _configs_lock:
+        cached = _configs.get(path)
+        if cached is None or cached[0] != mtime:
+            env_names, env_to_db, job_workers = _parse_db_config(path)
+            cached = _configs[path] = (mtime, (env_names, env_to_db))
+            with _schemas_lock:
+                _schemas.clear()
+            get_job_runner().set_max_workers(int(job_workers or DEFAULT_JOB_WORKERS))
+        return cached[1]
@@ -0,0 +1,122 @@
+"""
+Fixtures running masking_core against the SQLite stand-in of
+benchmarks/standin.py, on scratch tables laid out like the benchmark's.
+"""
+
+import os
+import sys
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "benchmarks")]
+
+import bench_suite  # noqa: E402
+import masking_core as core  # noqa: E402
+
+
+class StandInEnv:
+    """
+    One target and one main database in a fresh directory, with helpers to
+    fill the target table, run jobs against it and read the results back.
+    """
+
+    def __init__(self, workdir):
+        args = types.SimpleNamespace(backend="standin", workers=4)
+        connect, self.target_db, self.main_db = bench_suite._db_configs(
+            args, str(workdir)
+        )
+        # Own pools and cached schemas for every test's directory
+        for db_cfg in (self.target_db, self.main_db):
+            db_cfg["host"] = f"standin-{workdir.name}"
+        bench_suite._install(connect, bench_suite._Recorder())
+
+    def compact_log(self):
+        self.main_db["log_chunk_table"] = bench_suite.BENCH_CHUNK_TABLE
+        self.main_db["log_chunk_key_table"] = bench_suite.BENCH_CHUNK_KEY_TABLE
+
+    def reset(self, names):
+        """
+        Recreate the tables; the target table holds {row_id: name}.
+        """
+        bench_suite._reset_tables("standin", self.target_db, self.main_db, 0, 1)
+        self.execute(
+            self.target_db,
+            [
+                f"INSERT INTO `{bench_suite.BENCH_TABLE}` VALUES "
+                f"('{row_id}', '{name}')"
+                for row_id, name in names.items()
+            ],
+        )
+
+    def execute(self, db_cfg, statements):
+        bench_suite._execute_script(db_cfg, statements)
+
+    def names(self):
+        """
+        {row_id: name} of the target table.
+        """
+        conn = core.get_connection(self.target_db)
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                f"SELECT `{bench_suite.ID_COLUMN}`, `{bench_suite.NAME_COLUMN}` "
+                f"FROM `{bench_suite.BENCH_TABLE}`"
+            )
+            return dict(cursor.fetchall())
+        finally:
+            cursor.close()
+            core.release_connection(self.target_db, conn)
+
+    def details(self, batch_id):
+        """
+        The batch's detail rows as [(row_id, old_name, new_name)] in log
+        order.
+        """
+        return [row[:3] for row in core._export_rows(self.main_db, batch_id, False)]
+
+    def batch(
+        self,
+        mapping,
+        rowwise=False,
+        chunk_size=100,
+        workers=1,
+        batch_id=None,
+        **kwargs,
+    ):
+        """
+        Run `mapping` ([(seq, kind, key, new_name)]) as a new batch, or as
+        batch_id; returns the job.
+        """
+        job = core.Job(
+            batch_id or core.new_batch_id(), "batch", "test", "tester", len(mapping)
+        )
+        core.execute_batch(
+            job,
+            self.target_db,
+            self.main_db,
+            lambda: mapping,
+            rowwise,
+            chunk_size,
+            workers,
+            **kwargs,
+        )
+        return job
+
+    def rollback(self, batch_id, chunk_size=100):
+        batch = core.find_batch(self.main_db, batch_id)
+        job = core.Job(
+            core.new_batch_id(),
+            "rollback",
+            "test",
+            "tester",
+            batch["total_rows"],
+            batch_id=batch_id,
+        )
+        return core.execute_rollback(job, self.target_db, self.main_db, chunk_size)
+
+
+@pytest.fixture
+def standin(tmp_path):
+    return StandInEnv(tmp_path)
@@ -0,0 +1,65 @@
+import masking_core as core
+
+
+def _names(groups):
+    return {f"id{i}": f"name{i // 3}" for i in range(groups * 3)}
+
+
+def test_bulk_and_rowwise_log_the_same_details(standin):
+    mapping = [
+        (0, "name", "name0", "A"),
+        (1, "name", "A", "B"),
+        (2, "id", "id4", "C"),
+        (3, "name", "name2", "name3"),
+        (4, "name", "name3", "D"),
+        (5, "name", "Name5", "E"),
+        (6, "name", "name5", "F"),
+        (7, "id", "id4", "G"),
+    ]
+    results = {}
+    for rowwise in (True, False):
+        standin.reset(_names(8))
+        job = standin.batch(mapping, rowwise=rowwise, chunk_size=3)
+        results[rowwise] = (standin.names(), sorted(standin.details(job.batch_id)))
+    assert results[True] == results[False]
+    names, details = results[False]
+    assert names["id0"] == "B" and names["id4"] == "G" and names["id6"] == "D"
+    assert len(details) == len(set(details))
+
+
+def test_chunks_split_keys_the_collation_matches():
+    mapping = [
+        (0, "name", "José", "A"),
+        (1, "name", "jose ", "B"),
+        (2, "name", "Other", "C"),
+    ]
+
+    def plan(collation):
+        keys = {"id": str, "name": core._conflict_key(collation)}
+        return [len(chunk) for _kind, chunk in core._plan_chunks(mapping, 10, keys)]
+
+    assert plan("utf8mb4_bin") == [3]
+    assert plan("utf8mb4_0900_as_ci") == [3]
+    assert plan("utf8mb4_general_ci") == [1, 2]
+    # Unknown collations fall back to the loose key
+    assert plan("latin1_swedish_ci") == [1, 2]
+
+
+def test_shards_group_keys_the_collation_matches():
+    mapping = [(i, "name", f"Name{i}", f"new{i}") for i in range(50)]
+    mapping += [(50 + i, "name", f"name{i} ", f"other{i}") for i in range(50)]
+    keys = {"id": str, "name": core._conflict_key("utf8mb4_unicode_ci")}
+    shard_of = core._plan_shards(mapping, 4, keys)
+    for i in range(50):
+        assert shard_of(mapping[i]) == shard_of(mapping[50 + i])
+
+
+def test_parallel_shards_match_a_serial_run(standin):
+    mapping = [(i, "name", f"name{i}", f"N{i}") for i in range(0, 60, 2)]
+    mapping += [(60 + i, "name", f"N{i}", f"M{i}") for i in range(0, 60, 4)]
+    results = []
+    for workers in (1, 4):
+        standin.reset(_names(60))
+        job = standin.batch(mapping, chunk_size=4, workers=workers)
+        results.append((standin.names(), sorted(standin.details(job.batch_id))))
+    assert results[0] == results[1]
@@ -0,0 +1,56 @@
+import pytest
+
+import masking_core as core
+
+
+def _fail_halfway(standin, monkeypatch, mapping):
+    batch_id = core.new_batch_id()
+    report = core.Job.report
+
+    def failing_report(job, done):
+        if done >= len(mapping) // 2:
+            raise RuntimeError("crash")
+        report(job, done)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(core.Job, "report", failing_report)
+        with pytest.raises(RuntimeError):
+            standin.batch(mapping, chunk_size=1, batch_id=batch_id)
+    return core.find_batch(standin.main_db, batch_id)
+
+
+def test_compact_log_rolls_back_and_exports(standin, tmp_path):
+    standin.compact_log()
+    original = {f"id{i}": f"name{i // 2}" for i in range(20)}
+    mapping = [(0, "name", "name0", "A"), (1, "name", "A", "B")]
+    mapping += [(2 + i, "id", f"id{i}", f"I{i}") for i in range(4, 12)]
+    standin.reset(original)
+    job = standin.batch(mapping, chunk_size=3)
+
+    details = standin.details(job.batch_id)
+    assert len(details) == 12
+    assert ("id0", "name0", "A") in details and ("id0", "A", "B") in details
+    out = tmp_path / "details.csv"
+    with open(out, "wb") as f:
+        assert core.export_details(standin.main_db, job.batch_id, f, "csv") == 12
+    assert out.read_text(encoding="utf-8-sig").count("\n") == 13
+
+    standin.rollback(job.batch_id)
+    assert standin.names() == original
+
+
+@pytest.mark.parametrize("compact_first", [True, False])
+def test_resume_refuses_another_log_format(standin, monkeypatch, compact_first):
+    if compact_first:
+        standin.compact_log()
+    standin.reset({f"id{i}": f"name{i}" for i in range(6)})
+    mapping = [(i, "name", f"name{i}", f"new{i}") for i in range(6)]
+    batch = _fail_halfway(standin, monkeypatch, mapping)
+    assert core.resume_blocker(batch, "test", standin.main_db) is None
+
+    if compact_first:
+        del standin.main_db["log_chunk_table"]
+        del standin.main_db["log_chunk_key_table"]
+    else:
+        standin.compact_log()
+    assert core.resume_blocker(batch, "test", standin.main_db) is not None
@@ -0,0 +1,27 @@
+import masking_core as core
+
+
+def test_name_conflicts_keep_the_first_row():
+    plan = core.prepare_mapping(
+        [(0, "name", "A", "B"), (1, "name", "Y", "Z"), (2, "name", "A", "C")]
+    )
+    assert plan["conflicts"] == [("name", "A", ["B", "C"])]
+    assert plan["reentered"] == []
+    assert (0, "name", "A", "B") in plan["mapping"]
+
+
+def test_name_key_given_back_in_between_is_reported():
+    plan = core.prepare_mapping(
+        [(0, "name", "A", "B"), (1, "name", "X", "A"), (2, "name", "A", "C")]
+    )
+    assert plan["reentered"] == [("A", ["B", "C"])]
+    # Exact repeats and ID rows giving the key back count too
+    plan = core.prepare_mapping(
+        [(0, "name", "A", "B"), (1, "id", "id9", "A"), (2, "name", "A", "B")]
+    )
+    assert plan["reentered"] == [("A", ["B", "B"])]
+    # A row giving the key back before its first row does not
+    plan = core.prepare_mapping(
+        [(0, "name", "X", "A"), (1, "name", "A", "B"), (2, "name", "A", "C")]
+    )
+    assert plan["reentered"] == []
@@ -0,0 +1,83 @@
+import pytest
+
+import masking_core as core
+
+MODES = pytest.mark.parametrize(
+    "mode",
+    [
+        {"rowwise": True, "chunk_size": 1},
+        {"chunk_size": 1},
+        {"chunk_size": 10},
+        {"chunk_size": 10, "name_scan": True},
+        {"chunk_size": 1, "workers": 2},
+        {"chunk_size": 1, "compact_log": True},
+    ],
+    ids=["rowwise", "bulk", "one-chunk", "name-scan", "shards", "compact-log"],
+)
+
+
+def _crash_and_resume(standin, monkeypatch, mapping, rows_done, mode):
+    """
+    Run `mapping` as a batch (in `mode`, one of MODES) that dies once
+    rows_done mapping rows are committed, before any of its checkpoints reach
+    the checkpoint table, then resume it. Returns the batch id.
+    """
+    kwargs = dict(mode)
+    standin.target_db["name_scan"] = kwargs.pop("name_scan", False)
+    if kwargs.pop("compact_log", False):
+        standin.compact_log()
+    batch_id = core.new_batch_id()
+    report = core.Job.report
+
+    def crashing_report(job, done):
+        if done >= rows_done:
+            raise RuntimeError("crash")
+        report(job, done)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(core._DetailLogWriter, "checkpoint", lambda self, *a: None)
+        patch.setattr(core.Job, "report", crashing_report)
+        with pytest.raises(RuntimeError):
+            standin.batch(mapping, batch_id=batch_id, **kwargs)
+    standin.batch(mapping, batch_id=batch_id, resume=True, **kwargs)
+    return batch_id
+
+
+@MODES
+def test_resume_leaves_records_renamed_after_the_checkpoint(standin, monkeypatch, mode):
+    original = {"id0": "A", "id1": "A", "id2": "X", "id3": "X", "id4": "Y"}
+    mapping = [(0, "name", "A", "B"), (1, "name", "X", "A")]
+    standin.reset(original)
+    batch_id = _crash_and_resume(standin, monkeypatch, mapping, 2, mode)
+    assert standin.names() == {
+        "id0": "B",
+        "id1": "B",
+        "id2": "A",
+        "id3": "A",
+        "id4": "Y",
+    }
+    assert sorted(standin.details(batch_id)) == [
+        ("id0", "A", "B"),
+        ("id1", "A", "B"),
+        ("id2", "X", "A"),
+        ("id3", "X", "A"),
+    ]
+    standin.rollback(batch_id)
+    assert standin.names() == original
+
+
+@MODES
+def test_resume_still_runs_rows_past_the_crash(standin, monkeypatch, mode):
+    # id4 is renamed by ID before the crash and by name after it
+    original = {"id0": "A", "id4": "Y"}
+    mapping = [(0, "id", "id4", "A"), (1, "name", "A", "B")]
+    standin.reset(original)
+    batch_id = _crash_and_resume(standin, monkeypatch, mapping, 1, mode)
+    assert standin.names() == {"id0": "B", "id4": "B"}
+    assert sorted(standin.details(batch_id)) == [
+        ("id0", "A", "B"),
+        ("id4", "A", "B"),
+        ("id4", "Y", "A"),
+    ]
+    standin.rollback(batch_id)
+    assert standin.names() == original
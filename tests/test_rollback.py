@@ -0,0 +1,37 @@
+import pytest
+
+import masking_core as core
+
+
+@pytest.mark.parametrize(
+    "error, status",
+    [(core.JobCancelled, "cancelled"), (RuntimeError, "failed")],
+)
+def test_interrupted_batch_rolls_back(standin, monkeypatch, error, status):
+    original = {f"id{i}": f"name{i}" for i in range(6)}
+    mapping = [(i, "name", f"name{i}", f"new{i}") for i in range(6)]
+    standin.reset(original)
+    batch_id = core.new_batch_id()
+    report = core.Job.report
+
+    def interrupting_report(job, done):
+        if done >= 3:
+            raise error()
+        report(job, done)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(core.Job, "report", interrupting_report)
+        with pytest.raises(error):
+            standin.batch(mapping, chunk_size=1, batch_id=batch_id)
+    assert standin.names() != original
+
+    batch = core.find_batch(standin.main_db, batch_id)
+    assert batch["status"] == status and batch["total_rows"] == 3
+    assert core.rollback_blocker(batch, "test") is None
+    standin.rollback(batch_id)
+    assert standin.names() == original
+
+
+def test_failed_batch_without_details_is_blocked():
+    batch = {"env_name": "test", "status": "failed", "total_rows": 0}
+    assert core.rollback_blocker(batch, "test") is not None